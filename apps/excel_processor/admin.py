@@ -1,11 +1,16 @@
-from django.contrib import admin
-from django.utils.html import format_html
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Q
+from django.utils.html import format_html, format_html_join
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-import pandas as pd
-import openpyxl
 
-from .models import ExcelFile, QueryLog
+from . import ingest
+from .models import ExcelFile, QueryLog, SlowQuery
 
 
 @admin.register(ExcelFile)
@@ -48,6 +53,10 @@ class ExcelFileAdmin(admin.ModelAdmin):
         if not obj.file:
             return "No file uploaded"
 
+        # Imported here: the admin is loaded by every worker, the preview rarely
+        import openpyxl
+        import pandas as pd
+
         try:
             # Get basic file info
             wb = openpyxl.load_workbook(obj.file.path, read_only=True)
@@ -84,47 +93,135 @@ class ExcelFileAdmin(admin.ModelAdmin):
         """Override save to process Excel file metadata"""
         super().save_model(request, obj, form, change)
 
-        # Process file to extract metadata
+        # Process file to extract metadata and column statistics; the form
+        # has already run the preflight checks
         if obj.file:
+            if not ingest.can_catalog_inline(obj):
+                ingest.catalog_out_of_band(obj)
+                self.message_user(request, 'The workbook is being processed in the background', messages.INFO)
+                return
             try:
-                wb = openpyxl.load_workbook(obj.file.path, read_only=True)
-                obj.sheet_names = wb.sheetnames
-
-                # Get column information for each sheet
-                column_info = {}
-                for sheet_name in wb.sheetnames:
-                    try:
-                        df = pd.read_excel(obj.file.path, sheet_name=sheet_name, nrows=0)
-                        column_info[sheet_name] = {
-                            'columns': df.columns.tolist(),
-                            'column_count': len(df.columns)
-                        }
-                    except:
-                        continue
-
-                obj.column_info = column_info
-                wb.close()
+                obj.sheet_names, obj.column_info = ingest.catalog_for(obj)
                 obj.save()
+                for sheet, error in ingest.failed_sheets(obj.column_info).items():
+                    self.message_user(request, f'Could not read sheet {sheet}: {error}', messages.WARNING)
 
             except Exception as e:
                 pass  # Handle silently in admin
 
 
+class QueryLogChangeList(ChangeList):
+    """Changelist paged by a keyset cursor on (query_time, id) instead of page numbers
+
+    Page numbers need COUNT(*) and OFFSET over the whole log table; a cursor
+    reads one page from the query_time index wherever it is. The count
+    shown is capped at QUERYLOG_ADMIN_COUNT_LIMIT.
+    """
+
+    BEFORE_VAR = 'before'
+    AFTER_VAR = 'after'
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        for cursor_var in (self.BEFORE_VAR, self.AFTER_VAR):
+            params.pop(cursor_var, None)
+        return params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # A cursor only makes sense for the filters it was taken under
+        remove = list(remove or [])
+        if not new_params or not {self.BEFORE_VAR, self.AFTER_VAR} & set(new_params):
+            remove += [self.BEFORE_VAR, self.AFTER_VAR]
+        return super().get_query_string(new_params, remove)
+
+    @staticmethod
+    def _cursor(query_log):
+        return f'{query_log.query_time.isoformat()}_{query_log.pk}'
+
+    @staticmethod
+    def _parse_cursor(value):
+        try:
+            query_time, pk = value.rsplit('_', 1)
+            return datetime.fromisoformat(query_time), int(pk)
+        except (AttributeError, ValueError):
+            return None
+
+    def get_results(self, request):
+        per_page = self.list_per_page
+        queryset = self.queryset
+        before = self._parse_cursor(request.GET.get(self.BEFORE_VAR))
+        after = self._parse_cursor(request.GET.get(self.AFTER_VAR))
+
+        if after:
+            query_time, pk = after
+            rows = list(
+                queryset.filter(Q(query_time__gt=query_time) | Q(query_time=query_time, pk__gt=pk))
+                .order_by('query_time', 'pk')[:per_page + 1]
+            )
+            has_newer, has_older = len(rows) > per_page, True
+            rows = rows[:per_page][::-1]
+        else:
+            if before:
+                query_time, pk = before
+                queryset = queryset.filter(Q(query_time__lt=query_time) | Q(query_time=query_time, pk__lt=pk))
+            rows = list(queryset.order_by('-query_time', '-pk')[:per_page + 1])
+            has_newer, has_older = before is not None, len(rows) > per_page
+            rows = rows[:per_page]
+
+        # Count at most limit + 1 rows, enough to say "limit+"
+        limit = settings.QUERYLOG_ADMIN_COUNT_LIMIT
+        counted = self.queryset.values('pk')[:limit + 1].count()
+
+        self.result_list = rows
+        self.result_count = min(counted, limit)
+        self.count_capped = counted > limit
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = has_newer or has_older
+        self.paginator = None
+        self.newer_url = self.older_url = self.newest_url = None
+        if rows and has_newer:
+            self.newer_url = self.get_query_string({self.AFTER_VAR: self._cursor(rows[0])}, [self.BEFORE_VAR])
+        if rows and has_older:
+            self.older_url = self.get_query_string({self.BEFORE_VAR: self._cursor(rows[-1])}, [self.AFTER_VAR])
+        if before or after:
+            self.newest_url = self.get_query_string(remove=[self.BEFORE_VAR, self.AFTER_VAR])
+
+
 @admin.register(QueryLog)
 class QueryLogAdmin(admin.ModelAdmin):
     list_display = ['excel_file', 'sheet_name', 'result_found', 'query_time', 'filters_preview']
+    # query_time's range filter replaces date_hierarchy, whose drill-down
+    # scans the whole table for distinct dates on every page view
     list_filter = ['result_found', 'query_time', 'excel_file']
-    search_fields = ['excel_file__name', 'sheet_name']
+    search_fields = ['sheet_name']
     readonly_fields = ['excel_file', 'sheet_name', 'filters_applied', 'result_found', 'result_data', 'query_time']
-    date_hierarchy = 'query_time'
+    # Pages follow the keyset cursor, which only works in query_time order
+    sortable_by = ()
+    show_full_result_count = False
+    # Files live in the main database, so they are prefetched rather than joined
+    list_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('excel_file')
+
+    def get_changelist(self, request, **kwargs):
+        return QueryLogChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            file_ids = list(ExcelFile.objects.filter(name__icontains=search_term).values_list('id', flat=True))
+            queryset |= self.get_queryset(request).filter(excel_file_id__in=file_ids)
+        return queryset, may_have_duplicates
 
     def filters_preview(self, obj):
-        """Show a preview of applied filters"""
+        """Show a preview of applied filters, formatting only the first few"""
         if obj.filters_applied:
-            filters = []
-            for key, value in obj.filters_applied.items():
-                filters.append(f"{key}={value}")
-            return ", ".join(filters[:3]) + ("..." if len(filters) > 3 else "")
+            filters = [f"{key}={value}" for key, value in islice(obj.filters_applied.items(), 3)]
+            return ", ".join(filters) + ("..." if len(obj.filters_applied) > 3 else "")
         return "No filters"
     filters_preview.short_description = 'Applied Filters'
 
@@ -137,6 +234,47 @@ class QueryLogAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ['view_name', 'duration_display', 'excel_file', 'sheet_name', 'rows_scanned',
+                    'cache_hit', 'sampled', 'status_code', 'created_at']
+    list_filter = ['view_name', 'sampled', 'cache_hit', 'status_code', 'created_at']
+    search_fields = ['view_name', 'path', 'sheet_name']
+    readonly_fields = ['view_name', 'path', 'method', 'status_code', 'user', 'excel_file', 'sheet_name',
+                       'filters', 'rows_scanned', 'cache_hit', 'duration_ms', 'phases_breakdown',
+                       'sampled', 'created_at']
+    exclude = ['phases']
+    date_hierarchy = 'created_at'
+    ordering = ['-duration_ms']
+    # Like QueryLog, slow queries live in the log database
+    list_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('excel_file')
+
+    def duration_display(self, obj):
+        return f"{obj.duration_ms:.0f} ms"
+    duration_display.short_description = 'Duration'
+    duration_display.admin_order_field = 'duration_ms'
+
+    def phases_breakdown(self, obj):
+        """Show where the time went, slowest phase first"""
+        if not obj.phases:
+            return "No phases recorded"
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td style="text-align: right;">{} ms</td></tr>',
+            ((name, f"{elapsed:.1f}") for name, elapsed in sorted(obj.phases.items(), key=lambda item: -item[1]))
+        )
+        return format_html('<table>{}</table>', rows)
+    phases_breakdown.short_description = 'Phases'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 # Customize admin site
 admin.site.site_header = "Excel Analyzer Admin"
 admin.site.site_title = "Excel Analyzer"
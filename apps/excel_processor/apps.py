@@ -5,3 +5,14 @@ class ExcelProcessorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.excel_processor'
     verbose_name = 'Excel Processor'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+
+        from .routers import configure_connection
+        connection_created.connect(configure_connection)
+
+        if settings.SHEET_PREWARM_ON_STARTUP:
+            from . import prewarm
+            prewarm.start_background_prewarm()
@@ -0,0 +1,171 @@
+"""Compact copies of small sheets, downloaded once and filtered in the browser
+
+A payload holds a sheet's configured filter and result columns, each
+dictionary-encoded: the column's distinct values are listed once and
+every row refers to one of them by position. Filter columns are encoded
+by normalized key, so a dropdown value matches in the browser exactly as
+it would in query.parse_filters; result columns hold the values
+fetch_results would return.
+
+Payloads are versioned by the workbook content and the sheet's column
+configuration, so a URL naming a version never changes meaning and can
+be cached for good. Each version is compressed once, with gzip and, when
+the brotli package is installed, brotli, and kept next to the sheet's
+snapshot.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+
+from . import query, snapshots
+from .sheet_cache import LoadedSheet, SheetSource
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip is always available
+    brotli = None
+
+
+FORMAT_VERSION = 1
+
+# Preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+def version(excel_file, sheet_name):
+    """Return the payload version for a sheet's content and column configuration"""
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    source = SheetSource.for_excel_file(excel_file, sheet_name)
+    identity = json.dumps([
+        FORMAT_VERSION,
+        source.fingerprint,
+        sheet_name,
+        sheet_config.get('filter_columns', []),
+        sheet_config.get('result_columns', ['total']),
+    ])
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def payload_path(excel_file, sheet_name, payload_version, encoding):
+    source = SheetSource.for_excel_file(excel_file, sheet_name)
+    extension = {'br': 'br', 'gzip': 'gz'}[encoding]
+    return os.path.join(
+        snapshots.sheet_dir(source.fingerprint, sheet_name),
+        f'dataset-{payload_version}.json.{extension}'
+    )
+
+
+def _encode(values):
+    """Dictionary-encode a list of JSON values into {'values': [...], 'codes': [...]}"""
+    positions = {}
+    dictionary = []
+    codes = []
+    for value in values:
+        # Keyed by JSON text so 1, 1.0 and True stay distinct
+        key = json.dumps(value)
+        code = positions.get(key)
+        if code is None:
+            code = positions[key] = len(dictionary)
+            dictionary.append(value)
+        codes.append(code)
+    return {'values': dictionary, 'codes': codes}
+
+
+def build_payload(sheet, sheet_config, payload_version):
+    """Return the payload for a loaded sheet holding its filter columns
+
+    Result columns are read from the snapshot for the payload only; the
+    cached sheet keeps holding just the columns requests asked for.
+    """
+    filter_columns = [column for column in sheet_config.get('filter_columns', []) if column in sheet.keys]
+    result_columns = sheet_config.get('result_columns', ['total'])
+    row_count = sheet.row_count or 0
+
+    data = dict(sheet.data)
+    data.update(sheet.source.read_columns([
+        column for column in result_columns if column in sheet.columns and column not in data
+    ]))
+    results = [
+        query.result_values({column: data[column][row] for column in result_columns if column in data}, result_columns)
+        for row in range(row_count)
+    ]
+    result_names = list(query.result_values({}, result_columns))
+    return {
+        'version': payload_version,
+        'row_count': row_count,
+        'columns': {
+            column: _encode(sheet.keys[column].tolist())
+            for column in filter_columns
+        },
+        # A list, not an object, so the browser keeps the configured order
+        'result_columns': result_names,
+        'results': [_encode([values[name] for values in results]) for name in result_names],
+    }
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def write_payload(excel_file, sheet_name, sheet, payload_version):
+    """Compress and store a payload in every available encoding"""
+    payload = build_payload(sheet, excel_file.sheet_config.get(sheet_name, {}), payload_version)
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    if brotli is not None:
+        _write(payload_path(excel_file, sheet_name, payload_version, 'br'), brotli.compress(data))
+    # gzip last: its presence marks the payload as complete
+    _write(payload_path(excel_file, sheet_name, payload_version, 'gzip'), gzip.compress(data, mtime=0))
+
+
+def is_servable(excel_file, sheet_name, payload_version):
+    """Whether a stored payload exists and is within CLIENT_DATASET_MAX_BYTES"""
+    try:
+        size = os.path.getsize(payload_path(excel_file, sheet_name, payload_version, 'gzip'))
+    except FileNotFoundError:
+        return False
+    return size <= settings.CLIENT_DATASET_MAX_BYTES
+
+
+def ensure_payload(excel_file, sheet_name, sheet):
+    """Return the version of a sheet's payload, writing it if needed
+
+    Returns None when the sheet is served by the API instead: payloads
+    are disabled, the sheet is held in SQLite or has more than
+    CLIENT_DATASET_MAX_ROWS rows, or its payload compresses to more
+    than CLIENT_DATASET_MAX_BYTES. Oversized payloads are still stored,
+    so the check is not repeated on every request.
+    """
+    if not settings.CLIENT_DATASET_ENABLED or not isinstance(sheet, LoadedSheet):
+        return None
+    if sheet.row_count is None or sheet.row_count > settings.CLIENT_DATASET_MAX_ROWS:
+        return None
+
+    payload_version = version(excel_file, sheet_name)
+    if not os.path.exists(payload_path(excel_file, sheet_name, payload_version, 'gzip')):
+        write_payload(excel_file, sheet_name, sheet, payload_version)
+    return payload_version if is_servable(excel_file, sheet_name, payload_version) else None
+
+
+def negotiate(excel_file, sheet_name, payload_version, accept_encoding):
+    """Return (encoding, path) of the stored payload to serve, or (None, gzip path)
+
+    With no acceptable encoding the gzip payload is decompressed on the way out.
+    """
+    accepted = {
+        part.split(';')[0].strip().lower()
+        for part in (accept_encoding or '').split(',')
+        if not part.replace(' ', '').endswith(';q=0')
+    }
+    for encoding in ENCODINGS:
+        path = payload_path(excel_file, sheet_name, payload_version, encoding)
+        if encoding in accepted and os.path.exists(path):
+            return encoding, path
+    return None, payload_path(excel_file, sheet_name, payload_version, 'gzip')
@@ -0,0 +1,67 @@
+"""Content-addressed storage for uploaded workbooks
+
+Uploads are stored under the SHA-256 of their bytes, so the same workbook
+uploaded twice (under any name) is one blob on disk, one set of parsed
+snapshots and indexes, and one catalog. ExcelFile rows reference blobs;
+the last row to go deletes the blob and its snapshots. Storing a blob's
+row and releasing the blob both hold its content lock, so a release
+cannot delete a blob a new row is being saved against.
+"""
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from . import singleflight
+
+
+CONTENT_DIR = 'excel_files/sha256'
+_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(file):
+    """SHA-256 hex digest of a file's bytes, leaving it rewound"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def content_name(digest, filename):
+    """Storage name of a blob: its hash, keeping the extension pandas needs to pick an engine"""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{CONTENT_DIR}/{digest[:2]}/{digest}{extension}'
+
+
+def is_content_name(name):
+    return name.startswith(CONTENT_DIR + '/')
+
+
+def content_lock(storage, digest):
+    """Exclusive lock on a blob across processes, held while it is stored or released
+
+    The lock file stays behind when the blob is deleted, as waiters may
+    still hold it open.
+    """
+    return singleflight.file_lock(storage.path(f'{CONTENT_DIR}/{digest[:2]}/{digest}.lock'))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """File storage where an existing content-addressed name already holds the same bytes"""
+
+    def get_available_name(self, name, max_length=None):
+        if is_content_name(name):
+            return name
+        return super().get_available_name(name, max_length=max_length)
+
+    def _save(self, name, content):
+        if is_content_name(name) and self.exists(name):
+            return name
+        return super()._save(name, content)
+
+
+content_storage = ContentAddressedStorage()
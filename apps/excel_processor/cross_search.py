@@ -0,0 +1,104 @@
+"""Run one filter set across every active file and enabled sheet concurrently"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from . import query_servers
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # One pool per process, so concurrent searches share the same bound
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CROSS_SEARCH_MAX_WORKERS,
+                thread_name_prefix='cross-search'
+            )
+        return _executor
+
+
+def filter_columns(excel_files):
+    """Columns any enabled sheet of `excel_files` can be filtered on"""
+    columns = set()
+    for excel_file in excel_files:
+        for config in (excel_file.sheet_config or {}).values():
+            if config.get('is_enabled', True):
+                columns.update(config.get('filter_columns', []))
+    return columns
+
+
+def searchable_sheets(excel_files, columns):
+    """Yield (excel_file, sheet_name) for enabled sheets filterable on all `columns`"""
+    for excel_file in excel_files:
+        sheet_config = excel_file.sheet_config or {}
+        for sheet_name in excel_file.sheet_names or []:
+            config = sheet_config.get(sheet_name, {})
+            if not config.get('is_enabled', True):
+                continue
+            # A sheet that cannot apply every filter would match too broadly
+            if all(column in config.get('filter_columns', []) for column in columns):
+                yield excel_file, sheet_name
+
+
+def _search_sheet(excel_file, sheet_name, filters):
+    results = query_servers.run('first_match', excel_file, sheet_name, filters=filters)
+    if results is None:
+        return None
+    return {
+        'file_id': excel_file.id,
+        'file_name': excel_file.name,
+        'sheet_name': sheet_name,
+        'results': results,
+    }
+
+
+def search_all(excel_files, filters, time_budget):
+    """Yield a dict per matching sheet as soon as it is found, then a summary
+
+    Sheets still running when `time_budget` seconds have passed are
+    abandoned and the summary reports `timed_out`. Every filter in
+    `filters` must have been validated by query.parse_filters.
+    """
+    deadline = time.monotonic() + time_budget
+    executor = _get_executor()
+    pending = {
+        executor.submit(_search_sheet, excel_file, sheet_name, filters): (excel_file, sheet_name)
+        for excel_file, sheet_name in searchable_sheets(excel_files, filters)
+    }
+    searched = len(pending)
+    matches = 0
+
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                excel_file, sheet_name = pending.pop(future)
+                try:
+                    match = future.result()
+                except Exception as e:
+                    yield {'file_id': excel_file.id, 'sheet_name': sheet_name, 'error': str(e)}
+                    continue
+                if match is not None:
+                    matches += 1
+                    yield match
+    finally:
+        # Anything left is either over budget or the client went away
+        for future in pending:
+            future.cancel()
+
+    yield {
+        'done': True,
+        'searched': searched,
+        'matches': matches,
+        'timed_out': bool(pending),
+    }
@@ -0,0 +1,226 @@
+"""Streaming top-K counts of the filter combinations lookups ask for
+
+Grouping QueryLog by its filters JSON scans the whole table, so each
+worker process instead counts lookups in a space-saving summary: at
+most HEAVY_HITTER_CAPACITY combinations are tracked, and a new one
+replaces the least counted, inheriting its count as possible error.
+Counts are never under-estimated, and any combination asked for more
+than total / capacity times is guaranteed to be tracked.
+
+Every HEAVY_HITTER_FLUSH_INTERVAL seconds a worker merges what it
+counted since into the FilterSummary row in the log database, so the
+analytics page sees every process without any of them holding more
+than one summary. A merge that finds the database locked is retried,
+and counts that still could not be stored are kept for the next flush.
+"""
+import atexit
+import heapq
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, OperationalError, transaction
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_NAME = 'filters'
+
+STORE_ATTEMPTS = 3
+STORE_RETRY_DELAY = 0.05  # Seconds, doubled after each attempt
+
+
+class SpaceSaving:
+    """Space-saving summary: approximate counts of the most frequent keys in bounded memory"""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or settings.HEAVY_HITTER_CAPACITY
+        self.total = 0
+        # {key: [count, error]}; the true count is within [count - error, count]
+        self.counters = {}
+
+    def __len__(self):
+        return len(self.counters)
+
+    def _floor(self):
+        """Most times an untracked key can have been seen"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def offer(self, key, weight=1):
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+        else:
+            # A linear scan; evictions only happen for new keys once full
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def merge(self, other):
+        """Add another summary's counts into this one, keeping the largest `capacity`"""
+        floor, other_floor = self._floor(), other._floor()
+        merged = {}
+        for key in self.counters.keys() | other.counters.keys():
+            # A key missing from a full summary may have been seen up to its floor
+            count, error = self.counters.get(key, (floor, floor))
+            other_count, other_error = other.counters.get(key, (other_floor, other_floor))
+            merged[key] = [count + other_count, error + other_error]
+        self.counters = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0]))
+        self.total += other.total
+        return self
+
+    def remove(self, keys):
+        """Stop tracking `keys`; the total still counts them, as they were seen"""
+        for key in keys:
+            self.counters.pop(key, None)
+
+    def top(self, k=None):
+        """[(key, count, error)] for the `k` most counted keys"""
+        items = heapq.nlargest(k or len(self.counters), self.counters.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in items]
+
+    def to_list(self):
+        return [[key, count, error] for key, count, error in self.top()]
+
+    @classmethod
+    def from_list(cls, counters, total=0, capacity=None):
+        summary = cls(capacity)
+        summary.total = total
+        summary.counters = {key: [count, error] for key, count, error in counters}
+        return summary
+
+
+_lock = threading.Lock()
+_pending = None
+_last_flush = time.monotonic()
+
+
+def combination_key(excel_file_id, sheet_name, filters):
+    """Canonical text for a (file, sheet, applied filters) combination"""
+    return json.dumps([excel_file_id, sheet_name, filters], sort_keys=True, separators=(',', ':'), default=str)
+
+
+def record(excel_file_id, sheet_name, filters):
+    """Count one lookup, merging into the log database when the flush interval has passed"""
+    global _pending
+    with _lock:
+        if _pending is None:
+            _pending = SpaceSaving()
+        _pending.offer(combination_key(excel_file_id, sheet_name, filters))
+        due = time.monotonic() - _last_flush >= settings.HEAVY_HITTER_FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def _take_pending():
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, None
+        _last_flush = time.monotonic()
+    return pending
+
+
+def _restore(pending):
+    """Put counts that could not be stored back, to go out with the next flush"""
+    global _pending
+    with _lock:
+        _pending = pending if _pending is None else pending.merge(_pending)
+
+
+def _update_stored(change):
+    """Apply change(summary) to the stored summary, retrying while the log database is locked"""
+    from .models import FilterSummary
+
+    for attempt in range(STORE_ATTEMPTS):
+        try:
+            # Durable: commits here, never with a transaction the caller has open
+            with transaction.atomic(using=settings.LOG_DATABASE, durable=True):
+                stored, _ = FilterSummary.objects.select_for_update().get_or_create(name=SUMMARY_NAME)
+                summary = SpaceSaving.from_list(stored.counters, stored.total)
+                change(summary)
+                stored.counters = summary.to_list()
+                stored.total = summary.total
+                stored.save()
+            return
+        except OperationalError:
+            # SQLite fails at once, without waiting out its timeout, when
+            # another writer got in before this read could become a write
+            if attempt == STORE_ATTEMPTS - 1:
+                raise
+            time.sleep(STORE_RETRY_DELAY * 2 ** attempt)
+
+
+def flush():
+    """Merge this process's counts into the stored summary"""
+    pending = _take_pending()
+    if not pending:
+        return
+    try:
+        _update_stored(lambda summary: summary.merge(pending))
+    except DatabaseError:
+        # Keep serving lookups; the counts are kept for the next flush
+        logger.exception('Could not store popular filter counts')
+        _restore(pending)
+
+
+def _file_keys(summary, excel_file_id):
+    return [key for key in summary.counters if json.loads(key)[0] == excel_file_id]
+
+
+def forget_file(excel_file_id):
+    """Drop a deleted file's combinations from this process's counts and the stored summary"""
+    with _lock:
+        if _pending:
+            _pending.remove(_file_keys(_pending, excel_file_id))
+    try:
+        _update_stored(lambda summary: summary.remove(_file_keys(summary, excel_file_id)))
+    except DatabaseError:
+        logger.exception('Could not drop popular filter counts of file %s', excel_file_id)
+
+
+def summary():
+    """The stored summary merged with counts not yet flushed by this process"""
+    from .models import FilterSummary
+
+    stored = FilterSummary.objects.filter(name=SUMMARY_NAME).first()
+    merged = SpaceSaving.from_list(stored.counters, stored.total) if stored else SpaceSaving()
+    with _lock:
+        if _pending:
+            merged.merge(_pending)
+    return merged
+
+
+def top(k=None):
+    """Return ([{file_id, sheet_name, filters, count, error}], lookups counted) for the top `k`"""
+    merged = summary()
+    combinations = []
+    for key, count, error in merged.top(k or settings.HEAVY_HITTER_TOP):
+        excel_file_id, sheet_name, filters = json.loads(key)
+        combinations.append({
+            'file_id': excel_file_id,
+            'sheet_name': sheet_name,
+            'filters': filters,
+            'count': count,
+            'error': error,
+        })
+    return combinations, merged.total
+
+
+def _flush_at_exit():
+    # Best effort: the database may already be gone at interpreter exit
+    pending = _take_pending()
+    if pending:
+        try:
+            _update_stored(lambda summary: summary.merge(pending))
+        except Exception:
+            pass
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,318 @@
+"""Workbook catalog built at upload: sheet names, columns and per-column statistics
+
+The statistics are stored in ExcelFile.column_info and drive query
+planning: which kind of key index a filter column gets, and how the
+configure pages warn about columns with too many values for a dropdown.
+
+Sheets are parsed in parallel, up to INGEST_WORKERS processes, and each
+parse also writes the sheet's column snapshot so the first lookup does
+not parse it again. A sheet that fails is cataloged with its error
+instead of failing the whole workbook. Workbooks preflight finds too
+costly to parse during the upload request are cataloged out of band;
+their sheets are marked pending in column_info meanwhile, and an ingest
+that fails, or never finishes, leaves them to be retried.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import preflight, snapshots
+from .normalize import normalize_array
+from .query import json_value
+from .sheet_cache import column_values
+
+
+logger = logging.getLogger(__name__)
+
+
+def index_kind(dtype, distinct_count):
+    """Pick the key index for a filter column from its statistics
+
+    Few distinct values get a bitmap per value, numeric columns a sorted
+    index (which also serves ranges), everything else a hash of row lists.
+    """
+    if distinct_count <= settings.BITMAP_INDEX_MAX_DISTINCT:
+        return 'bitmap'
+    if dtype in ('integer', 'float'):
+        return 'sorted'
+    return 'hash'
+
+
+def _dtype(series):
+    import pandas as pd
+
+    if pd.api.types.is_bool_dtype(series):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(series):
+        return 'integer'
+    if pd.api.types.is_float_dtype(series):
+        return 'float'
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return 'datetime'
+    return 'text'
+
+
+def column_stats(df):
+    """Return {column: statistics} for every column of a parsed sheet"""
+    # Whole-frame reductions, one pass each rather than one per column
+    null_counts = df.isna().sum()
+    distinct_counts = df.nunique(dropna=True)
+
+    stats = {}
+    for column in df.columns:
+        series = df[column]
+        dtype = _dtype(series)
+        top_values = series.value_counts(dropna=True).head(settings.COLUMN_STATS_TOP_VALUES)
+        column_stats = {
+            'dtype': dtype,
+            'null_count': int(null_counts[column]),
+            'distinct_count': int(distinct_counts[column]),
+            'min': None,
+            'max': None,
+            'top_values': [[json_value(value), int(count)] for value, count in top_values.items()],
+        }
+        if dtype in ('integer', 'float') and column_stats['null_count'] < len(series):
+            column_stats['min'] = json_value(series.min())
+            column_stats['max'] = json_value(series.max())
+        column_stats['index'] = index_kind(dtype, column_stats['distinct_count'])
+        stats[str(column)] = column_stats
+    return stats
+
+
+def sheet_catalog(df):
+    """Catalog entry of one parsed sheet, as stored in column_info"""
+    columns = [str(column) for column in df.columns]
+    return {
+        'columns': columns,
+        'column_count': len(columns),
+        'row_count': len(df),
+        'stats': column_stats(df),
+    }
+
+
+def failed_catalog(error):
+    """Catalog entry of a sheet that could not be parsed"""
+    return {'columns': [], 'column_count': 0, 'row_count': 0, 'stats': {}, 'error': str(error)}
+
+
+def pending_catalog():
+    """Catalog entry of a sheet being cataloged out of band"""
+    return {'pending': time.time()}
+
+
+def failed_sheets(column_info):
+    """{sheet name: error} for the sheets whose ingest failed"""
+    return {sheet: entry['error'] for sheet, entry in (column_info or {}).items() if 'error' in entry}
+
+
+def is_cataloged(column_info, sheet_names):
+    """Whether every sheet has statistics from a successful ingest"""
+    column_info = column_info or {}
+    return all(
+        'stats' in column_info.get(sheet, {}) and 'error' not in column_info[sheet]
+        for sheet in sheet_names
+    )
+
+
+def is_catalog_pending(column_info, sheet_names):
+    """Whether an out-of-band ingest of the sheets may still be running
+
+    Pending entries older than INGEST_PENDING_TIMEOUT are taken to belong
+    to an ingest lost with its process.
+    """
+    column_info = column_info or {}
+    started = [column_info.get(sheet, {}).get('pending') for sheet in sheet_names]
+    started = [when for when in started if when is not None]
+    return bool(started) and time.time() - max(started) < settings.INGEST_PENDING_TIMEOUT
+
+
+def _write_snapshot(fingerprint, sheet_name, df):
+    # The same parts SheetSource writes, so later loads read them instead
+    snapshots.write(fingerprint, sheet_name, 'header', df.columns.tolist())
+    for column in df.columns:
+        values = column_values(df[column])
+        snapshots.write(fingerprint, sheet_name, snapshots.column_part(column), values)
+        snapshots.write(fingerprint, sheet_name, snapshots.key_part(column), normalize_array(values))
+
+
+def ingest_sheet(path, sheet_name, fingerprint=None):
+    """Parse one sheet, snapshot it under `fingerprint`, and return its catalog entry
+
+    Cells are parsed as read, as SheetSource parses them; the statistics
+    use the inferred column types. Sheets big enough for the SQLite
+    backend are not snapshotted, as they are never loaded into memory.
+    """
+    import pandas as pd
+
+    df = pd.read_excel(path, sheet_name=sheet_name, dtype=object)
+    if fingerprint is not None and len(df) <= settings.SQLITE_BACKEND_ROW_THRESHOLD:
+        _write_snapshot(fingerprint, sheet_name, df)
+    return sheet_catalog(df.infer_objects())
+
+
+# Settings ingest_sheet reads, handed to workers as the caller sees them
+WORKER_SETTINGS = (
+    'SHEET_SNAPSHOT_DIR',
+    'SQLITE_BACKEND_ROW_THRESHOLD',
+    'COLUMN_STATS_TOP_VALUES',
+    'BITMAP_INDEX_MAX_DISTINCT',
+)
+
+
+def _pool_context():
+    # Forking a web worker copies locks other threads may hold; workers
+    # start from a clean process instead and set Django up themselves
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _init_worker(settings_module, worker_settings):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+    # Values the caller overrides at runtime, e.g. in tests
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
+
+
+def workbook_catalog(path, fingerprint=None, isolated=False):
+    """Return (sheet names, column_info) for a workbook, one sheet per worker process
+
+    With `isolated`, sheets are parsed in worker processes even when
+    INGEST_WORKERS is 1, so a parse that runs out of memory takes down a
+    worker rather than the calling process.
+    """
+    import pandas as pd
+
+    with pd.ExcelFile(path) as workbook:
+        sheet_names = list(workbook.sheet_names)
+
+    column_info = {}
+    workers = min(settings.INGEST_WORKERS, len(sheet_names))
+    if workers <= 1 and not isolated:
+        for sheet_name in sheet_names:
+            try:
+                column_info[sheet_name] = ingest_sheet(path, sheet_name, fingerprint)
+            except Exception as e:
+                column_info[sheet_name] = failed_catalog(e)
+        return sheet_names, column_info
+
+    pool = ProcessPoolExecutor(
+        max_workers=max(1, workers),
+        mp_context=_pool_context(),
+        initializer=_init_worker,
+        initargs=(settings.SETTINGS_MODULE, {name: getattr(settings, name) for name in WORKER_SETTINGS}),
+    )
+    with pool:
+        futures = {
+            sheet_name: pool.submit(ingest_sheet, path, sheet_name, fingerprint)
+            for sheet_name in sheet_names
+        }
+        for sheet_name, future in futures.items():
+            try:
+                column_info[sheet_name] = future.result()
+            except Exception as e:
+                # Includes a worker that died, e.g. out of memory
+                column_info[sheet_name] = failed_catalog(e)
+    return sheet_names, column_info
+
+
+def catalog_for(excel_file, isolated=False):
+    """Return (sheet names, column_info), copied from another row with the same content if any"""
+    if excel_file.content_hash:
+        from .models import ExcelFile
+        twin = (
+            ExcelFile.objects.filter(content_hash=excel_file.content_hash)
+            .exclude(pk=excel_file.pk).exclude(sheet_names=[])
+            .only('sheet_names', 'column_info').first()
+        )
+        if twin is not None and is_cataloged(twin.column_info, twin.sheet_names):
+            return list(twin.sheet_names), twin.column_info
+    return workbook_catalog(excel_file.file.path, excel_file.content_hash or None, isolated)
+
+
+def ensure_catalog(excel_file, isolated=False):
+    """Build and save the catalog of a file uploaded before it existed, or deferred"""
+    column_info = excel_file.column_info or {}
+    if excel_file.sheet_names and is_cataloged(column_info, excel_file.sheet_names):
+        return column_info
+    sheet_names, column_info = catalog_for(excel_file, isolated)
+    excel_file.sheet_names = excel_file.sheet_names or sheet_names
+    excel_file.column_info = column_info
+    excel_file.save(update_fields=['sheet_names', 'column_info'])
+    return column_info
+
+
+def can_catalog_inline(excel_file):
+    """Whether preflight finds a stored workbook cheap enough to catalog within a request"""
+    try:
+        inspection = preflight.inspect(excel_file.file.path)
+    except preflight.PreflightError:
+        return False
+    return inspection is None or inspection.parse_inline
+
+
+def _store_failure(excel_file_id, error):
+    from .models import ExcelFile
+
+    excel_file = ExcelFile.objects.filter(id=excel_file_id).first()
+    if excel_file is None:
+        return
+    column_info = dict(excel_file.column_info or {})
+    for sheet_name in excel_file.sheet_names:
+        if not is_cataloged(column_info, [sheet_name]):
+            column_info[sheet_name] = failed_catalog(error)
+    excel_file.column_info = column_info
+    excel_file.save(update_fields=['column_info'])
+
+
+def catalog_deferred(excel_file_id):
+    """Catalog a workbook in worker processes, storing the error on its sheets if that fails"""
+    from .models import ExcelFile
+
+    try:
+        excel_file = ExcelFile.objects.get(id=excel_file_id)
+    except ExcelFile.DoesNotExist:
+        return None
+    try:
+        return ensure_catalog(excel_file, isolated=True)
+    except Exception as e:
+        logger.exception('Out-of-band ingest of file %s failed', excel_file_id)
+        # The configure pages report the error and retry, as for a sheet that failed to parse
+        _store_failure(excel_file_id, e)
+        return None
+
+
+def _catalog_deferred(excel_file_id):
+    try:
+        catalog_deferred(excel_file_id)
+    except Exception:
+        logger.exception('Could not record the failed ingest of file %s', excel_file_id)
+    finally:
+        close_old_connections()
+
+
+def catalog_out_of_band(excel_file):
+    """Mark a workbook's uncataloged sheets pending and catalog them on a background thread"""
+    column_info = dict(excel_file.column_info or {})
+    for sheet_name in excel_file.sheet_names:
+        if not is_cataloged(column_info, [sheet_name]):
+            column_info[sheet_name] = pending_catalog()
+    excel_file.column_info = column_info
+    excel_file.save(update_fields=['column_info'])
+    threading.Thread(
+        target=_catalog_deferred, args=(excel_file.id,), name='ingest', daemon=True
+    ).start()
+
+
+def cardinalities(column_info, sheet_name):
+    """{column: distinct count} of one sheet, for the configure pages"""
+    stats = column_info.get(sheet_name, {}).get('stats', {})
+    return {column: column_stats['distinct_count'] for column, column_stats in stats.items()}
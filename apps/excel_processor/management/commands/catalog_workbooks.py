@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from apps.excel_processor import ingest
+from apps.excel_processor.models import ExcelFile
+
+
+class Command(BaseCommand):
+    help = (
+        'Catalog workbooks whose sheets have no catalog yet, including out-of-band '
+        'ingests that failed or were lost with their process'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--include-pending', action='store_true',
+                            help='Also catalog workbooks an out-of-band ingest may still be working on')
+
+    def handle(self, *args, **options):
+        cataloged = 0
+        for excel_file in ExcelFile.objects.filter(is_active=True).exclude(file='').order_by('id'):
+            column_info = excel_file.column_info or {}
+            if excel_file.sheet_names and ingest.is_cataloged(column_info, excel_file.sheet_names):
+                continue
+            if not options['include_pending'] and ingest.is_catalog_pending(column_info, excel_file.sheet_names):
+                self.stdout.write(f'{excel_file.name}: still pending')
+                continue
+            column_info = ingest.catalog_deferred(excel_file.id)
+            if column_info is None:
+                self.stdout.write(self.style.ERROR(f'{excel_file.name}: failed'))
+                continue
+            for sheet, error in ingest.failed_sheets(column_info).items():
+                self.stdout.write(self.style.WARNING(f'{excel_file.name} / {sheet}: {error}'))
+            cataloged += 1
+        self.stdout.write(self.style.SUCCESS(f'Cataloged {cataloged} workbook(s)'))
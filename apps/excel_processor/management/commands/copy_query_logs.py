@@ -0,0 +1,91 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+
+from apps.excel_processor.models import QueryLog, ResultPayload
+
+
+# Columns of the table as it was before the log database existed
+LEGACY_FIELDS = ['id', 'user_id', 'excel_file_id', 'sheet_name', 'filters_applied', 'result_found', 'query_time']
+
+# What identifies a copied row, whichever id it ended up with
+IDENTITY_FIELDS = ['query_time', 'user_id', 'excel_file_id', 'sheet_name']
+
+
+def identity(row):
+    return tuple(row[field] for field in IDENTITY_FIELDS)
+
+
+class Command(BaseCommand):
+    help = 'Copy query logs written before the log database existed out of the default database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Start after this legacy row id, as reported by an interrupted run')
+
+    def handle(self, *args, **options):
+        table = QueryLog._meta.db_table
+        if table not in connections['default'].introspection.table_names():
+            self.stdout.write('No query log table in the default database')
+            return
+
+        # The legacy table has result_data rather than the result payload
+        # reference, so only its own columns are selected
+        source = (
+            QueryLog.objects.using('default').order_by('id').values(*LEGACY_FIELDS)
+            .annotate(legacy_result=RawSQL('result_data', ()))
+        )
+        target = QueryLog.objects.using(settings.LOG_DATABASE)
+        payloads = ResultPayload.objects.db_manager(settings.LOG_DATABASE)
+
+        # Progress follows the source's ids: lookups logged since the log
+        # database went live have ids of their own that say nothing about
+        # how far the copy got
+        last_id = options['after_id']
+        copied = skipped = renumbered = 0
+        while True:
+            batch = list(source.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1]['id']
+            with transaction.atomic(using=settings.LOG_DATABASE):
+                # Rows copied by an earlier run are skipped; ids a new
+                # lookup has taken are left to it and the copy gets another
+                already_copied = {
+                    identity(row) for row in
+                    target.filter(query_time__in=[row['query_time'] for row in batch]).values(*IDENTITY_FIELDS)
+                }
+                taken = set(target.filter(id__in=[row['id'] for row in batch]).values_list('id', flat=True))
+
+                logs, query_times = [], []
+                for row in batch:
+                    result = row.pop('legacy_result')
+                    if identity(row) in already_copied:
+                        skipped += 1
+                        continue
+                    if row['id'] in taken:
+                        del row['id']
+                        renumbered += 1
+                    if isinstance(result, str):
+                        result = json.loads(result)
+                    log = QueryLog(**row)
+                    if result is not None:
+                        log.result = payloads.intern(result)
+                    logs.append(log)
+                    query_times.append(row['query_time'])
+                target.bulk_create(logs)
+                # bulk_create stamps auto_now_add fields with the current time
+                for log, query_time in zip(logs, query_times):
+                    log.query_time = query_time
+                target.bulk_update(logs, ['query_time'])
+            copied += len(logs)
+            self.stdout.write(f'Copied up to legacy id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Copied {copied} query log(s), {renumbered} under a new id; '
+            f'{skipped} already copied'
+        ))
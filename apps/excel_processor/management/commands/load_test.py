@@ -0,0 +1,377 @@
+import http.client
+import io
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from apps.excel_processor.models import ExcelFile
+
+
+NAME_PREFIX = 'Load test'
+USER_PREFIX = 'loadtest-'
+
+# Synthetic filter columns and how many distinct values each has
+FILTER_COLUMNS = {'region': 8, 'grade': 5, 'category': 20, 'size': 50}
+
+# Response bodies naming SQLite lock contention
+LOCK_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, or None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def skewed_weights(count, skew):
+    """Zipf-like weights: rank r is chosen in proportion to 1 / r**skew (0 is uniform)"""
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def synthetic_workbook(sheets, rows, seed):
+    """An .xlsx with `sheets` sheets of `rows` rows over FILTER_COLUMNS, plus total and product_code"""
+    # Imported here: only the setup step needs pandas
+    import pandas as pd
+
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for position in range(sheets):
+            data = {
+                column: [f'{column}-{rng.randrange(values)}' for _ in range(rows)]
+                for column, values in FILTER_COLUMNS.items()
+            }
+            data['total'] = [round(rng.uniform(1, 1000), 2) for _ in range(rows)]
+            data['product_code'] = [f'P{position}-{row}' for row in range(rows)]
+            pd.DataFrame(data).to_excel(writer, sheet_name=f'Sheet{position + 1}', index=False)
+    return buffer.getvalue()
+
+
+class Recorder:
+    """Thread-safe request samples, reported per interval and in total"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []  # (finished at, endpoint, milliseconds, outcome)
+
+    def add(self, endpoint, duration_ms, outcome):
+        with self.lock:
+            self.samples.append((time.monotonic(), endpoint, duration_ms, outcome))
+
+    def since(self, start):
+        with self.lock:
+            return [sample for sample in self.samples if sample[0] >= start]
+
+
+def summarize(samples, seconds):
+    durations = [duration for _, _, duration, _ in samples]
+    outcomes = [outcome for _, _, _, outcome in samples]
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / seconds if seconds > 0 else 0.0,
+        'p50': percentile(durations, 0.50),
+        'p95': percentile(durations, 0.95),
+        'p99': percentile(durations, 0.99),
+        'errors': sum(1 for outcome in outcomes if outcome != 'ok'),
+        'locked': outcomes.count('locked'),
+    }
+
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.0f}'
+
+
+class Session:
+    """One simulated browser: a logged-in user with a keep-alive connection"""
+
+    def __init__(self, base_url, cookie, recorder, timeout):
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self.cookie = cookie
+        self.recorder = recorder
+
+    def request(self, endpoint, method, path, body=None):
+        """Return the decoded JSON response, or None after recording an error"""
+        headers = {'Cookie': self.cookie}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.recorder.add(endpoint, (time.perf_counter() - start) * 1000, 'error')
+            return None
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        text = data.decode('utf-8', 'replace')
+        if any(message in text for message in LOCK_MESSAGES):
+            outcome = 'locked'
+        elif response.status >= 400:
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+        self.recorder.add(endpoint, duration_ms, outcome)
+        if outcome != 'ok':
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    def close(self):
+        self.connection.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the lookup API: create users and synthetic workbooks, start the app '
+        '(or target --url), replay get_sheets -> get_columns -> fetch_results sessions '
+        'from concurrent clients and report throughput, latency percentiles, errors '
+        'and database-lock errors over time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Test a running server instead of starting one; it must share this database')
+        parser.add_argument('--port', type=int, help='Port for the started server (default: a free port)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous client sessions')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to generate load')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between progress reports')
+        parser.add_argument('--users', type=int, default=10, help='Users to log in as')
+        parser.add_argument('--workbooks', type=int, default=3, help='Synthetic workbooks to create')
+        parser.add_argument('--sheets', type=int, default=3, help='Sheets per workbook')
+        parser.add_argument('--rows', type=int, default=2000, help='Rows per sheet')
+        parser.add_argument('--lookups', type=int, default=5, help='fetch_results calls per session, at most')
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help='Zipf exponent for choosing workbooks, sheets and filter values (0 is uniform)')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Seconds a client waits between requests')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds before a request counts as an error')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep-data', action='store_true', help='Keep the load-test users and workbooks afterwards')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['duration'] <= 0:
+            raise CommandError('--concurrency and --duration must be positive')
+
+        users = self.create_users(options['users'])
+        excel_files = self.create_workbooks(options)
+        cookies = [self.session_cookie(user) for user in users]
+
+        server = None
+        try:
+            base_url = options['url']
+            if not base_url:
+                server, base_url = self.start_server(options['port'])
+            self.stdout.write(
+                f'Running {options["concurrency"]} client(s) for {options["duration"]:.0f}s against {base_url}'
+            )
+            recorder = self.run_load(base_url, cookies, excel_files, options)
+            self.report(recorder, options['duration'])
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if not options['keep_data']:
+                self.cleanup()
+
+    # Setup
+
+    def create_users(self, count):
+        User = get_user_model()
+        users = []
+        for position in range(count):
+            user, created = User.objects.get_or_create(username=f'{USER_PREFIX}{position}')
+            if created:
+                user.set_unusable_password()
+                user.save()
+            users.append(user)
+        return users
+
+    def session_cookie(self, user):
+        """A logged-in session for `user`, created directly rather than through the login form"""
+        # Imported here: the session engine is a setting
+        from importlib import import_module
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        store[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.save()
+        return f'{settings.SESSION_COOKIE_NAME}={store.session_key}'
+
+    def create_workbooks(self, options):
+        sheet_config = {
+            'is_enabled': True,
+            'filter_columns': list(FILTER_COLUMNS),
+            'result_columns': ['total', 'product_code'],
+        }
+        excel_files = []
+        for position in range(options['workbooks']):
+            content = synthetic_workbook(options['sheets'], options['rows'], options['seed'] + position)
+            sheet_names = [f'Sheet{sheet + 1}' for sheet in range(options['sheets'])]
+            excel_files.append(ExcelFile.objects.create(
+                name=f'{NAME_PREFIX} {position + 1}',
+                file=ContentFile(content, name=f'load-test-{position + 1}.xlsx'),
+                sheet_names=sheet_names,
+                sheet_config={name: dict(sheet_config) for name in sheet_names},
+            ))
+        self.stdout.write(
+            f'Created {len(excel_files)} workbook(s) of {options["sheets"]} sheet(s) x {options["rows"]} rows'
+        )
+        return excel_files
+
+    def cleanup(self):
+        for excel_file in ExcelFile.objects.filter(name__startswith=NAME_PREFIX):
+            excel_file.delete()
+        get_user_model().objects.filter(username__startswith=USER_PREFIX).delete()
+
+    def start_server(self, port):
+        if port is None:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+        manage = os.path.abspath(sys.argv[0])
+        server = subprocess.Popen(
+            [sys.executable, manage, 'runserver', '--noreload', '--skip-checks', f'127.0.0.1:{port}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        base_url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'The server exited with {server.returncode} before accepting requests')
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    return server, base_url
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('The server did not start within 30 seconds')
+
+    # Load
+
+    def run_load(self, base_url, cookies, excel_files, options):
+        recorder = Recorder()
+        stop = threading.Event()
+        deadline = time.monotonic() + options['duration']
+
+        clients = [
+            threading.Thread(
+                target=self.client,
+                args=(base_url, cookies[position % len(cookies)], excel_files, options, recorder, stop,
+                      random.Random(options['seed'] * 1000 + position)),
+                name=f'load-test-{position}', daemon=True,
+            )
+            for position in range(options['concurrency'])
+        ]
+        start = time.monotonic()
+        for client in clients:
+            client.start()
+
+        self.stdout.write(f'{"elapsed":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7} {"locked":>7}')
+        window_start = start
+        while time.monotonic() < deadline:
+            time.sleep(max(0.0, min(options['interval'], deadline - time.monotonic())))
+            now = time.monotonic()
+            window = summarize(recorder.since(window_start), now - window_start)
+            self.stdout.write(
+                f'{now - start:>7.0f}s {window["throughput"]:>8.1f} {format_ms(window["p50"]):>8} '
+                f'{format_ms(window["p95"]):>8} {format_ms(window["p99"]):>8} '
+                f'{window["errors"]:>7} {window["locked"]:>7}'
+            )
+            window_start = now
+
+        stop.set()
+        for client in clients:
+            client.join(options['timeout'])
+        return recorder
+
+    def client(self, base_url, cookie, excel_files, options, recorder, stop, rng):
+        """Replay sessions until stopped: pick a file, list its sheets, load a sheet's columns, look up"""
+        session = Session(base_url, cookie, recorder, options['timeout'])
+        file_weights = skewed_weights(len(excel_files), options['skew'])
+        pause = options['think_time']
+        try:
+            while not stop.is_set():
+                excel_file = rng.choices(excel_files, file_weights)[0]
+                sheets = session.request(
+                    'get_sheets', 'GET',
+                    reverse('excel_processor:get_sheets') + '?' + urlencode({'file_id': excel_file.id})
+                )
+                if not sheets or not sheets.get('sheets'):
+                    continue
+                sheet_name = rng.choices(sheets['sheets'], skewed_weights(len(sheets['sheets']), options['skew']))[0]
+                stop.wait(pause)
+
+                columns = session.request(
+                    'get_columns', 'GET',
+                    reverse('excel_processor:get_columns') + '?'
+                    + urlencode({'file_id': excel_file.id, 'sheet_name': sheet_name})
+                )
+                if not columns:
+                    continue
+
+                for _ in range(rng.randint(1, max(1, options['lookups']))):
+                    if stop.is_set():
+                        break
+                    stop.wait(pause)
+                    session.request('fetch_results', 'POST', reverse('excel_processor:fetch_results'), {
+                        'file_id': excel_file.id,
+                        'sheet_name': sheet_name,
+                        'filters': self.choose_filters(columns['columns'], options['skew'], rng),
+                    })
+        finally:
+            session.close()
+
+    @staticmethod
+    def choose_filters(columns, skew, rng):
+        """A value for some of the dropdown columns, popular values first"""
+        filters = {}
+        for column, values in columns.items():
+            if values and rng.random() < 0.75:
+                filters[column] = rng.choices(values, skewed_weights(len(values), skew))[0]
+        return filters
+
+    # Report
+
+    def report(self, recorder, duration):
+        samples = recorder.since(0)
+        self.stdout.write('')
+        self.stdout.write(f'{"endpoint":<14} {"requests":>9} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7} {"locked":>7}')
+        endpoints = sorted({endpoint for _, endpoint, _, _ in samples})
+        for endpoint in endpoints + ['all']:
+            selected = [sample for sample in samples if endpoint in ('all', sample[1])]
+            summary = summarize(selected, duration)
+            self.stdout.write(
+                f'{endpoint:<14} {summary["requests"]:>9} {summary["throughput"]:>8.1f} '
+                f'{format_ms(summary["p50"]):>8} {format_ms(summary["p95"]):>8} {format_ms(summary["p99"]):>8} '
+                f'{summary["errors"]:>7} {summary["locked"]:>7}'
+            )
+
+        total = summarize(samples, duration)
+        if total['requests']:
+            rate = total['errors'] / total['requests'] * 100
+            message = f'{total["requests"]} requests, {rate:.1f}% errors, {total["locked"]} database-lock error(s)'
+            self.stdout.write(self.style.SUCCESS(message) if not total['errors'] else self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.WARNING('No requests completed'))
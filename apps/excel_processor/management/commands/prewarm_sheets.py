@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.excel_processor import prewarm
+
+
+class Command(BaseCommand):
+    help = (
+        'Load the most-queried sheets, building their on-disk snapshots and '
+        'SQLite stores so web workers start from them instead of the workbook'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SHEET_PREWARM_DAYS,
+                            help='Rank sheets by queries over this many days')
+        parser.add_argument('--limit', type=int, default=settings.SHEET_PREWARM_LIMIT,
+                            help='Maximum number of sheets to load')
+        parser.add_argument('--time-budget', type=float, default=settings.SHEET_PREWARM_TIME_BUDGET,
+                            help='Stop after this many seconds')
+        parser.add_argument('--memory-budget-mb', type=int,
+                            default=settings.SHEET_PREWARM_MEMORY_BUDGET // (1024 * 1024),
+                            help='Stop once loaded sheets use this much memory')
+
+    def handle(self, *args, **options):
+        report = prewarm.prewarm(
+            days=options['days'],
+            limit=options['limit'],
+            time_budget=options['time_budget'],
+            memory_budget=options['memory_budget_mb'] * 1024 * 1024,
+        )
+        for file_name, sheet_name, status in report:
+            self.stdout.write(f'{file_name} / {sheet_name}: {status}')
+        loaded = sum(1 for _, _, status in report if status == 'loaded')
+        self.stdout.write(self.style.SUCCESS(f'Prewarmed {loaded} sheet(s)'))
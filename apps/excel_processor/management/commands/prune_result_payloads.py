@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apps.excel_processor.models import ResultPayload
+
+
+class Command(BaseCommand):
+    help = 'Delete stored result payloads that no query log refers to any more'
+
+    def handle(self, *args, **options):
+        deleted = ResultPayload.objects.prune()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} unreferenced result payload(s)'))
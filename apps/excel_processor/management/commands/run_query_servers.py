@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.excel_processor import prewarm, query_servers
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the query servers listed in QUERY_SERVERS, one process per address, '
+        'restarting any that exit. With --address, run a single server in the foreground.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', help='Serve on this address only, e.g. 127.0.0.1:7101 or /run/qs.sock')
+        parser.add_argument('--restart-delay', type=float, default=1.0,
+                            help='Seconds to wait before restarting a server that exited')
+
+    def handle(self, *args, **options):
+        if options['address']:
+            self.serve(options['address'])
+            return
+
+        addresses = list(settings.QUERY_SERVERS)
+        if not addresses:
+            raise CommandError('QUERY_SERVERS is empty; nothing to run')
+
+        processes = {}
+        try:
+            while True:
+                for address in addresses:
+                    process = processes.get(address)
+                    if process is not None and process.poll() is None:
+                        continue
+                    if process is not None:
+                        self.stderr.write(f'Query server {address} exited with {process.returncode}; restarting')
+                        time.sleep(options['restart_delay'])
+                    processes[address] = subprocess.Popen(
+                        [sys.executable, os.path.abspath(sys.argv[0]), 'run_query_servers', '--address', address]
+                    )
+                    self.stdout.write(f'Started query server {address} (pid {processes[address].pid})')
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.wait()
+
+    def serve(self, address):
+        if settings.SHEET_PREWARM_ON_STARTUP and address in settings.QUERY_SERVERS:
+            # Warm only this server's shard of the popular sheets
+            prewarm.start_background_prewarm(
+                owns=lambda excel_file_id, sheet_name: query_servers.owns(address, excel_file_id, sheet_name)
+            )
+        self.stdout.write(self.style.SUCCESS(f'Starting query server on {address}'))
+        try:
+            query_servers.serve(address)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0002_remove_excelfile_filter_columns_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='querylog',
+            name='excel_file',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='excel_processor.excelfile'),
+        ),
+        migrations.AlterField(
+            model_name='querylog',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
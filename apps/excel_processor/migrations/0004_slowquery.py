@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0003_query_log_database'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view_name', models.CharField(db_index=True, max_length=255)),
+                ('path', models.CharField(max_length=500)),
+                ('method', models.CharField(max_length=10)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('sheet_name', models.CharField(blank=True, max_length=255)),
+                ('filters', models.JSONField(blank=True, help_text='Filters sent with the request', null=True)),
+                ('rows_scanned', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('cache_hit', models.BooleanField(help_text='Whether the sheet was already loaded', null=True)),
+                ('duration_ms', models.FloatField(db_index=True)),
+                ('phases', models.JSONField(blank=True, default=dict, help_text='Milliseconds spent in each phase')),
+                ('sampled', models.BooleanField(default=False, help_text='Recorded by sampling rather than for being slow')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('excel_file', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='excel_processor.excelfile')),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Slow Query',
+                'verbose_name_plural': 'Slow Queries',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
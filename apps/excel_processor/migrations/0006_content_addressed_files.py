@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:42
+
+import apps.excel_processor.content_store
+import apps.excel_processor.models
+import django.core.validators
+from django.db import migrations, models
+
+from apps.excel_processor.content_store import content_hash
+
+
+def hash_existing_files(apps, schema_editor):
+    """Hash files uploaded before content addressing; they keep their current names"""
+    ExcelFile = apps.get_model('excel_processor', 'ExcelFile')
+    for excel_file in ExcelFile.objects.using(schema_editor.connection.alias).exclude(file=''):
+        try:
+            with excel_file.file.open('rb') as f:
+                excel_file.content_hash = content_hash(f)
+        except OSError:
+            continue  # Missing file; it cannot be shared anyway
+        excel_file.save(update_fields=['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0005_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='excelfile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='SHA-256 of the file; rows with the same hash share the file, snapshots and catalog', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='excelfile',
+            name='file',
+            field=models.FileField(help_text='Upload Excel file (.xlsx or .xls)', storage=apps.excel_processor.content_store.ContentAddressedStorage(), upload_to=apps.excel_processor.models.excel_upload_path, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['xlsx', 'xls'])]),
+        ),
+        migrations.RunPython(hash_existing_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0006_content_addressed_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='querylog',
+            name='query_time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='querylog',
+            index=models.Index(fields=['excel_file', 'query_time'], name='querylog_file_time_idx'),
+        ),
+    ]
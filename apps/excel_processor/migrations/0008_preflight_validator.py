@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:58
+
+import apps.excel_processor.content_store
+import apps.excel_processor.models
+import apps.excel_processor.preflight
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0007_querylog_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='excelfile',
+            name='file',
+            field=models.FileField(help_text='Upload Excel file (.xlsx or .xls)', storage=apps.excel_processor.content_store.ContentAddressedStorage(), upload_to=apps.excel_processor.models.excel_upload_path, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['xlsx', 'xls']), apps.excel_processor.preflight.validate_workbook]),
+        ),
+    ]
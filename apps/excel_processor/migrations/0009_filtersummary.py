@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0008_preflight_validator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('total', models.PositiveBigIntegerField(default=0, help_text='Lookups counted, including evicted ones')),
+                ('counters', models.JSONField(blank=True, default=list, help_text='[key, count, error] per tracked combination')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Filter Summary',
+                'verbose_name_plural': 'Filter Summaries',
+            },
+        ),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:04
+
+import hashlib
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+
+BATCH_SIZE = 1000
+
+
+def result_hash(data):
+    # Frozen copy of models.result_hash
+    text = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compact_results(apps, schema_editor):
+    """Move each row's result_data into a shared ResultPayload, a batch at a time"""
+    QueryLog = apps.get_model('excel_processor', 'QueryLog')
+    ResultPayload = apps.get_model('excel_processor', 'ResultPayload')
+    alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        rows = list(
+            QueryLog.objects.using(alias)
+            .filter(id__gt=last_id, result_data__isnull=False)
+            .order_by('id').only('id', 'result_data')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        hashes = {row.id: result_hash(row.result_data) for row in rows}
+        with transaction.atomic(using=alias):
+            payloads = dict(
+                ResultPayload.objects.using(alias)
+                .filter(content_hash__in=set(hashes.values())).values_list('content_hash', 'id')
+            )
+            new_payloads = {}
+            for row in rows:
+                content_hash = hashes[row.id]
+                if content_hash not in payloads and content_hash not in new_payloads:
+                    new_payloads[content_hash] = ResultPayload(content_hash=content_hash, data=row.result_data)
+            ResultPayload.objects.using(alias).bulk_create(new_payloads.values())
+            payloads.update(
+                ResultPayload.objects.using(alias)
+                .filter(content_hash__in=list(new_payloads)).values_list('content_hash', 'id')
+            )
+            for row in rows:
+                row.result_id = payloads[hashes[row.id]]
+            QueryLog.objects.using(alias).bulk_update(rows, ['result'])
+
+
+def expand_results(apps, schema_editor):
+    """Copy shared payloads back into each row's result_data"""
+    QueryLog = apps.get_model('excel_processor', 'QueryLog')
+    alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        rows = list(
+            QueryLog.objects.using(alias)
+            .filter(id__gt=last_id, result__isnull=False)
+            .select_related('result').order_by('id')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for row in rows:
+            row.result_data = row.result.data
+        with transaction.atomic(using=alias):
+            QueryLog.objects.using(alias).bulk_update(rows, ['result_data'])
+
+
+class Migration(migrations.Migration):
+
+    # Each batch commits on its own, so a large log table is not rewritten in one transaction
+    atomic = False
+
+    dependencies = [
+        ('excel_processor', '0009_filtersummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(editable=False, max_length=64, unique=True)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Result Payload',
+                'verbose_name_plural': 'Result Payloads',
+            },
+        ),
+        migrations.AddField(
+            model_name='querylog',
+            name='result',
+            field=models.ForeignKey(blank=True, help_text='Results returned', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='query_logs', to='excel_processor.resultpayload'),
+        ),
+        # Routed like QueryLog, so it only runs against the log database
+        migrations.RunPython(compact_results, expand_results, hints={'model_name': 'querylog'}),
+        migrations.RemoveField(
+            model_name='querylog',
+            name='result_data',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('excel_processor', '0010_querylog_result_payloads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='excelfile',
+            name='sheet_versions',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='File version at which each sheet last changed'),
+        ),
+        migrations.AddField(
+            model_name='excelfile',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1, editable=False, help_text='Bumped on every content or configuration change'),
+        ),
+    ]
@@ -1,8 +1,17 @@
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import FileExtensionValidator
 from django.utils import timezone
+import hashlib
+import json
 import os
+from contextlib import nullcontext
+from functools import partial
+
+from . import content_store, heavy_hitters, preflight
 
 
 class CustomUser(AbstractUser):
@@ -15,7 +24,9 @@ class CustomUser(AbstractUser):
 
 
 def excel_upload_path(instance, filename):
-    """Generate upload path for excel files"""
+    """Generate upload path for excel files: by content hash, so identical uploads share one file"""
+    if instance.content_hash:
+        return content_store.content_name(instance.content_hash, filename)
     return os.path.join('excel_files', filename)
 
 
@@ -29,9 +40,17 @@ class ExcelFile(models.Model):
 
     file = models.FileField(
         upload_to=excel_upload_path,
-        validators=[FileExtensionValidator(allowed_extensions=['xlsx', 'xls'])],
+        storage=content_store.content_storage,
+        validators=[FileExtensionValidator(allowed_extensions=['xlsx', 'xls']), preflight.validate_workbook],
         help_text="Upload Excel file (.xlsx or .xls)"
     )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        editable=False,
+        help_text="SHA-256 of the file; rows with the same hash share the file, snapshots and catalog"
+    )
 
     uploaded_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -54,6 +73,15 @@ class ExcelFile(models.Model):
         help_text="Configuration for each sheet including filter and result columns"
     )
 
+    # Cache keys carry these (see cache_token), so a bump invalidates every process's entries
+    version = models.PositiveBigIntegerField(default=1, editable=False, help_text="Bumped on every content or configuration change")
+    sheet_versions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text="File version at which each sheet last changed"
+    )
+
     class Meta:
         ordering = ['-uploaded_at']
         verbose_name = 'Excel File'
@@ -73,31 +101,292 @@ class ExcelFile(models.Model):
         """Get number of sheets"""
         return len(self.sheet_names) if self.sheet_names else 0
 
-    def delete(self, *args, **kwargs):
-        """Override delete to remove file from filesystem"""
-        if self.file:
-            try:
-                os.remove(self.file.path)
-            except:
-                pass
-        super().delete(*args, **kwargs)
+    # Fields whose changes invalidate cached sheets and results
+    VERSIONED_FIELDS = ('file', 'content_hash', 'is_active', 'sheet_names', 'sheet_config', 'column_info')
+
+    def save(self, *args, **kwargs):
+        """Override save to hash a newly assigned file and bump the versions of what changed"""
+        if self.file and not self.file._committed:
+            self.content_hash = content_store.content_hash(self.file)
+
+        # Held until the row referencing the blob is committed
+        with self._content_lock(), transaction.atomic():
+            previous = None
+            if self.pk:
+                rows = ExcelFile.objects.filter(pk=self.pk)
+                # A write first takes the row's lock (SQLite's write lock), so
+                # the row is read as the last save left it and any sheet this
+                # one reverts is bumped
+                rows.update(version=F('version'))
+                previous = rows.values(*self.VERSIONED_FIELDS).first()
+            if previous is not None and not kwargs.get('force_insert'):
+                # Versions only move through _bump_versions, so a stale copy cannot write them back
+                update_fields = kwargs.get('update_fields')
+                if update_fields is None:
+                    update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+                kwargs['update_fields'] = [name for name in update_fields if name not in ('version', 'sheet_versions')]
+
+            super().save(*args, **kwargs)
+            if previous is not None:
+                self._bump_versions(previous)
+
+        replaced = previous and (previous['file'], previous['content_hash'])
+        if replaced and replaced[0] != self.file.name:
+            transaction.on_commit(partial(release_file_content, self.file.storage, *replaced))
+
+    def _content_lock(self):
+        if not (self.file and self.content_hash):
+            return nullcontext()
+        return content_store.content_lock(self.file.storage, self.content_hash)
+
+    def _changed_sheets(self, previous):
+        sheet_names = set(self.sheet_names or []) | set(previous['sheet_names'] or [])
+        if previous['file'] != self.file.name or previous['content_hash'] != self.content_hash:
+            return sheet_names
+        changed = set(self.sheet_names or []) ^ set(previous['sheet_names'] or [])
+        for field in ('sheet_config', 'column_info'):
+            current, before = getattr(self, field) or {}, previous[field] or {}
+            changed |= {sheet for sheet in set(current) | set(before) if current.get(sheet) != before.get(sheet)}
+        return changed
+
+    def _bump_versions(self, previous):
+        """Atomically bump the file version, stamping it on every changed sheet"""
+        changed = self._changed_sheets(previous)
+        if not changed and previous['is_active'] == self.is_active:
+            return
+        rows = ExcelFile.objects.filter(pk=self.pk)
+        # The increment takes the row's write lock, so concurrent saves get distinct versions
+        rows.update(version=F('version') + 1)
+        version, sheet_versions = rows.values_list('version', 'sheet_versions').get()
+        if changed:
+            sheet_versions = dict(sheet_versions or {}, **{sheet: version for sheet in changed})
+            rows.update(sheet_versions=sheet_versions)
+        self.version, self.sheet_versions = version, sheet_versions
+
+    def sheet_version(self, sheet_name):
+        """Version at which a sheet's content or configuration last changed"""
+        return (self.sheet_versions or {}).get(sheet_name, 0)
+
+    def cache_token(self, sheet_name):
+        """Identifies a sheet's current content and configuration in cache keys"""
+        return f'{self.pk}:{sheet_name}:{self.sheet_version(sheet_name)}:{self.content_hash}'
+
+
+_UNSET = object()
+
+
+def result_hash(data):
+    """SHA-256 of a result payload's canonical JSON"""
+    text = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultPayloadManager(models.Manager):
+    def intern(self, data):
+        """Return the stored payload for `data`, storing it on first use"""
+        payload, _ = self.get_or_create(content_hash=result_hash(data), defaults={'data': data})
+        return payload
+
+    def prune(self, ids=None):
+        """Delete payloads no QueryLog refers to, among `ids` if given; returns the count"""
+        unreferenced = self.filter(query_logs__isnull=True)
+        if ids is not None:
+            unreferenced = unreferenced.filter(id__in=ids)
+        # Deleted by id: a delete() with a join is not supported everywhere
+        deleted, _ = self.filter(id__in=list(unreferenced.values_list('id', flat=True))).delete()
+        return deleted
+
+
+class ResultPayload(models.Model):
+    """A distinct result returned by lookups, stored once and shared by every QueryLog returning it"""
+
+    content_hash = models.CharField(max_length=64, unique=True, editable=False)
+    data = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ResultPayloadManager()
+
+    class Meta:
+        verbose_name = 'Result Payload'
+        verbose_name_plural = 'Result Payloads'
+
+    def __str__(self):
+        return self.content_hash[:12]
 
 
 class QueryLog(models.Model):
     """Log user queries for analytics"""
 
-    user = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True)
-    excel_file = models.ForeignKey(ExcelFile, on_delete=models.CASCADE)
+    # Query logs live in their own database (see routers.py), so these
+    # relations have no database constraint and deletes are handled below
+    user = models.ForeignKey(CustomUser, on_delete=models.DO_NOTHING, null=True, db_constraint=False)
+    excel_file = models.ForeignKey(ExcelFile, on_delete=models.DO_NOTHING, db_constraint=False)
     sheet_name = models.CharField(max_length=255)
     filters_applied = models.JSONField(help_text="Filters selected by user")
     result_found = models.BooleanField(default=False)
-    result_data = models.JSONField(blank=True, null=True, help_text="Results returned")
-    query_time = models.DateTimeField(auto_now_add=True)
+    # Both in the log database, so this one is a real foreign key
+    result = models.ForeignKey(
+        ResultPayload, on_delete=models.PROTECT, null=True, blank=True,
+        related_name='query_logs', help_text="Results returned"
+    )
+    query_time = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
         ordering = ['-query_time']
         verbose_name = 'Query Log'
         verbose_name_plural = 'Query Logs'
+        indexes = [
+            # Admin changelist filtered by file, paged by query_time
+            models.Index(fields=['excel_file', 'query_time'], name='querylog_file_time_idx'),
+        ]
 
     def __str__(self):
         return f"Query on {self.excel_file.name} at {self.query_time.strftime('%Y-%m-%d %H:%M')}"
+
+    @property
+    def result_data(self):
+        """Results returned, resolved from the shared payload"""
+        if self._unsaved_result is not _UNSET:
+            return self._unsaved_result
+        return self.result.data if self.result_id else None
+
+    @result_data.setter
+    def result_data(self, data):
+        # Accepted by QueryLog(...) and objects.create() like a field; stored by save()
+        self._unsaved_result = data
+
+    _unsaved_result = _UNSET
+
+    def save(self, *args, **kwargs):
+        """Override save to store the result payload, shared with identical results"""
+        if self._unsaved_result is _UNSET:
+            return super().save(*args, **kwargs)
+        db = kwargs.get('using') or router.db_for_write(QueryLog, instance=self)
+        for attempt in range(2):
+            try:
+                with transaction.atomic(using=db):
+                    data = self._unsaved_result
+                    self.result = None if data is None else ResultPayload.objects.db_manager(db).intern(data)
+                    super().save(*args, **kwargs)
+                break
+            except IntegrityError:
+                # The payload was pruned between interning and saving; intern it again
+                if attempt:
+                    raise
+        self._unsaved_result = _UNSET
+
+
+class SlowQuery(models.Model):
+    """A request that exceeded the latency threshold, or was sampled, with its trace"""
+
+    # Stored in the log database with QueryLog, so no database constraints
+    user = models.ForeignKey(CustomUser, on_delete=models.DO_NOTHING, null=True, db_constraint=False)
+    excel_file = models.ForeignKey(ExcelFile, on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False)
+    view_name = models.CharField(max_length=255, db_index=True)
+    path = models.CharField(max_length=500)
+    method = models.CharField(max_length=10)
+    status_code = models.PositiveSmallIntegerField()
+    sheet_name = models.CharField(max_length=255, blank=True)
+    filters = models.JSONField(blank=True, null=True, help_text="Filters sent with the request")
+    rows_scanned = models.PositiveBigIntegerField(null=True, blank=True)
+    cache_hit = models.BooleanField(null=True, help_text="Whether the sheet was already loaded")
+    duration_ms = models.FloatField(db_index=True)
+    phases = models.JSONField(default=dict, blank=True, help_text="Milliseconds spent in each phase")
+    sampled = models.BooleanField(default=False, help_text="Recorded by sampling rather than for being slow")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Slow Query'
+        verbose_name_plural = 'Slow Queries'
+
+    def __str__(self):
+        return f"{self.view_name} took {self.duration_ms:.0f} ms at {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+
+
+class RequestProfile(models.Model):
+    """A cProfile run of one request, requested by a staff member"""
+
+    request_id = models.UUIDField(unique=True, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.DO_NOTHING, null=True, db_constraint=False)
+    path = models.CharField(max_length=500)
+    method = models.CharField(max_length=10)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Request Profile'
+        verbose_name_plural = 'Request Profiles'
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+    def delete(self, *args, **kwargs):
+        """Override delete to remove the profile file"""
+        from .profiling import profile_path
+        try:
+            os.remove(profile_path(self.request_id))
+        except OSError:
+            pass
+        super().delete(*args, **kwargs)
+
+
+class FilterSummary(models.Model):
+    """Persisted top-K counts of filter combinations, merged from every worker process"""
+
+    name = models.CharField(max_length=50, unique=True)
+    total = models.PositiveBigIntegerField(default=0, help_text="Lookups counted, including evicted ones")
+    counters = models.JSONField(default=list, blank=True, help_text="[key, count, error] per tracked combination")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Filter Summary'
+        verbose_name_plural = 'Filter Summaries'
+
+    def __str__(self):
+        return f"{self.name} ({len(self.counters)} combinations of {self.total} lookups)"
+
+
+@receiver(pre_delete, sender=ExcelFile)
+def delete_file_query_logs(sender, instance, **kwargs):
+    """Cascade by hand: the logs are in another database"""
+    logs = QueryLog.objects.filter(excel_file_id=instance.pk)
+    payload_ids = list(logs.exclude(result=None).values_list('result_id', flat=True).distinct())
+    logs.delete()
+    # Payloads shared with other files' logs stay
+    ResultPayload.objects.prune(payload_ids)
+    SlowQuery.objects.filter(excel_file_id=instance.pk).delete()
+    heavy_hitters.forget_file(instance.pk)
+
+
+def release_file_content(storage, name, content_hash):
+    """Remove a stored file, and the snapshots parsed from it, once no row references it"""
+    if not name:
+        return
+    lock = content_store.content_lock(storage, content_hash) if content_hash else nullcontext()
+    with lock:
+        if ExcelFile.objects.filter(file=name).exists():
+            return
+        storage.delete(name)
+        if content_hash:
+            from . import sheet_cache, snapshots
+            sheet_cache.discard(content_hash)
+            snapshots.remove(content_hash)
+
+
+@receiver(post_delete, sender=ExcelFile)
+def release_file(sender, instance, **kwargs):
+    # A signal rather than delete(), so queryset and admin bulk deletes count too.
+    # After commit, so the content lock is never awaited while holding the database
+    transaction.on_commit(partial(
+        release_file_content, instance.file.storage, instance.file.name, instance.content_hash
+    ))
+
+
+@receiver(pre_delete, sender=CustomUser)
+def detach_user_query_logs(sender, instance, **kwargs):
+    QueryLog.objects.filter(user_id=instance.pk).update(user=None)
+    SlowQuery.objects.filter(user_id=instance.pk).update(user=None)
+    RequestProfile.objects.filter(user_id=instance.pk).update(user=None)
@@ -0,0 +1,58 @@
+"""Canonical string form of cell and filter values, used for every comparison
+
+Ingest, dropdown generation and lookups all go through normalize_value, so
+a value offered in a dropdown always matches the cell it came from.
+"""
+import datetime
+import math
+import re
+
+import numpy as np
+
+
+# Text such as "100.0" is compared as "100", the same as the number 100.0
+_INTEGRAL_DECIMAL = re.compile(r'^(-?\d+)\.0+$')
+
+
+def normalize_value(value):
+    """Return the comparison key for a cell or filter value, or None for blanks"""
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        match = _INTEGRAL_DECIMAL.match(value)
+        return match.group(1) if match else value
+
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+
+    if isinstance(value, datetime.datetime):
+        if value != value:  # NaT
+            return None
+        if value.time() == datetime.time():
+            return value.date().isoformat()
+        return value.isoformat(sep=' ')
+
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+
+    return normalize_value(str(value))
+
+
+def normalize_array(values):
+    """Normalize a column of cell values into an object array of keys"""
+    return np.fromiter((normalize_value(value) for value in values), dtype=object, count=len(values))
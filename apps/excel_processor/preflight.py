@@ -0,0 +1,142 @@
+"""Bounded-cost checks of an uploaded workbook, run before anything parses its cells
+
+Only the zip directory, workbook.xml and the head of each worksheet (for
+its <dimension> record) are read, so a workbook declaring a million rows
+or columns, a huge shared-strings table or a zip bomb is turned away in
+milliseconds instead of taking a worker down in pd.read_excel. Workbooks
+within the limits but too costly to parse during the upload request are
+cataloged out of band (see ingest.catalog_out_of_band).
+"""
+import zipfile
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from . import workbook_info
+
+
+# Rough costs behind the estimates
+_XML_BYTES_PER_CELL = 20  # e.g. <c r="B2" t="s"><v>17</v></c>
+_MEMORY_PER_CELL = 100  # An object array slot plus the parsed value
+_MEMORY_PER_SHARED_STRING_BYTE = 2
+
+# Parts smaller than this are too small for their compression ratio to matter
+_RATIO_MIN_BYTES = 1024 * 1024
+
+
+class PreflightError(ValueError):
+    """Raised for a workbook over one of the preflight limits"""
+
+
+class Inspection:
+    """What the zip directory says about a workbook, and what parsing it would cost"""
+
+    def __init__(self, sheets, uncompressed_size, shared_strings_size):
+        # {sheet name: {'rows': n or None, 'columns': n or None, 'cells': estimate}}
+        self.sheets = sheets
+        self.uncompressed_size = uncompressed_size
+        self.shared_strings_size = shared_strings_size
+
+    @property
+    def sheet_names(self):
+        return list(self.sheets)
+
+    @property
+    def estimated_cells(self):
+        return sum(sheet['cells'] for sheet in self.sheets.values())
+
+    @property
+    def estimated_memory(self):
+        """Bytes pd.read_excel would need to parse every sheet"""
+        return (
+            self.estimated_cells * _MEMORY_PER_CELL
+            + self.shared_strings_size * _MEMORY_PER_SHARED_STRING_BYTE
+        )
+
+    @property
+    def parse_inline(self):
+        """Whether the workbook is cheap enough to catalog during the upload request"""
+        return self.estimated_memory <= settings.PREFLIGHT_INLINE_MEMORY_BUDGET
+
+
+def _check_archive(entries):
+    uncompressed_size = sum(entry.file_size for entry in entries)
+    if uncompressed_size > settings.PREFLIGHT_MAX_UNCOMPRESSED_BYTES:
+        raise PreflightError(
+            f'Workbook expands to {uncompressed_size // (1024 * 1024)} MB, '
+            f'over the {settings.PREFLIGHT_MAX_UNCOMPRESSED_BYTES // (1024 * 1024)} MB limit'
+        )
+    for entry in entries:
+        if entry.file_size < _RATIO_MIN_BYTES:
+            continue
+        if entry.file_size > max(entry.compress_size, 1) * settings.PREFLIGHT_MAX_COMPRESSION_RATIO:
+            raise PreflightError(
+                f'{entry.filename} is compressed more than '
+                f'{settings.PREFLIGHT_MAX_COMPRESSION_RATIO}:1; refusing to expand it'
+            )
+    return uncompressed_size
+
+
+def _inspect_archive(archive):
+    entries = archive.infolist()
+    # Sizes come from the directory, so this is checked before any part is read
+    uncompressed_size = _check_archive(entries)
+    sizes = {entry.filename: entry.file_size for entry in entries}
+
+    shared_strings_size = sizes.get('xl/sharedStrings.xml', 0)
+    if shared_strings_size > settings.PREFLIGHT_MAX_SHARED_STRINGS_BYTES:
+        raise PreflightError(
+            f'Shared strings table is {shared_strings_size // (1024 * 1024)} MB, over the '
+            f'{settings.PREFLIGHT_MAX_SHARED_STRINGS_BYTES // (1024 * 1024)} MB limit'
+        )
+
+    sheets = {}
+    for name, part in workbook_info.sheet_parts(archive).items():
+        if part not in sizes:
+            continue
+        dimension = workbook_info.read_dimension(archive, part)
+        rows, columns = dimension or (None, None)
+        if rows is not None and rows > settings.PREFLIGHT_MAX_ROWS:
+            raise PreflightError(f'Sheet {name} declares {rows} rows, over the {settings.PREFLIGHT_MAX_ROWS} limit')
+        if columns is not None and columns > settings.PREFLIGHT_MAX_COLUMNS:
+            raise PreflightError(
+                f'Sheet {name} declares {columns} columns, over the {settings.PREFLIGHT_MAX_COLUMNS} limit'
+            )
+        # Readers pad every row to the declared width, so declared cells are real cost
+        cells = rows * columns if dimension else sizes[part] // _XML_BYTES_PER_CELL
+        sheets[name] = {'rows': rows, 'columns': columns, 'cells': cells}
+
+    inspection = Inspection(sheets, uncompressed_size, shared_strings_size)
+    if inspection.estimated_cells > settings.PREFLIGHT_MAX_CELLS:
+        raise PreflightError(
+            f'Workbook holds about {inspection.estimated_cells} cells, over the {settings.PREFLIGHT_MAX_CELLS} limit'
+        )
+    return inspection
+
+
+def inspect(file):
+    """Inspect an .xlsx path or file object and enforce the preflight limits
+
+    Returns an Inspection, or None for files that are not zips (legacy
+    .xls, bounded by its format and MAX_UPLOAD_SIZE). Raises
+    PreflightError for a workbook over a limit or not readable as .xlsx.
+    """
+    try:
+        if not zipfile.is_zipfile(file):
+            return None
+        with zipfile.ZipFile(file) as archive:
+            return _inspect_archive(archive)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise PreflightError(f'Not a readable .xlsx workbook: {e}')
+    finally:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+
+def validate_workbook(value):
+    """Model field validator running the preflight checks on an uploaded file"""
+    try:
+        inspect(value.file if hasattr(value, 'file') else value)
+    except PreflightError as e:
+        raise ValidationError(str(e))
@@ -0,0 +1,112 @@
+"""Preload the most-queried sheets so the first users after a deploy don't pay for it"""
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count
+from django.utils import timezone
+
+from . import sheet_cache
+from .models import ExcelFile, QueryLog
+
+
+logger = logging.getLogger(__name__)
+
+
+def popular_sheets(days, limit):
+    """Return [(excel_file_id, sheet_name, query_count)] for the busiest sheets"""
+    since = timezone.now() - timedelta(days=days)
+    ranked = (
+        QueryLog.objects.filter(query_time__gte=since)
+        .values('excel_file_id', 'sheet_name')
+        .annotate(query_count=Count('id'))
+        .order_by('-query_count')[:limit]
+    )
+    return [(row['excel_file_id'], row['sheet_name'], row['query_count']) for row in ranked]
+
+
+def prewarm(days=None, limit=None, time_budget=None, memory_budget=None, owns=None):
+    """Load the most popular active sheets into the sheet cache
+
+    Stops at whichever budget runs out first: `time_budget` seconds or
+    `memory_budget` bytes of loaded sheet data. Returns a list of
+    (file name, sheet name, status) tuples describing what happened.
+    With `owns`, only sheets for which owns(excel_file_id, sheet_name) is
+    true are loaded, e.g. a query server's shard.
+    """
+    days = settings.SHEET_PREWARM_DAYS if days is None else days
+    limit = settings.SHEET_PREWARM_LIMIT if limit is None else limit
+    time_budget = settings.SHEET_PREWARM_TIME_BUDGET if time_budget is None else time_budget
+    memory_budget = settings.SHEET_PREWARM_MEMORY_BUDGET if memory_budget is None else memory_budget
+
+    # Loading more than the cache holds would only evict earlier loads
+    limit = min(limit, settings.SHEET_CACHE_MAX_SHEETS)
+    deadline = time.monotonic() + time_budget
+    memory_used = 0
+    report = []
+
+    candidates = popular_sheets(days, limit)
+    if owns is not None:
+        candidates = [candidate for candidate in candidates if owns(candidate[0], candidate[1])]
+    excel_files = ExcelFile.objects.in_bulk([excel_file_id for excel_file_id, _, _ in candidates])
+
+    for excel_file_id, sheet_name, _ in candidates:
+        excel_file = excel_files.get(excel_file_id)
+        if excel_file is None or not excel_file.is_active or not excel_file.file:
+            continue
+        sheet_config = (excel_file.sheet_config or {}).get(sheet_name, {})
+        if not sheet_config.get('is_enabled', True) or sheet_name not in (excel_file.sheet_names or []):
+            continue
+
+        if time.monotonic() >= deadline:
+            report.append((excel_file.name, sheet_name, 'skipped: time budget reached'))
+            break
+        if memory_used >= memory_budget:
+            report.append((excel_file.name, sheet_name, 'skipped: memory budget reached'))
+            break
+
+        try:
+            sheet = sheet_cache.get_sheet(excel_file, sheet_name)
+        except Exception as e:
+            report.append((excel_file.name, sheet_name, f'failed: {e}'))
+            continue
+        memory_used += sheet.memory_estimate()
+        report.append((excel_file.name, sheet_name, 'loaded'))
+
+    return report
+
+
+def _run_in_background(owns=None):
+    time.sleep(settings.SHEET_PREWARM_DELAY)
+    try:
+        for file_name, sheet_name, status in prewarm(owns=owns):
+            logger.info('Prewarm %s / %s: %s', file_name, sheet_name, status)
+    except Exception:
+        logger.exception('Sheet prewarm failed')
+    finally:
+        close_old_connections()
+
+
+def _is_serving_process():
+    """Only web workers prewarm, not migrate, shell or the runserver reloader parent"""
+    if os.path.basename(sys.argv[0]) != 'manage.py':
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return os.environ.get('RUN_MAIN') == 'true'
+
+
+def start_background_prewarm(owns=None):
+    """Prewarm on a daemon thread so the worker starts serving immediately
+
+    Web workers skip this when QUERY_SERVERS hold the sheets; each query
+    server prewarms its own shard by passing `owns`.
+    """
+    if owns is None and (settings.QUERY_SERVERS or not _is_serving_process()):
+        return
+    threading.Thread(target=_run_in_background, args=(owns,), name='sheet-prewarm', daemon=True).start()
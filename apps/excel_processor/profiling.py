@@ -0,0 +1,89 @@
+"""Profile single requests on demand, for staff only
+
+Add `?_profile=1` to a URL, or send an `X-Profile: 1` header, while logged
+in as staff: the request runs under cProfile and the profile is saved
+under PROFILE_DIR with a RequestProfile row pointing at it. The response
+carries the profile's id in an `X-Profile-Id` header; the admin panel
+lists recent profiles and shows their top functions or downloads the
+raw .prof file for snakeviz/pstats. Other requests only pay for the
+check of the query string and header.
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+import uuid
+
+from django.conf import settings
+
+
+PROFILE_SORT_KEYS = {
+    'cumulative': pstats.SortKey.CUMULATIVE,
+    'tottime': pstats.SortKey.TIME,
+    'calls': pstats.SortKey.CALLS,
+}
+
+
+def profile_path(request_id):
+    return os.path.join(str(settings.PROFILE_DIR), f'{request_id}.prof')
+
+
+def wants_profile(request):
+    if not settings.PROFILING_ENABLED:
+        return False
+    if '_profile' not in request.GET and request.META.get('HTTP_X_PROFILE') != '1':
+        return False
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_authenticated and user.is_staff
+
+
+def top_functions(path, sort='cumulative', limit=None):
+    """Return the profile's most expensive functions as dicts, most expensive first"""
+    stats = pstats.Stats(path, stream=io.StringIO())
+    stats.sort_stats(PROFILE_SORT_KEYS.get(sort, pstats.SortKey.CUMULATIVE))
+    functions = []
+    for function in stats.fcn_list[:limit or settings.PROFILE_TOP_FUNCTIONS]:
+        primitive_calls, calls, total_time, cumulative_time, _ = stats.stats[function]
+        filename, line, name = function
+        functions.append({
+            'function': name,
+            'location': f'{filename}:{line}' if line else filename,
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_time': total_time,
+            'cumulative_time': cumulative_time,
+        })
+    return functions
+
+
+class ProfilingMiddleware:
+    """Must come after AuthenticationMiddleware, which provides request.user"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not wants_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        response = profiler.runcall(self.get_response, request)
+        duration = (time.perf_counter() - started) * 1000
+
+        from .models import RequestProfile
+
+        request_id = uuid.uuid4()
+        os.makedirs(str(settings.PROFILE_DIR), exist_ok=True)
+        profiler.dump_stats(profile_path(request_id))
+        RequestProfile.objects.create(
+            request_id=request_id,
+            user_id=request.user.pk,
+            path=request.get_full_path()[:500],
+            method=request.method,
+            status_code=response.status_code,
+            duration_ms=duration,
+        )
+        response['X-Profile-Id'] = str(request_id)
+        return response
@@ -0,0 +1,333 @@
+"""Filter predicates parsed from request payloads and evaluated against loaded sheets
+
+A filter payload maps column names to one of:
+
+    "value"                       exact match
+    ["value", ...]                any of the values
+    {"in": ["value", ...]}        any of the values
+    {"min": 100, "max": 500}      numeric range, either bound optional, inclusive
+
+Predicates are evaluated most selective first, using exact row counts
+from each column's key index; each later predicate only looks at the
+rows that survived the earlier ones. Matching rows can also
+be grouped and aggregated with `aggregate`.
+"""
+import math
+
+import numpy as np
+
+from . import tracing
+from .normalize import normalize_value
+
+
+AGGREGATE_FUNCTIONS = ('sum', 'count', 'min', 'max', 'mean')
+
+
+class QueryError(ValueError):
+    """Raised for a query payload that cannot be evaluated"""
+
+
+class FilterError(QueryError):
+    """Raised for a filter payload that cannot be evaluated"""
+
+
+class Equals:
+    def __init__(self, column, value):
+        self.column = column
+        self.key = normalize_value(value)
+
+    def estimate(self, sheet):
+        # Exact: the key index knows how many rows hold each key
+        return sheet.key_index(self.column).count([self.key])
+
+    def rows(self, sheet):
+        return sheet.key_index(self.column).rows([self.key])
+
+    def mask(self, sheet, rows):
+        return sheet.keys[self.column][rows] == self.key
+
+    def matches(self, key):
+        return key == self.key
+
+
+class In:
+    def __init__(self, column, values):
+        self.column = column
+        self.keys = []
+        for value in values:
+            key = normalize_value(value)
+            if key is not None and key not in self.keys:
+                self.keys.append(key)
+
+    def estimate(self, sheet):
+        return sheet.key_index(self.column).count(self.keys)
+
+    def rows(self, sheet):
+        return sheet.key_index(self.column).rows(self.keys)
+
+    def mask(self, sheet, rows):
+        keys = sheet.keys[self.column][rows]
+        mask = np.zeros(len(keys), dtype=bool)
+        for key in self.keys:
+            mask |= keys == key
+        return mask
+
+    def matches(self, key):
+        return key in self.keys
+
+
+class Range:
+    def __init__(self, column, low, high):
+        self.column = column
+        self.low = low
+        self.high = high
+
+    def estimate(self, sheet):
+        # Exact: the sorted index gives the number of rows in range
+        start, stop = sheet.numeric_index(self.column).bounds(self.low, self.high)
+        return stop - start
+
+    def rows(self, sheet):
+        return sheet.numeric_index(self.column).rows_between(self.low, self.high)
+
+    def mask(self, sheet, rows):
+        values = sheet.numeric_index(self.column).values[rows]
+        mask = ~np.isnan(values)
+        if self.low is not None:
+            mask &= values >= self.low
+        if self.high is not None:
+            mask &= values <= self.high
+        return mask
+
+    def matches(self, key):
+        if key is None:
+            return False
+        try:
+            value = float(key)
+        except ValueError:
+            return False
+        return (self.low is None or value >= self.low) and (self.high is None or value <= self.high)
+
+
+def _bound(spec, name):
+    value = spec.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise FilterError(f'"{name}" must be a number')
+    if math.isnan(value):
+        raise FilterError(f'"{name}" must be a number')
+    return value
+
+
+def parse_predicate(column, spec):
+    """Build the predicate for one column's filter, or None if it is blank"""
+    if isinstance(spec, dict):
+        unknown = set(spec) - {'in', 'min', 'max'}
+        if unknown:
+            raise FilterError(f'Unknown filter operator for {column}: {", ".join(sorted(unknown))}')
+        if 'in' in spec:
+            if set(spec) != {'in'}:
+                raise FilterError(f'Filter for {column} cannot combine "in" with a range')
+            spec = spec['in']
+            if not isinstance(spec, list):
+                raise FilterError(f'"in" filter for {column} must be a list')
+        else:
+            low, high = _bound(spec, 'min'), _bound(spec, 'max')
+            if low is None and high is None:
+                return None
+            if low is not None and high is not None and low > high:
+                raise FilterError(f'Range for {column} has min greater than max')
+            return Range(column, low, high)
+
+    if isinstance(spec, list):
+        predicate = In(column, spec)
+        return predicate if predicate.keys else None
+
+    predicate = Equals(column, spec)
+    return predicate if predicate.key is not None else None
+
+
+def parse_filters(filters, columns):
+    """Parse a filter payload into predicates for the columns in `columns`
+
+    Filters on other columns are skipped, as are blank ones. Returns the
+    predicates and the subset of the payload they came from.
+    """
+    if not isinstance(filters, dict):
+        raise FilterError('Filters must be an object')
+
+    predicates = []
+    applied = {}
+    for column, spec in filters.items():
+        if column not in columns:
+            continue
+        predicate = parse_predicate(column, spec)
+        if predicate is not None:
+            predicates.append(predicate)
+            applied[column] = spec
+    return predicates, applied
+
+
+def matching_rows(sheet, predicates):
+    """Return the positions of rows matching every predicate, in sheet order"""
+    row_count = sheet.row_count or 0
+    if not predicates:
+        return np.arange(row_count)
+
+    predicates = sorted(predicates, key=lambda predicate: predicate.estimate(sheet))
+
+    # The most selective predicate reads its rows straight from its index
+    first, rest = predicates[0], predicates[1:]
+    rows = first.rows(sheet)
+    scanned = len(rows)
+
+    for predicate in rest:
+        if not len(rows):
+            break
+        scanned += len(rows)
+        rows = rows[predicate.mask(sheet, rows)]
+    tracing.add_rows_scanned(scanned)
+    return rows
+
+
+def json_value(value):
+    """Convert a cell value to a JSON-serializable Python value"""
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    if value != value:  # NaT
+        return None
+    return str(value)
+
+
+def row_results(sheet, row, result_columns):
+    """Return the result columns of one row, with 'total' first as a float"""
+    return result_values(sheet.row_values(row, result_columns), result_columns)
+
+
+def result_values(values, result_columns):
+    """Convert {column: raw cell value} into the result payload, 'total' first"""
+    results = {}
+
+    if 'total' in result_columns:
+        total = values.get('total')
+        try:
+            total = float(total)
+        except (TypeError, ValueError):
+            total = None
+        results['total'] = None if total is None or math.isnan(total) else total
+
+    for column in result_columns:
+        if column.lower() != 'total':  # Skip total as it's already added
+            results[column] = json_value(values.get(column))
+    return results
+
+
+def parse_aggregates(aggregates, columns):
+    """Validate an aggregate spec of {column: [function, ...]} against `columns`"""
+    if not isinstance(aggregates, dict) or not aggregates:
+        raise QueryError('Aggregates must be a non-empty object')
+
+    parsed = {}
+    for column, functions in aggregates.items():
+        if column not in columns:
+            raise QueryError(f'Cannot aggregate {column}: not a result column')
+        if isinstance(functions, str):
+            functions = [functions]
+        if not isinstance(functions, list) or not functions:
+            raise QueryError(f'Aggregates for {column} must be a list of functions')
+        unknown = [function for function in functions if function not in AGGREGATE_FUNCTIONS]
+        if unknown:
+            raise QueryError(f'Unknown aggregate function: {", ".join(map(str, unknown))}')
+        parsed[column] = list(dict.fromkeys(functions))
+    return parsed
+
+
+def _group_codes(sheet, rows, group_by):
+    """Return (labels, inverse): distinct key tuples and each row's group number"""
+    if not group_by:
+        return [()], np.zeros(len(rows), dtype=np.intp)
+
+    codes = []
+    uniques = []
+    for column in group_by:
+        keys = sheet.keys[column][rows]
+        # Normalized keys are never empty, so '' can stand in for blanks
+        keys = np.where(keys == None, '', keys).astype(str)  # noqa: E711
+        unique, inverse = np.unique(keys, return_inverse=True)
+        uniques.append(unique)
+        codes.append(inverse.reshape(-1))
+
+    combined, inverse = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    labels = [
+        tuple(str(uniques[i][code]) or None for i, code in enumerate(group))
+        for group in combined.tolist()
+    ]
+    return labels, inverse.reshape(-1)
+
+
+def aggregate(sheet, rows, group_by, aggregates):
+    """Group `rows` by the `group_by` columns and aggregate numeric columns
+
+    Returns one dict per group, ordered by group key, with the number of
+    rows in the group and the requested functions per column. Cells that
+    are blank or not numeric are skipped, as in SQL aggregates.
+    """
+    if not len(rows):
+        return []
+
+    labels, inverse = _group_codes(sheet, rows, group_by)
+    group_count = len(labels)
+    row_counts = np.bincount(inverse, minlength=group_count)
+
+    values = {}
+    for column, functions in aggregates.items():
+        numbers = sheet.numeric_index(column).values[rows]
+        present = ~np.isnan(numbers)
+        counts = np.bincount(inverse, weights=present, minlength=group_count)
+        sums = np.bincount(inverse, weights=np.where(present, numbers, 0.0), minlength=group_count)
+
+        results = {}
+        for function in functions:
+            if function == 'count':
+                results[function] = counts.astype(int)
+            elif function == 'sum':
+                results[function] = np.where(counts > 0, sums, np.nan)
+            elif function == 'mean':
+                results[function] = np.divide(sums, counts, out=np.full(group_count, np.nan), where=counts > 0)
+            else:
+                # fmin/fmax ignore the NaN starting values and blank cells
+                extreme = np.full(group_count, np.nan)
+                (np.fmin if function == 'min' else np.fmax).at(extreme, inverse, numbers)
+                results[function] = extreme
+        values[column] = results
+
+    groups = []
+    for position, label in enumerate(labels):
+        groups.append({
+            'group': dict(zip(group_by, label)),
+            'rows': int(row_counts[position]),
+            'values': {
+                column: {
+                    function: _number(result[position])
+                    for function, result in results.items()
+                }
+                for column, results in values.items()
+            },
+        })
+    return groups
+
+
+def _number(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    value = float(value)
+    return None if math.isnan(value) else value
@@ -0,0 +1,242 @@
+"""Optional tier of long-lived query server processes, each owning a shard of sheets
+
+With QUERY_SERVERS set to a list of addresses ("host:port" or a Unix
+socket path), views forward sheet operations to the server that owns
+the (file, sheet) pair instead of loading the sheet themselves. Owners
+are assigned on a consistent hash ring, so each sheet is held in memory
+once per host and adding or removing a server only moves the sheets
+next to it on the ring. A server that cannot be reached is skipped for
+QUERY_SERVER_RETRY_AFTER seconds and its sheets go to the next server
+on the ring; with none reachable, operations run in the web worker.
+
+Servers are started with `manage.py run_query_servers`. Messages are
+pickled over multiprocessing connections authenticated with
+QUERY_SERVER_AUTHKEY.
+"""
+import bisect
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import query, shared_cache, sheet_queries, tracing
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_down = {}
+_down_lock = threading.Lock()
+
+
+class QueryServerError(RuntimeError):
+    """Raised for an operation that failed inside a query server"""
+
+
+class QueryServerTimeout(TimeoutError):
+    """Raised when a query server does not answer within QUERY_SERVER_TIMEOUT"""
+
+
+# Exceptions re-raised in the web worker as themselves, so views answer 400
+_REQUEST_ERRORS = {'FilterError': query.FilterError, 'QueryError': query.QueryError}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes, with virtual nodes for balance"""
+
+    def __init__(self, nodes, replicas=None):
+        replicas = replicas or settings.QUERY_SERVER_RING_REPLICAS
+        points = sorted(
+            (_hash(f'{node}#{replica}'), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def nodes_for(self, key):
+        """Yield every node once, starting with the key's owner, in ring order"""
+        if not self._nodes:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for position in range(len(self._nodes)):
+            node = self._nodes[(start + position) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+    def owner(self, key):
+        return next(self.nodes_for(key), None)
+
+
+@functools.lru_cache(maxsize=8)
+def ring(addresses):
+    return HashRing(addresses)
+
+
+def sheet_key(excel_file_id, sheet_name):
+    return f'{excel_file_id}:{sheet_name}'
+
+
+def parse_address(address):
+    """("host", port) for "host:port", else the address as a Unix socket path"""
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def _authkey():
+    return (settings.QUERY_SERVER_AUTHKEY or settings.SECRET_KEY).encode('utf-8')
+
+
+def _is_down(address):
+    with _down_lock:
+        until = _down.get(address)
+        if until is not None and until <= time.monotonic():
+            del _down[address]
+            return False
+        return until is not None
+
+
+def _mark_down(address):
+    with _down_lock:
+        _down[address] = time.monotonic() + settings.QUERY_SERVER_RETRY_AFTER
+
+
+def _connections():
+    # Connections are not thread-safe; each thread keeps its own
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    return connections
+
+
+def _call(address, message):
+    connections = _connections()
+    for attempt in range(2):
+        connection = connections.pop(address, None)
+        reused = connection is not None
+        if connection is None:
+            connection = Client(parse_address(address), authkey=_authkey())
+        try:
+            connection.send(message)
+            if not connection.poll(settings.QUERY_SERVER_TIMEOUT):
+                raise QueryServerTimeout(f'Query server {address} did not answer in time')
+            reply = connection.recv()
+        except QueryServerTimeout:
+            connection.close()
+            raise
+        except (OSError, EOFError):
+            connection.close()
+            # The server may have restarted since this connection was opened
+            if reused and attempt == 0:
+                continue
+            raise
+        connections[address] = connection
+        return reply
+
+
+def run(operation, excel_file, sheet_name, **params):
+    """Run a sheet_queries operation on the server owning the sheet, or in this process
+
+    Results shared through SHARED_CACHE_DIR are answered without either.
+    """
+    return shared_cache.get_or_compute(
+        operation, excel_file, sheet_name, params,
+        lambda: _dispatch(operation, excel_file, sheet_name, params)
+    )
+
+
+def _dispatch(operation, excel_file, sheet_name, params):
+    addresses = tuple(settings.QUERY_SERVERS)
+    if addresses:
+        for address in ring(addresses).nodes_for(sheet_key(excel_file.id, sheet_name)):
+            if _is_down(address):
+                continue
+            try:
+                reply = _call(address, (operation, excel_file.id, sheet_name, params))
+            except QueryServerTimeout:
+                raise
+            except (OSError, EOFError) as e:
+                logger.warning('Query server %s unreachable, skipping it: %s', address, e)
+                _mark_down(address)
+                continue
+            return _result(reply)
+        logger.warning('No query server reachable; running %s in this process', operation)
+    return sheet_queries.OPERATIONS[operation](excel_file, sheet_name, **params)
+
+
+def _result(reply):
+    status, payload, trace_summary = reply
+    tracing.merge(trace_summary)
+    if status == 'ok':
+        return payload
+    kind, message = payload
+    raise _REQUEST_ERRORS.get(kind, QueryServerError)(message)
+
+
+def handle(message):
+    """Run one forwarded operation and return the reply to send back"""
+    from .models import ExcelFile
+
+    operation, excel_file_id, sheet_name, params = message
+    close_old_connections()
+    with tracing.collect() as trace:
+        try:
+            excel_file = ExcelFile.objects.get(id=excel_file_id)
+            reply = ('ok', sheet_queries.OPERATIONS[operation](excel_file, sheet_name, **params))
+        except query.QueryError as e:
+            reply = ('error', (type(e).__name__, str(e)))
+        except Exception as e:
+            logger.exception('Query server operation %s failed', operation)
+            reply = ('error', (type(e).__name__, str(e)))
+        finally:
+            close_old_connections()
+    return reply + (tracing.summary(trace),)
+
+
+def _serve_connection(connection):
+    with connection:
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                return
+            connection.send(handle(message))
+
+
+def serve(address):
+    """Accept connections on `address` until interrupted, one thread per connection"""
+    parsed = parse_address(address)
+    if isinstance(parsed, str) and os.path.exists(parsed):
+        os.unlink(parsed)  # Left behind by a previous run
+
+    with Listener(parsed, authkey=_authkey()) as listener:
+        logger.info('Query server listening on %s', address)
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                # A client that failed authentication or hung up mid-handshake
+                logger.warning('Query server %s rejected a connection: %s', address, e)
+                continue
+            threading.Thread(
+                target=_serve_connection, args=(connection,), name='query-server', daemon=True
+            ).start()
+
+
+def owns(address, excel_file_id, sheet_name):
+    """Whether `address` owns a sheet on the ring of QUERY_SERVERS"""
+    return ring(tuple(settings.QUERY_SERVERS)).owner(sheet_key(excel_file_id, sheet_name)) == address
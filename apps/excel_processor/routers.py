@@ -0,0 +1,50 @@
+"""Keep the write-heavy query logs in their own database
+
+Every lookup writes a QueryLog row; in the shared SQLite file those writes
+would queue behind (and block) logins, sessions and admin edits. Models in
+LOG_MODELS live in settings.LOG_DATABASE, tuned for write throughput;
+everything else stays in 'default'. Relations across the two are plain
+ids without database constraints, so they cannot be joined in SQL.
+"""
+from django.conf import settings
+
+
+LOG_MODELS = {'querylog', 'resultpayload', 'slowquery', 'requestprofile', 'filtersummary'}
+
+
+def is_log_model(model):
+    return model._meta.app_label == 'excel_processor' and model._meta.model_name in LOG_MODELS
+
+
+class LogDatabaseRouter:
+    def _db_for(self, model):
+        return settings.LOG_DATABASE if is_log_model(model) else 'default'
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Logs point at files and users in the other database by id
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'excel_processor' and model_name in LOG_MODELS:
+            return db == settings.LOG_DATABASE
+        return db == 'default'
+
+
+def configure_connection(sender, connection, **kwargs):
+    """Favour write throughput on the log database: WAL and relaxed syncing
+
+    WAL lets lookups keep reading while a log row is written, and NORMAL
+    sync only risks the last few log rows on power loss, never corruption.
+    """
+    if connection.alias != settings.LOG_DATABASE or connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
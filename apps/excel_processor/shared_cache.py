@@ -0,0 +1,69 @@
+"""Results of sheet operations, shared by every worker process on a host
+
+With SHARED_CACHE_DIR set, query_servers.run answers repeated operations
+from a file-based cache in that directory before loading a sheet or
+asking a query server. Keys include the sheet's cache token (see
+ExcelFile.cache_token), which changes whenever the workbook or the
+sheet's configuration is saved, so no process can serve a result from
+before the change and nothing has to be told to invalidate; old entries
+are never read again and age out under SHARED_CACHE_MAX_ENTRIES.
+"""
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+
+from . import tracing
+
+
+_lock = threading.Lock()
+_backend = None
+_backend_dir = None
+
+_MISSING = object()
+
+
+def backend():
+    """The file-based cache in SHARED_CACHE_DIR, or None when sharing is off"""
+    global _backend, _backend_dir
+    directory = settings.SHARED_CACHE_DIR
+    if not directory:
+        return None
+    with _lock:
+        if _backend is None or _backend_dir != str(directory):
+            _backend = FileBasedCache(str(directory), {
+                'TIMEOUT': settings.SHARED_CACHE_TIMEOUT,
+                'OPTIONS': {'MAX_ENTRIES': settings.SHARED_CACHE_MAX_ENTRIES},
+            })
+            _backend_dir = str(directory)
+        return _backend
+
+
+def key(operation, excel_file, sheet_name, params):
+    identity = json.dumps(
+        [operation, excel_file.cache_token(sheet_name), params], sort_keys=True, default=str
+    )
+    return f'sheet-op:{hashlib.sha1(identity.encode("utf-8")).hexdigest()}'
+
+
+def get_or_compute(operation, excel_file, sheet_name, params, compute):
+    """Return the cached result of an operation, else compute() and cache it
+
+    Errors raised by compute() are not cached.
+    """
+    cache = backend()
+    if cache is None:
+        return compute()
+
+    cache_key = key(operation, excel_file, sheet_name, params)
+    with tracing.phase('shared_cache'):
+        result = cache.get(cache_key, _MISSING)
+    if result is not _MISSING:
+        tracing.annotate(cache_hit=True)
+        return result
+
+    result = compute()
+    cache.set(cache_key, result)
+    return result
@@ -0,0 +1,551 @@
+"""In-process cache of loaded sheets and the lookup indexes built over them"""
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from . import query, singleflight, snapshots, tracing
+from .normalize import normalize_array
+
+
+# Highest code point, appended to a prefix to find the end of its range
+_PREFIX_END = '\U0010ffff'
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+# Loads started by requests that were answered some other way meanwhile
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheet-load')
+_background_keys = set()
+
+
+class ColumnIndex:
+    """Sorted distinct values of one column, used for dropdowns and typeahead"""
+
+    def __init__(self, values):
+        distinct = sorted(set(values))
+        self.values = np.array(distinct, dtype=str)
+
+        # Case-folded copy sorted on its own, so prefix ranges can be found
+        # with a binary search regardless of the display order
+        folded = np.array([value.casefold() for value in distinct], dtype=str)
+        order = np.argsort(folded, kind='stable')
+        self.folded = folded[order]
+        self.folded_values = self.values[order]
+
+    def __len__(self):
+        return len(self.values)
+
+    def search(self, query, mode='prefix', limit=20):
+        """Return up to `limit` values matching `query`, prefix matches first"""
+        query = query.strip().casefold()
+        if not query:
+            return self.values[:limit].tolist()
+
+        lo = int(np.searchsorted(self.folded, query, side='left'))
+        hi = int(np.searchsorted(self.folded, query + _PREFIX_END, side='left'))
+        matches = self.folded_values[lo:min(hi, lo + limit)].tolist()
+
+        if mode == 'contains' and len(matches) < limit:
+            hits = np.flatnonzero(np.char.find(self.folded, query) >= 0)
+            # Prefix matches were already taken from [lo, hi)
+            hits = hits[(hits < lo) | (hits >= hi)]
+            matches += self.folded_values[hits[:limit - len(matches)]].tolist()
+
+        return matches
+
+
+class NumericIndex:
+    """Numeric view of one column sorted once, so ranges resolve by binary search"""
+
+    def __init__(self, keys):
+        self.values = np.fromiter((_to_float(key) for key in keys), dtype=float, count=len(keys))
+        present = np.flatnonzero(~np.isnan(self.values))
+        self.order = present[np.argsort(self.values[present], kind='stable')]
+        self.sorted_values = self.values[self.order]
+
+    def bounds(self, low=None, high=None):
+        """Return the [start, stop) slice of sorted positions within low..high inclusive"""
+        start = 0 if low is None else int(np.searchsorted(self.sorted_values, low, side='left'))
+        stop = len(self.sorted_values) if high is None else int(np.searchsorted(self.sorted_values, high, side='right'))
+        return start, max(start, stop)
+
+    def rows_between(self, low=None, high=None):
+        """Row positions whose value lies within low..high, in sheet order"""
+        start, stop = self.bounds(low, high)
+        return np.sort(self.order[start:stop])
+
+
+class HashIndex:
+    """Row positions of every key, for columns with many distinct values"""
+
+    kind = 'hash'
+
+    def __init__(self, keys):
+        present = np.flatnonzero(keys != None)  # noqa: E711
+        values = keys[present].astype(str)
+        # A stable sort keeps each key's rows in sheet order
+        order = np.argsort(values, kind='stable')
+        distinct, starts = np.unique(values[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        positions = present[order]
+        self._rows = {
+            key: positions[start:stop]
+            for key, start, stop in zip(distinct.tolist(), starts.tolist(), stops.tolist())
+        }
+
+    def count(self, keys):
+        return sum(len(self._rows.get(key, ())) for key in keys)
+
+    def rows(self, keys):
+        found = [self._rows[key] for key in keys if key in self._rows]
+        if len(found) == 1:
+            return found[0]
+        return np.sort(np.concatenate(found)) if found else np.array([], dtype=np.intp)
+
+
+class SortedIndex:
+    """Keys sorted once with their row positions; lighter than a hash for numeric columns"""
+
+    kind = 'sorted'
+
+    def __init__(self, keys):
+        present = np.flatnonzero(keys != None)  # noqa: E711
+        values = keys[present].astype(str)
+        order = np.argsort(values, kind='stable')
+        self.sorted_keys = values[order]
+        self.positions = present[order]
+
+    def _bounds(self, key):
+        return (
+            int(np.searchsorted(self.sorted_keys, key, side='left')),
+            int(np.searchsorted(self.sorted_keys, key, side='right')),
+        )
+
+    def count(self, keys):
+        return sum(stop - start for start, stop in map(self._bounds, keys))
+
+    def rows(self, keys):
+        found = [self.positions[start:stop] for start, stop in map(self._bounds, keys)]
+        return np.sort(np.concatenate(found)) if found else np.array([], dtype=np.intp)
+
+
+class BitmapIndex:
+    """One packed bitmap per key, for columns with few distinct values"""
+
+    kind = 'bitmap'
+
+    def __init__(self, keys):
+        self.row_count = len(keys)
+        self._bitmaps = {}
+        self._counts = {}
+        for key in set(keys.tolist()) - {None}:
+            mask = keys == key
+            self._bitmaps[key] = np.packbits(mask)
+            self._counts[key] = int(mask.sum())
+
+    def count(self, keys):
+        return sum(self._counts.get(key, 0) for key in keys)
+
+    def rows(self, keys):
+        combined = np.zeros((self.row_count + 7) // 8, dtype=np.uint8)
+        for key in keys:
+            if key in self._bitmaps:
+                combined |= self._bitmaps[key]
+        return np.flatnonzero(np.unpackbits(combined, count=self.row_count))
+
+
+KEY_INDEX_KINDS = {index.kind: index for index in (HashIndex, SortedIndex, BitmapIndex)}
+
+
+def _to_float(key):
+    if key is None:
+        return np.nan
+    try:
+        return float(key)
+    except ValueError:
+        return np.nan
+
+
+def column_values(series):
+    """A parsed column as an object array of plain Python values
+
+    Timestamps become datetimes and NaT None, so snapshots unpickle
+    without importing pandas.
+    """
+    import pandas as pd
+
+    values = series.to_numpy(dtype=object, copy=True)
+    for position, value in enumerate(values):
+        if value is pd.NaT:
+            values[position] = None
+        elif isinstance(value, pd.Timestamp):
+            values[position] = value.to_pydatetime()
+        elif isinstance(value, pd.Timedelta):
+            values[position] = value.to_pytimedelta()
+    return values
+
+
+class SheetSource:
+    """Where a sheet's data comes from: the workbook path and a fingerprint of its contents"""
+
+    def __init__(self, path, fingerprint, sheet_name, stats=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.sheet_name = sheet_name
+        # Column statistics from the ingest catalog, where available
+        self.stats = stats or {}
+
+    @classmethod
+    def for_excel_file(cls, excel_file, sheet_name):
+        path = excel_file.file.path
+        if excel_file.content_hash:
+            # Rows uploading the same workbook share snapshots and cache entries
+            fingerprint = excel_file.content_hash
+        else:
+            stat = os.stat(path)
+            fingerprint = hashlib.sha1(
+                f'{excel_file.file.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')
+            ).hexdigest()
+        stats = (excel_file.column_info or {}).get(sheet_name, {}).get('stats')
+        return cls(path, fingerprint, sheet_name, stats)
+
+    @property
+    def key(self):
+        return (self.fingerprint, self.sheet_name)
+
+    def read_header(self):
+        """Return the sheet's column names, reading only the header row on a miss"""
+        header = snapshots.read(self.fingerprint, self.sheet_name, 'header')
+        if header is None:
+            with self.load_lock():
+                header = snapshots.read(self.fingerprint, self.sheet_name, 'header')
+                if header is None:
+                    import pandas as pd
+                    header = pd.read_excel(self.path, sheet_name=self.sheet_name, nrows=0).columns.tolist()
+                    snapshots.write(self.fingerprint, self.sheet_name, 'header', header)
+        return header
+
+    def read_columns(self, columns):
+        """Return {column: values} for the requested columns
+
+        Columns already in the snapshot are read from it; the rest are parsed
+        from the workbook in a single pass that skips every other column.
+        """
+        data = self._read_snapshot_columns(columns)
+        if all(column in data for column in columns):
+            return data
+
+        with self.load_lock():
+            # Another process may have parsed them while we waited
+            data = self._read_snapshot_columns(columns)
+            missing = [column for column in columns if column not in data]
+            if missing:
+                data.update(self._parse_columns(missing))
+        return data
+
+    def _read_snapshot_columns(self, columns):
+        data = {}
+        for column in columns:
+            values = snapshots.read(self.fingerprint, self.sheet_name, snapshots.column_part(column))
+            if values is not None:
+                data[column] = values
+        return data
+
+    def _parse_columns(self, missing):
+        import pandas as pd
+
+        wanted = set(missing)
+        df = pd.read_excel(
+            self.path,
+            sheet_name=self.sheet_name,
+            usecols=lambda column: column in wanted,
+            # Keep cell values as read, so a column parses the same way
+            # whichever other columns were loaded alongside it
+            dtype={column: object for column in missing},
+        )
+        data = {}
+        for column in missing:
+            values = column_values(df[column])
+            snapshots.write(self.fingerprint, self.sheet_name, snapshots.column_part(column), values)
+            data[column] = values
+        return data
+
+    def load_lock(self):
+        """Cross-process lock held while parsing this sheet from the workbook"""
+        return singleflight.file_lock(snapshots.lock_path(self.fingerprint, self.sheet_name))
+
+    def read_keys(self, column, values):
+        """Return the normalized comparison keys of a column, computing them once"""
+        keys = snapshots.read(self.fingerprint, self.sheet_name, snapshots.key_part(column))
+        if keys is None:
+            keys = normalize_array(values)
+            snapshots.write(self.fingerprint, self.sheet_name, snapshots.key_part(column), keys)
+        return keys
+
+
+class BaseSheet:
+    """Interface shared by the sheet backends get_sheet can return
+
+    `columns` lists the sheet's header and `keys` maps every column that
+    can be filtered on to its normalized keys (in whatever form the
+    backend stores them). Rows are addressed by 0-based position.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._results = OrderedDict()
+        self._results_lock = threading.Lock()
+
+    def ensure_columns(self, columns):
+        """Make `columns` available for filtering and results"""
+
+    def cardinality(self, column):
+        """Number of distinct non-blank keys in a column"""
+        raise NotImplementedError
+
+    def distinct_values(self, column):
+        """Sorted distinct non-blank keys of a column"""
+        raise NotImplementedError
+
+    def search_values(self, column, query, mode='prefix', limit=20):
+        """Up to `limit` distinct keys matching a typeahead query"""
+        raise NotImplementedError
+
+    def first_row(self, predicates):
+        """Position of the first row matching every predicate, or None"""
+        raise NotImplementedError
+
+    def row_values(self, row, columns):
+        """Raw cell values of one row for the requested columns"""
+        raise NotImplementedError
+
+    def aggregate(self, predicates, group_by, aggregates):
+        """Grouped aggregates over matching rows, in query.aggregate's format"""
+        raise NotImplementedError
+
+    def memory_estimate(self):
+        """Approximate bytes this sheet holds in memory"""
+        return 0
+
+    def memoized(self, key, compute):
+        """Return compute() for a hashable key, remembering recent results
+
+        Results live as long as this sheet, so a changed workbook (a new
+        sheet object) never sees results computed from the old one.
+        """
+        with self._results_lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+
+        result = compute()
+
+        with self._results_lock:
+            self._results[key] = result
+            while len(self._results) > settings.SHEET_RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+        return result
+
+
+class LoadedSheet(BaseSheet):
+    """Column arrays of one sheet plus lazily built per-column indexes
+
+    Only the columns requests have asked for are held; others are added on
+    demand by get_sheet. Each held column keeps its raw cell values in
+    `data` and their normalized comparison keys in `keys`.
+    """
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.columns = source.read_header()
+        self.row_count = None
+        self.data = {}
+        self.keys = {}
+        self._indexes = {}
+        self._key_indexes = {}
+        self._numeric_indexes = {}
+
+    def ensure_columns(self, columns):
+        """Load any of `columns` that exist in the sheet but are not held yet"""
+        while True:
+            missing = [column for column in columns if column in self.columns and column not in self.data]
+            if not missing:
+                return
+            # Concurrent callers wait for one load; if it was for other
+            # columns they go round again and load theirs
+            singleflight.do(('columns',) + self.source.key, lambda: self._load_columns(missing))
+
+    def _load_columns(self, columns):
+        tracing.annotate(cache_hit=False)
+        for column, values in self.source.read_columns(columns).items():
+            self.row_count = len(values)
+            self.keys[column] = self.source.read_keys(column, values)
+            self.data[column] = values
+
+    def column_index(self, column):
+        """Return the ColumnIndex for a column, building it on first use"""
+        index = self._indexes.get(column)
+        if index is None:
+            keys = self.keys[column]
+            index = self._indexes[column] = ColumnIndex(key for key in keys if key is not None)
+        return index
+
+    def index_kind(self, column):
+        """Kind of key index a column gets: from the catalog, else from its keys"""
+        stats = self.source.stats.get(column)
+        if stats and stats.get('index') in KEY_INDEX_KINDS:
+            return stats['index']
+        if len(self.column_index(column)) <= settings.BITMAP_INDEX_MAX_DISTINCT:
+            return 'bitmap'
+        return 'hash'
+
+    def key_index(self, column):
+        """Return the index from keys to row positions for a column, building it on first use"""
+        index = self._key_indexes.get(column)
+        if index is None:
+            index_class = KEY_INDEX_KINDS[self.index_kind(column)]
+            index = self._key_indexes[column] = index_class(self.keys[column])
+        return index
+
+    def numeric_index(self, column):
+        """Return the NumericIndex for a column, building it on first use"""
+        index = self._numeric_indexes.get(column)
+        if index is None:
+            index = self._numeric_indexes[column] = NumericIndex(self.keys[column])
+        return index
+
+    def memory_estimate(self):
+        total = 0
+        for arrays in (self.data, self.keys):
+            for values in arrays.values():
+                total += values.nbytes
+                # Object arrays hold pointers; add the objects from a sample
+                sample = values[:100]
+                if len(sample):
+                    total += sum(sys.getsizeof(value) for value in sample) * len(values) // len(sample)
+        return total
+
+    def cardinality(self, column):
+        return len(self.column_index(column))
+
+    def distinct_values(self, column):
+        return self.column_index(column).values.tolist()
+
+    def search_values(self, column, query, mode='prefix', limit=20):
+        return self.column_index(column).search(query, mode=mode, limit=limit)
+
+    def matching_rows(self, predicates):
+        """Positions of all rows matching every predicate, in sheet order"""
+        return query.matching_rows(self, predicates)
+
+    def first_row(self, predicates):
+        rows = self.matching_rows(predicates)
+        return int(rows[0]) if len(rows) else None
+
+    def row_values(self, row, columns):
+        return {column: self.data[column][row] for column in columns if column in self.data}
+
+    def aggregate(self, predicates, group_by, aggregates):
+        return query.aggregate(self, self.matching_rows(predicates), group_by, aggregates)
+
+
+def configured_columns(sheet_config):
+    """Columns a sheet's configuration needs, filter columns first"""
+    columns = list(sheet_config.get('filter_columns', []))
+    for column in sheet_config.get('result_columns', ['total']):
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def _open_sheet(source):
+    # Imported here: sqlite_store builds on the classes in this module
+    from . import sqlite_store
+
+    if sqlite_store.wants_store(source):
+        return sqlite_store.SQLiteSheet(source)
+    return LoadedSheet(source)
+
+
+def get_sheet(excel_file, sheet_name, columns=None):
+    """Return the sheet object for a sheet with at least `columns` loaded
+
+    Sheets above SQLITE_BACKEND_ROW_THRESHOLD rows are served from a
+    SQLite store, the rest from in-memory arrays. `columns` defaults to
+    the configured filter and result columns.
+    """
+    if columns is None:
+        columns = configured_columns(excel_file.sheet_config.get(sheet_name, {}))
+
+    source = SheetSource.for_excel_file(excel_file, sheet_name)
+    with _lock:
+        sheet = _cache.get(source.key)
+        if sheet is not None:
+            _cache.move_to_end(source.key)
+
+    tracing.annotate(cache_hit=sheet is not None)
+    if sheet is None:
+        # Requests that miss together share one load of the sheet
+        sheet = singleflight.do(('open',) + source.key, lambda: _open_sheet(source))
+        with _lock:
+            _cache[source.key] = sheet
+            while len(_cache) > settings.SHEET_CACHE_MAX_SHEETS:
+                _cache.popitem(last=False)
+
+    sheet.ensure_columns(columns)
+    return sheet
+
+
+def is_ready(excel_file, sheet_name, columns):
+    """Whether `columns` can be served without parsing the workbook"""
+    source = SheetSource.for_excel_file(excel_file, sheet_name)
+    with _lock:
+        sheet = _cache.get(source.key)
+    if sheet is not None:
+        return all(column in sheet.keys or column not in sheet.columns for column in columns)
+
+    from . import sqlite_store
+    if os.path.exists(sqlite_store.store_path(source)):
+        return True
+
+    return snapshots.exists(source.fingerprint, sheet_name, 'header') and all(
+        snapshots.exists(source.fingerprint, sheet_name, snapshots.column_part(column))
+        for column in columns
+    )
+
+
+def load_in_background(excel_file, sheet_name, columns=None):
+    """Queue get_sheet for a sheet unless it is already queued"""
+    key = (SheetSource.for_excel_file(excel_file, sheet_name).key, tuple(columns or ()))
+    with _lock:
+        if key in _background_keys:
+            return
+        _background_keys.add(key)
+
+    def load():
+        try:
+            get_sheet(excel_file, sheet_name, columns)
+        finally:
+            with _lock:
+                _background_keys.discard(key)
+
+    _background.submit(load)
+
+
+def discard(fingerprint):
+    """Drop the cached sheets of one workbook"""
+    with _lock:
+        for key in [key for key in _cache if key[0] == fingerprint]:
+            del _cache[key]
+
+
+def clear():
+    """Drop every cached sheet"""
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,152 @@
+"""Sheet operations behind the lookup views, run in a web worker or a query server
+
+Each operation takes the ExcelFile and sheet name plus plain parameters
+and returns plain Python values, so query_servers can forward it to the
+process that owns the sheet. Errors in the request itself are raised as
+query.QueryError (or FilterError) for the views to turn into a 400.
+"""
+import json
+
+from django.conf import settings
+
+from . import client_dataset, query, sheet_cache, stream_scan, tracing
+
+
+def columns(excel_file, sheet_name):
+    """Dropdown values of the filter columns, plus the client-side payload version"""
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    filterable_columns = sheet_config.get('filter_columns', [])
+
+    # Only the filter columns are needed to build dropdowns
+    with tracing.phase('load'):
+        sheet = sheet_cache.get_sheet(excel_file, sheet_name, columns=filterable_columns)
+
+    # Columns with too many values are left empty and served by search_values instead
+    column_data = {}
+    typeahead_columns = []
+    with tracing.phase('distinct_values'):
+        for column in filterable_columns:
+            if sheet.cardinality(column) > settings.TYPEAHEAD_CARDINALITY_THRESHOLD:
+                column_data[column] = []
+                typeahead_columns.append(column)
+            else:
+                column_data[column] = sheet.distinct_values(column)
+
+    # Small sheets can be downloaded once and filtered in the browser
+    with tracing.phase('dataset'):
+        dataset_version = client_dataset.ensure_payload(excel_file, sheet_name, sheet)
+
+    return {
+        'columns': column_data,
+        'typeahead_columns': typeahead_columns,
+        'dataset_version': dataset_version,
+    }
+
+
+def search_values(excel_file, sheet_name, column, text, mode, limit):
+    """Values of a high-cardinality filter column matching typed text"""
+    sheet = sheet_cache.get_sheet(excel_file, sheet_name, columns=[column])
+    return sheet.search_values(column, text, mode=mode, limit=limit)
+
+
+def _use_streaming_scan(excel_file, sheet_name, sheet_config):
+    """Whether a lookup should scan the worksheet instead of loading it"""
+    if not settings.STREAMING_SCAN_ENABLED or not stream_scan.can_scan(excel_file.file.path):
+        return False
+    # Without configured filter columns there is nothing to build a snapshot of
+    if not sheet_config.get('filter_columns'):
+        return True
+    return not sheet_cache.is_ready(excel_file, sheet_name, sheet_cache.configured_columns(sheet_config))
+
+
+def _filterable_columns(sheet_config):
+    """Columns lookups filter on: the configured ones, or None for any column of an unconfigured sheet"""
+    if not sheet_config.get('filter_columns'):
+        return None
+    return sheet_cache.configured_columns(sheet_config)
+
+
+def _loaded_filterable(sheet, filterable):
+    # Not every loaded column: other requests may have loaded more than the configuration
+    if filterable is None:
+        return sheet.keys
+    return [column for column in filterable if column in sheet.keys]
+
+
+def lookup(excel_file, sheet_name, filters):
+    """Return (applied filters, results of the first matching row or None)"""
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    result_columns = sheet_config.get('result_columns', ['total'])
+    # The same filters apply whether the sheet is scanned or loaded
+    filterable = _filterable_columns(sheet_config)
+
+    if _use_streaming_scan(excel_file, sheet_name, sheet_config):
+        # Nothing to look up in yet: scan the worksheet, stopping at
+        # the first match, and build the snapshot for next time
+        tracing.annotate(cache_hit=False)
+        with tracing.phase('scan'):
+            applied_filters, results = stream_scan.first_match(
+                excel_file.file.path, sheet_name, filters, result_columns, filterable
+            )
+        if sheet_config.get('filter_columns'):
+            sheet_cache.load_in_background(excel_file, sheet_name)
+        return applied_filters, results
+
+    # Load only the configured filter and result columns (cached)
+    with tracing.phase('load'):
+        sheet = sheet_cache.get_sheet(excel_file, sheet_name)
+
+    # Apply filters, comparing against the keys normalized at load
+    with tracing.phase('filter'):
+        predicates, applied_filters = query.parse_filters(filters, _loaded_filterable(sheet, filterable))
+        row = sheet.first_row(predicates)
+
+    # Convert numpy values to native Python types, 'total' first
+    with tracing.phase('results'):
+        results = None if row is None else query.row_results(sheet, row, result_columns)
+    return applied_filters, results
+
+
+def first_match(excel_file, sheet_name, filters):
+    """Results of the first row matching every filter, or None if any filter cannot apply"""
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    sheet = sheet_cache.get_sheet(excel_file, sheet_name)
+    predicates, applied_filters = query.parse_filters(
+        filters, _loaded_filterable(sheet, _filterable_columns(sheet_config))
+    )
+    if len(applied_filters) < len(filters):
+        return None
+
+    row = sheet.first_row(predicates)
+    if row is None:
+        return None
+    return query.row_results(sheet, row, sheet_config.get('result_columns', ['total']))
+
+
+def aggregate(excel_file, sheet_name, filters, group_by, aggregates):
+    """Return (applied filters, groups) for rows matching `filters`"""
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    sheet = sheet_cache.get_sheet(excel_file, sheet_name)
+    predicates, applied_filters = query.parse_filters(
+        filters, _loaded_filterable(sheet, _filterable_columns(sheet_config))
+    )
+
+    missing = [column for column in list(group_by) + list(aggregates) if column not in sheet.keys]
+    if missing:
+        raise query.QueryError(f'Columns not found in sheet: {", ".join(missing)}')
+
+    # Identical dashboard refreshes are answered from the sheet's memo
+    memo_key = json.dumps(
+        ['aggregate', applied_filters, group_by, aggregates], sort_keys=True, default=str
+    )
+    groups = sheet.memoized(memo_key, lambda: sheet.aggregate(predicates, group_by, aggregates))
+    return applied_filters, groups
+
+
+OPERATIONS = {
+    'columns': columns,
+    'search_values': search_values,
+    'lookup': lookup,
+    'first_match': first_match,
+    'aggregate': aggregate,
+}
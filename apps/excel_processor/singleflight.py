@@ -0,0 +1,100 @@
+"""Collapse concurrent loads of the same thing into one
+
+When a popular workbook changes, every request for it misses at once.
+`do` lets the first caller for a key run the load while the others wait
+for its result (or its exception) instead of parsing the same sheet
+again. `file_lock` extends this across worker processes.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: loads are only deduplicated within a process
+    fcntl = None
+
+
+_FILE_LOCK_POLL_INTERVAL = 0.05
+
+
+class LoadTimeout(TimeoutError):
+    """Raised when waiting on another caller's load takes too long"""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_lock = threading.Lock()
+
+
+def do(key, load, timeout=None):
+    """Return load(), running it once for all concurrent callers with `key`
+
+    Callers arriving while a load for `key` is running wait up to
+    `timeout` seconds (SHEET_LOAD_TIMEOUT by default) and get the same
+    result, or the same exception if the load failed.
+    """
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        timeout = settings.SHEET_LOAD_TIMEOUT if timeout is None else timeout
+        if not flight.done.wait(timeout):
+            raise LoadTimeout(f'Timed out after {timeout}s waiting for a concurrent load')
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = load()
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        # Later callers start a fresh load; nothing is cached here
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+
+@contextmanager
+def file_lock(path, timeout=None):
+    """Hold an exclusive lock on `path` shared with other processes
+
+    A no-op when SHEET_LOAD_FILE_LOCK is off or the platform has no
+    fcntl. Callers should re-check for the work's output once inside,
+    since another process may have finished it while they waited.
+    """
+    if fcntl is None or not settings.SHEET_LOAD_FILE_LOCK:
+        yield
+        return
+
+    timeout = settings.SHEET_LOAD_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LoadTimeout(f'Timed out after {timeout}s waiting for another process to load')
+                time.sleep(_FILE_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
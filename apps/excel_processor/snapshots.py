@@ -0,0 +1,66 @@
+"""On-disk columnar snapshots of parsed sheets, one file per column"""
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+
+from django.conf import settings
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()[:16]
+
+
+def sheet_dir(fingerprint, sheet_name):
+    """Directory holding the snapshot parts of one sheet"""
+    return os.path.join(str(settings.SHEET_SNAPSHOT_DIR), fingerprint, _digest(sheet_name))
+
+
+def column_part(column):
+    """Part name under which a column's values are stored"""
+    return f'column-{_digest(column)}'
+
+
+def key_part(column):
+    """Part name under which a column's normalized keys are stored"""
+    return f'key-{_digest(column)}'
+
+
+def lock_path(fingerprint, sheet_name):
+    """File locked while a process parses the sheet from its workbook"""
+    return os.path.join(sheet_dir(fingerprint, sheet_name), 'load.lock')
+
+
+def exists(fingerprint, sheet_name, part):
+    """Whether a part has been written"""
+    return os.path.exists(os.path.join(sheet_dir(fingerprint, sheet_name), part + '.pkl'))
+
+
+def read(fingerprint, sheet_name, part):
+    """Return a stored part, or None if it has not been written yet"""
+    path = os.path.join(sheet_dir(fingerprint, sheet_name), part + '.pkl')
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (EOFError, pickle.UnpicklingError):
+        # A truncated part is rebuilt from the workbook
+        return None
+
+
+def write(fingerprint, sheet_name, part, value):
+    """Store a part atomically so concurrent readers never see half a file"""
+    directory = sheet_dir(fingerprint, sheet_name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, part + '.pkl')
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def remove(fingerprint):
+    """Delete every snapshot part of every sheet parsed from one workbook"""
+    shutil.rmtree(os.path.join(str(settings.SHEET_SNAPSHOT_DIR), fingerprint), ignore_errors=True)
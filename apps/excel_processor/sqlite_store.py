@@ -0,0 +1,301 @@
+"""SQLite-backed storage for sheets too large to hold in memory
+
+The worksheet is streamed row by row into a local SQLite file next to the
+sheet's snapshot. Every column is stored raw as c<i>; columns that are
+filtered or aggregated on additionally get their normalized key (k<i>),
+case-folded key (f<i>) and numeric value (n<i>), each indexed, so lookups
+are answered by SQL instead of by scanning arrays.
+"""
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+
+from . import query, singleflight, snapshots, tracing, workbook_info
+from .normalize import normalize_value
+from .sheet_cache import BaseSheet
+
+
+STORE_FILENAME = 'rows.sqlite3'
+_INSERT_BATCH_SIZE = 5000
+
+# Highest code point, appended to a prefix to find the end of its range
+_PREFIX_END = '\U0010ffff'
+
+
+def store_path(source):
+    return os.path.join(snapshots.sheet_dir(source.fingerprint, source.sheet_name), STORE_FILENAME)
+
+
+def wants_store(source):
+    """Whether a sheet is large enough to be served from SQLite"""
+    if os.path.exists(store_path(source)):
+        return True
+    dimensions = workbook_info.sheet_dimensions(source.path)
+    if not dimensions or not dimensions.get(source.sheet_name):
+        # Legacy .xls, or no dimension record to go by
+        return False
+    rows, _ = dimensions[source.sheet_name]
+    return rows - 1 > settings.SQLITE_BACKEND_ROW_THRESHOLD
+
+
+def _storable(value):
+    """Convert a cell value into something SQLite stores natively"""
+    if value is None or isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return normalize_value(value)
+    return str(value)
+
+
+def _to_float(value):
+    key = normalize_value(value)
+    if key is None:
+        return None
+    try:
+        return float(key)
+    except ValueError:
+        return None
+
+
+def _casefold(value):
+    return None if value is None else value.casefold()
+
+
+def build_store(source, path):
+    """Stream a worksheet into a new SQLite file at `path`"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(source.path, read_only=True, data_only=True)
+    try:
+        rows = workbook[source.sheet_name].iter_rows(values_only=True)
+        header = workbook_info.header_names(next(rows, ()))
+        width = max(1, len(header))
+        placeholders = ', '.join('?' * width)
+
+        connection = sqlite3.connect(temp_path)
+        try:
+            # Nothing reads the file until it is renamed into place
+            connection.execute('PRAGMA journal_mode=OFF')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute(f'CREATE TABLE rows ({", ".join(f"c{i}" for i in range(width))})')
+
+            row_count = 0
+            batch = []
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                values = [_storable(value) for value in row[:width]]
+                batch.append(values + [None] * (width - len(values)))
+                if len(batch) >= _INSERT_BATCH_SIZE:
+                    connection.executemany(f'INSERT INTO rows VALUES ({placeholders})', batch)
+                    row_count += len(batch)
+                    batch = []
+            if batch:
+                connection.executemany(f'INSERT INTO rows VALUES ({placeholders})', batch)
+                row_count += len(batch)
+
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('header', json.dumps(header)),
+                ('row_count', json.dumps(row_count)),
+                ('derived', json.dumps([])),
+            ])
+            connection.commit()
+            connection.execute('PRAGMA journal_mode=WAL')
+        finally:
+            connection.close()
+    finally:
+        workbook.close()
+
+    os.replace(temp_path, path)
+
+
+class SQLiteSheet(BaseSheet):
+    """A sheet served from its SQLite store, with bounded memory use"""
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.path = store_path(source)
+        if not os.path.exists(self.path):
+            with source.load_lock():
+                # Another process may have built it while we waited
+                if not os.path.exists(self.path):
+                    build_store(source, self.path)
+
+        self._local = threading.local()
+        self._cardinality = {}
+
+        meta = dict(self._execute('SELECT name, value FROM meta').fetchall())
+        self.columns = json.loads(meta['header'])
+        self.row_count = json.loads(meta['row_count'])
+        self._positions = {column: position for position, column in enumerate(self.columns)}
+        self.keys = {
+            column: self._positions[column]
+            for column in json.loads(meta['derived']) if column in self._positions
+        }
+
+    def _connection(self):
+        # sqlite3 connections are per thread; readers never write
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def ensure_columns(self, columns):
+        """Add the derived key, folded and numeric columns (indexed) for `columns`"""
+        while True:
+            missing = [column for column in columns if column in self._positions and column not in self.keys]
+            if not missing:
+                return
+            singleflight.do(('columns',) + self.source.key, lambda: self._derive_columns(missing))
+
+    def _derive_columns(self, missing):
+        tracing.annotate(cache_hit=False)
+        with self.source.load_lock():
+            self._alter_store(missing)
+        for column in missing:
+            self.keys[column] = self._positions[column]
+
+    def _alter_store(self, missing):
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.create_function('normalize_key', 1, normalize_value, deterministic=True)
+            connection.create_function('to_number', 1, _to_float, deterministic=True)
+            connection.create_function('fold', 1, _casefold, deterministic=True)
+            derived = json.loads(
+                connection.execute("SELECT value FROM meta WHERE name = 'derived'").fetchone()[0]
+            )
+            for column in missing:
+                if column in derived:
+                    continue  # Added by another process since we opened the store
+                i = self._positions[column]
+                connection.execute(f'ALTER TABLE rows ADD COLUMN k{i} TEXT')
+                connection.execute(f'ALTER TABLE rows ADD COLUMN f{i} TEXT')
+                connection.execute(f'ALTER TABLE rows ADD COLUMN n{i} REAL')
+                connection.execute(
+                    f'UPDATE rows SET k{i} = normalize_key(c{i}), n{i} = to_number(c{i})'
+                )
+                connection.execute(f'UPDATE rows SET f{i} = fold(k{i})')
+                for prefix in ('k', 'f', 'n'):
+                    connection.execute(f'CREATE INDEX ix_{prefix}{i} ON rows ({prefix}{i})')
+                derived.append(column)
+            connection.execute("UPDATE meta SET value = ? WHERE name = 'derived'", (json.dumps(derived),))
+            connection.commit()
+            connection.execute('ANALYZE')
+        finally:
+            connection.close()
+
+    def _where(self, predicates):
+        clauses = []
+        params = []
+        for predicate in predicates:
+            i = self.keys[predicate.column]
+            if isinstance(predicate, query.Equals):
+                clauses.append(f'k{i} = ?')
+                params.append(predicate.key)
+            elif isinstance(predicate, query.In):
+                clauses.append(f'k{i} IN ({", ".join("?" * len(predicate.keys))})')
+                params.extend(predicate.keys)
+            elif isinstance(predicate, query.Range):
+                if predicate.low is not None:
+                    clauses.append(f'n{i} >= ?')
+                    params.append(predicate.low)
+                if predicate.high is not None:
+                    clauses.append(f'n{i} <= ?')
+                    params.append(predicate.high)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def cardinality(self, column):
+        if column not in self._cardinality:
+            i = self.keys[column]
+            self._cardinality[column] = self._execute(f'SELECT COUNT(DISTINCT k{i}) FROM rows').fetchone()[0]
+        return self._cardinality[column]
+
+    def distinct_values(self, column):
+        i = self.keys[column]
+        return [
+            value for (value,) in
+            self._execute(f'SELECT DISTINCT k{i} FROM rows WHERE k{i} IS NOT NULL ORDER BY k{i}')
+        ]
+
+    def search_values(self, column, query, mode='prefix', limit=20):
+        i = self.keys[column]
+        query = query.strip().casefold()
+        if not query:
+            return [
+                value for (value,) in
+                self._execute(f'SELECT DISTINCT k{i} FROM rows WHERE k{i} IS NOT NULL ORDER BY k{i} LIMIT ?', (limit,))
+            ]
+
+        prefix = (query, query + _PREFIX_END)
+        matches = [
+            value for _, value in self._execute(
+                f'SELECT DISTINCT f{i}, k{i} FROM rows WHERE f{i} >= ? AND f{i} < ? ORDER BY f{i}, k{i} LIMIT ?',
+                prefix + (limit,)
+            )
+        ]
+        if mode == 'contains' and len(matches) < limit:
+            matches += [
+                value for _, value in self._execute(
+                    f'SELECT DISTINCT f{i}, k{i} FROM rows WHERE instr(f{i}, ?) > 0 '
+                    f'AND NOT (f{i} >= ? AND f{i} < ?) ORDER BY f{i}, k{i} LIMIT ?',
+                    (query,) + prefix + (limit - len(matches),)
+                )
+            ]
+        return matches
+
+    def first_row(self, predicates):
+        where, params = self._where(predicates)
+        row = self._execute(f'SELECT rowid FROM rows{where} ORDER BY rowid LIMIT 1', params).fetchone()
+        return None if row is None else row[0] - 1
+
+    def row_values(self, row, columns):
+        columns = [column for column in columns if column in self._positions]
+        if not columns:
+            return {}
+        selected = ', '.join(f'c{self._positions[column]}' for column in columns)
+        values = self._execute(f'SELECT {selected} FROM rows WHERE rowid = ?', (row + 1,)).fetchone()
+        return dict(zip(columns, values or ()))
+
+    def aggregate(self, predicates, group_by, aggregates):
+        sql_functions = {'sum': 'SUM', 'count': 'COUNT', 'min': 'MIN', 'max': 'MAX', 'mean': 'AVG'}
+        group_columns = [f'k{self.keys[column]}' for column in group_by]
+        selected = group_columns + ['COUNT(*)']
+        for column, functions in aggregates.items():
+            i = self.keys[column]
+            selected += [f'{sql_functions[function]}(n{i})' for function in functions]
+
+        where, params = self._where(predicates)
+        sql = f'SELECT {", ".join(selected)} FROM rows{where}'
+        if group_columns:
+            sql += f' GROUP BY {", ".join(group_columns)} ORDER BY {", ".join(group_columns)}'
+
+        groups = []
+        for record in self._execute(sql, params):
+            label, record = record[:len(group_by)], record[len(group_by):]
+            if not record[0]:
+                continue  # An ungrouped aggregate over no rows
+            values = {}
+            position = 1
+            for column, functions in aggregates.items():
+                values[column] = dict(zip(functions, record[position:position + len(functions)]))
+                position += len(functions)
+            groups.append({
+                'group': dict(zip(group_by, label)),
+                'rows': record[0],
+                'values': values,
+            })
+        return groups
@@ -0,0 +1,66 @@
+"""Bounded-memory lookups that scan a worksheet row by row
+
+Used when a sheet has no snapshot yet, or no filter columns configured to
+build one from: rows are read with openpyxl in read-only mode, filters are
+applied as each row arrives, and the scan stops at the first match (the
+same row fetch_results would return from a loaded sheet).
+"""
+import zipfile
+
+from . import query, tracing, workbook_info
+from .normalize import normalize_value
+
+
+def can_scan(path):
+    """Streaming needs the .xlsx format; legacy .xls files are loaded instead"""
+    return zipfile.is_zipfile(path)
+
+
+def first_match(path, sheet_name, filters, result_columns, filter_columns=None):
+    """Return (applied_filters, results), with results None if no row matches
+
+    Filters apply to `filter_columns` if given, else to any header column.
+    Raises query.FilterError for an invalid filter payload.
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        positions = {
+            column: position
+            for position, column in enumerate(workbook_info.header_names(next(rows, ())))
+        }
+        allowed = positions if filter_columns is None else [column for column in filter_columns if column in positions]
+        predicates, applied_filters = query.parse_filters(filters, allowed)
+        tests = [(positions[predicate.column], predicate) for predicate in predicates]
+        wanted = [(column, positions[column]) for column in result_columns if column in positions]
+
+        def results(row):
+            values = {column: row[position] if position < len(row) else None for column, position in wanted}
+            return query.result_values(values, result_columns)
+
+        scanned = 0
+        blank_match = None
+        try:
+            for row in rows:
+                scanned += 1
+                blank = all(value is None for value in row)
+                # pandas keeps blank rows between data rows but drops trailing
+                # ones, so a matching blank row counts once data follows it
+                if not blank and blank_match is not None:
+                    return applied_filters, results(blank_match)
+                if all(
+                    predicate.matches(normalize_value(row[position] if position < len(row) else None))
+                    for position, predicate in tests
+                ):
+                    if not blank:
+                        return applied_filters, results(row)
+                    if blank_match is None:
+                        blank_match = row
+        finally:
+            tracing.add_rows_scanned(scanned)
+
+        return applied_filters, None
+    finally:
+        workbook.close()
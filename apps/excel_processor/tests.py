@@ -1,17 +1,66 @@
-from django.test import TestCase, Client
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, Client
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.core.management import call_command
+import io
 import json
 import os
+import shutil
 import tempfile
+import time
+from unittest import mock
 import pandas as pd
 
 from .models import ExcelFile, QueryLog
+from . import sheet_cache
+from .normalize import normalize_value
 
 User = get_user_model()
 
 
+def make_workbook(sheets):
+    """Build an in-memory .xlsx from a dict of sheet name -> DataFrame"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return buffer.getvalue()
+
+
+class WorkbookTestCase(TestCase):
+    """Base class for tests that need a real workbook on disk"""
+
+    databases = {'default', 'logs'}
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            SHEET_SNAPSHOT_DIR=os.path.join(self.media_root, 'snapshots')
+        )
+        self.settings_override.enable()
+        sheet_cache.clear()
+        # Keep lookups deterministic: nothing loads behind a test's back
+        background = mock.patch.object(sheet_cache, 'load_in_background')
+        self.load_in_background = background.start()
+        self.addCleanup(background.stop)
+
+    def tearDown(self):
+        sheet_cache.clear()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_excel_file(self, sheets, sheet_config, name='Workbook'):
+        return ExcelFile.objects.create(
+            name=name,
+            file=SimpleUploadedFile(f'{name}.xlsx', make_workbook(sheets)),
+            sheet_names=list(sheets),
+            sheet_config=sheet_config
+        )
+
+
 class ExcelFileModelTest(TestCase):
     """Test ExcelFile model"""
 
@@ -46,6 +95,8 @@ class ExcelFileModelTest(TestCase):
 class ViewsTest(TestCase):
     """Test views"""
 
+    databases = {'default', 'logs'}
+
     def setUp(self):
         self.client = Client()
         self.excel_file = ExcelFile.objects.create(
@@ -94,6 +145,8 @@ class ViewsTest(TestCase):
 class QueryLogTest(TestCase):
     """Test QueryLog model"""
 
+    databases = {'default', 'logs'}
+
     def setUp(self):
         self.excel_file = ExcelFile.objects.create(name="Test File")
 
@@ -110,3 +163,1578 @@ class QueryLogTest(TestCase):
         self.assertEqual(query_log.excel_file, self.excel_file)
         self.assertTrue(query_log.result_found)
         self.assertEqual(query_log.result_data['total'], 100)
+
+    def test_identical_results_are_stored_once(self):
+        from .models import ResultPayload
+        for position in range(3):
+            QueryLog.objects.create(
+                excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={'row': position},
+                result_found=True, result_data={'total': 100, 'code': 'P1'}
+            )
+        QueryLog.objects.create(
+            excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={},
+            result_found=True, result_data={'code': 'P1', 'total': 100}
+        )
+        QueryLog.objects.create(excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={})
+
+        payload = ResultPayload.objects.get()
+        self.assertEqual(payload.query_logs.count(), 4)
+        self.assertEqual(
+            [log.result_data for log in QueryLog.objects.order_by('id')],
+            [{'total': 100, 'code': 'P1'}] * 4 + [None]
+        )
+
+    def test_results_are_stored_on_save_and_pruned_with_their_logs(self):
+        from .models import ResultPayload
+        unsaved = QueryLog(excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={}, result_data={'total': 1})
+        self.assertEqual(unsaved.result_data, {'total': 1})
+        self.assertFalse(ResultPayload.objects.exists())
+
+        other = ExcelFile.objects.create(name="Other File")
+        for excel_file, total in ((self.excel_file, 1), (self.excel_file, 2), (other, 2)):
+            QueryLog.objects.create(
+                excel_file=excel_file, sheet_name='Sheet1', filters_applied={}, result_data={'total': total}
+            )
+        self.assertEqual(ResultPayload.objects.count(), 2)
+
+        # The payload shared with the other file's log stays
+        self.excel_file.delete()
+        self.assertEqual([payload.data for payload in ResultPayload.objects.all()], [{'total': 2}])
+
+        QueryLog.objects.all().delete()
+        call_command('prune_result_payloads', stdout=io.StringIO())
+        self.assertFalse(ResultPayload.objects.exists())
+
+    def test_query_logs_use_log_database(self):
+        query_log = QueryLog.objects.create(excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={})
+        self.assertEqual(query_log._state.db, 'logs')
+        self.assertEqual(self.excel_file._state.db, 'default')
+
+    def test_deleting_file_deletes_its_logs(self):
+        QueryLog.objects.create(excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={})
+        self.excel_file.delete()
+        self.assertFalse(QueryLog.objects.exists())
+
+    def test_deleting_user_keeps_logs(self):
+        user = User.objects.create_user(username='viewer', password='secret')
+        query_log = QueryLog.objects.create(
+            user=user, excel_file=self.excel_file, sheet_name='Sheet1', filters_applied={}
+        )
+        user.delete()
+        query_log.refresh_from_db()
+        self.assertIsNone(query_log.user_id)
+
+    def test_analytics_counts_popular_files(self):
+        quiet = ExcelFile.objects.create(name="Quiet File")
+        for excel_file, count in ((self.excel_file, 2), (quiet, 1)):
+            for _ in range(count):
+                QueryLog.objects.create(excel_file=excel_file, sheet_name='Sheet1', filters_applied={})
+        response = Client().get(reverse('excel_processor:analytics'))
+        self.assertEqual(
+            [(f.name, f.query_count) for f in response.context['popular_files']],
+            [('Test File', 2), ('Quiet File', 1)]
+        )
+
+
+class CopyQueryLogsTest(TestCase):
+    """Test copying legacy query logs out of the default database"""
+
+    databases = {'default', 'logs'}
+
+    def create_legacy_table(self):
+        from django.db import connections
+        with connections['default'].cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE excel_processor_querylog (id integer PRIMARY KEY, user_id bigint NULL, '
+                'excel_file_id bigint NOT NULL, sheet_name varchar(255) NOT NULL, filters_applied text NOT NULL, '
+                'result_found bool NOT NULL, result_data text NULL, query_time datetime NOT NULL)'
+            )
+            cursor.executemany(
+                'INSERT INTO excel_processor_querylog VALUES (%s, NULL, 1, %s, %s, %s, %s, %s)',
+                [
+                    (1, 'Sheet1', '{"grade": "A"}', True, '{"total": 10}', '2025-01-02 03:04:05'),
+                    (2, 'Sheet1', '{"grade": "B"}', True, '{"total": 10}', '2025-01-02 03:04:06'),
+                    (3, 'Sheet2', '{}', False, None, '2025-01-02 03:04:07'),
+                ]
+            )
+
+    def test_legacy_rows_are_copied_with_their_results(self):
+        from .models import ResultPayload
+        self.create_legacy_table()
+        call_command('copy_query_logs', batch_size=2, stdout=io.StringIO())
+        logs = list(QueryLog.objects.order_by('id'))
+        self.assertEqual(
+            [(log.id, log.filters_applied, log.result_data) for log in logs],
+            [(1, {'grade': 'A'}, {'total': 10}), (2, {'grade': 'B'}, {'total': 10}), (3, {}, None)]
+        )
+        self.assertEqual(logs[0].query_time.year, 2025)
+        self.assertEqual(ResultPayload.objects.count(), 1)
+
+        # Rerunning copies nothing twice
+        call_command('copy_query_logs', stdout=io.StringIO())
+        self.assertEqual(QueryLog.objects.count(), 3)
+
+    def test_lookups_logged_before_the_copy_keep_their_rows(self):
+        self.create_legacy_table()
+        # The log database went live, and took id 1, before the copy ran
+        excel_file = ExcelFile.objects.create(name='Workbook')
+        QueryLog.objects.create(excel_file=excel_file, sheet_name='New', filters_applied={}, result_found=False)
+
+        output = io.StringIO()
+        call_command('copy_query_logs', batch_size=2, stdout=output)
+        self.assertIn('Copied 3 query log(s)', output.getvalue())
+        self.assertEqual(
+            list(QueryLog.objects.order_by('query_time').values_list('sheet_name', 'filters_applied')),
+            [('Sheet1', {'grade': 'A'}), ('Sheet1', {'grade': 'B'}), ('Sheet2', {}), ('New', {})]
+        )
+        self.assertEqual(QueryLog.objects.get(id=1).sheet_name, 'New')
+
+        # Rerunning, even from the start, copies nothing twice
+        call_command('copy_query_logs', stdout=io.StringIO())
+        self.assertEqual(QueryLog.objects.count(), 4)
+
+    def test_resumes_after_a_legacy_id(self):
+        self.create_legacy_table()
+        call_command('copy_query_logs', after_id=2, stdout=io.StringIO())
+        self.assertEqual(list(QueryLog.objects.values_list('id', flat=True)), [3])
+
+
+class ResultCompactionMigrationTest(TransactionTestCase):
+    """Test the migration moving QueryLog results into shared payloads"""
+
+    databases = {'default', 'logs'}
+    before = [('excel_processor', '0009_filtersummary')]
+    after = [('excel_processor', '0010_querylog_result_payloads')]
+
+    def migrate(self, targets):
+        from django.db import connections
+        from django.db.migrations.executor import MigrationExecutor
+        executor = MigrationExecutor(connections['logs'])
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        from django.db import connections
+        from django.db.migrations.executor import MigrationExecutor
+        executor = MigrationExecutor(connections['logs'])
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_existing_results_are_compacted(self):
+        old_apps = self.migrate(self.before)
+        OldQueryLog = old_apps.get_model('excel_processor', 'QueryLog')
+        for result in [{'total': 1}, {'total': 2}, {'total': 1}, None]:
+            OldQueryLog.objects.create(
+                excel_file_id=1, sheet_name='Sheet1', filters_applied={}, result_data=result
+            )
+
+        import importlib
+        migration = importlib.import_module('apps.excel_processor.migrations.0010_querylog_result_payloads')
+        with mock.patch.object(migration, 'BATCH_SIZE', 3):
+            new_apps = self.migrate(self.after)
+        NewQueryLog = new_apps.get_model('excel_processor', 'QueryLog')
+        ResultPayload = new_apps.get_model('excel_processor', 'ResultPayload')
+        self.assertEqual(ResultPayload.objects.count(), 2)
+        self.assertEqual(
+            [log.result.data if log.result_id else None for log in NewQueryLog.objects.order_by('id')],
+            [{'total': 1}, {'total': 2}, {'total': 1}, None]
+        )
+
+        # And back again
+        old_apps = self.migrate(self.before)
+        OldQueryLog = old_apps.get_model('excel_processor', 'QueryLog')
+        self.assertEqual(
+            [log.result_data for log in OldQueryLog.objects.order_by('id')],
+            [{'total': 1}, {'total': 2}, {'total': 1}, None]
+        )
+
+
+@override_settings(TYPEAHEAD_CARDINALITY_THRESHOLD=3, TYPEAHEAD_RESULT_LIMIT=5)
+class TypeaheadTest(WorkbookTestCase):
+    """Test typeahead search for high-cardinality filter columns"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'category': ['A', 'B', 'A', 'B', 'A', 'B'],
+                'sku': ['AB-100', 'ab-200', 'XAB-1', 'CD-300', 'CD-301', 'EF-1'],
+                'total': [1, 2, 3, 4, 5, 6],
+            })},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['category', 'sku'], 'result_columns': ['total']}}
+        )
+
+    def search(self, **params):
+        params.setdefault('file_id', self.excel_file.id)
+        params.setdefault('sheet_name', 'Sheet1')
+        params.setdefault('column', 'sku')
+        return self.client.get(reverse('excel_processor:search_values'), params)
+
+    def test_get_columns_switches_to_typeahead(self):
+        response = self.client.get(
+            reverse('excel_processor:get_columns'),
+            {'file_id': self.excel_file.id, 'sheet_name': 'Sheet1'}
+        )
+        data = json.loads(response.content)
+        self.assertEqual(data['columns']['category'], ['A', 'B'])
+        self.assertEqual(data['columns']['sku'], [])
+        self.assertEqual(data['typeahead_columns'], ['sku'])
+
+    def test_prefix_search_is_case_insensitive(self):
+        data = json.loads(self.search(q='ab').content)
+        self.assertEqual(sorted(data['values']), ['AB-100', 'ab-200'])
+
+    def test_contains_search_adds_substring_matches(self):
+        data = json.loads(self.search(q='ab', mode='contains').content)
+        self.assertEqual(data['values'][:2], ['AB-100', 'ab-200'])
+        self.assertEqual(data['values'][2:], ['XAB-1'])
+
+    def test_limit_is_capped(self):
+        data = json.loads(self.search(q='', limit=100).content)
+        self.assertEqual(len(data['values']), 5)
+
+    def test_rejects_non_filter_column(self):
+        self.assertEqual(self.search(column='total').status_code, 400)
+
+
+@override_settings(STREAMING_SCAN_ENABLED=False)
+class ProjectionTest(WorkbookTestCase):
+    """Test that only the configured columns of a sheet are loaded"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'category': ['A', 'B'],
+                'size': [10, 20],
+                'unused': ['x', 'y'],
+                'total': [100, 200],
+            })},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['category', 'size'], 'result_columns': ['total']}}
+        )
+
+    def test_get_columns_loads_filter_columns_only(self):
+        self.client.get(
+            reverse('excel_processor:get_columns'),
+            {'file_id': self.excel_file.id, 'sheet_name': 'Sheet1'}
+        )
+        sheet = sheet_cache.get_sheet(self.excel_file, 'Sheet1', columns=[])
+        self.assertEqual(set(sheet.data), {'category', 'size'})
+
+    def test_fetch_results_adds_result_columns(self):
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+        response = self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': {'category': 'B'}}),
+            content_type='application/json'
+        )
+        self.assertEqual(json.loads(response.content)['results'], {'total': 200.0})
+        sheet = sheet_cache.get_sheet(self.excel_file, 'Sheet1', columns=[])
+        self.assertEqual(set(sheet.data), {'category', 'size', 'total'})
+
+    def test_columns_are_served_from_snapshot(self):
+        sheet_cache.get_sheet(self.excel_file, 'Sheet1')
+        sheet_cache.clear()
+        with mock.patch('pandas.read_excel', side_effect=AssertionError('workbook parsed')):
+            sheet = sheet_cache.get_sheet(self.excel_file, 'Sheet1')
+        self.assertEqual(sheet.data['total'].tolist(), [100, 200])
+
+
+class NormalizeTest(TestCase):
+    """Test the comparison keys shared by ingest, dropdowns and lookups"""
+
+    def test_integral_numbers_and_text_agree(self):
+        self.assertEqual(normalize_value(100), '100')
+        self.assertEqual(normalize_value(100.0), '100')
+        self.assertEqual(normalize_value('100.0'), '100')
+        self.assertEqual(normalize_value(' 100 '), '100')
+        self.assertEqual(normalize_value(100.5), '100.5')
+
+    def test_blanks_are_none(self):
+        self.assertIsNone(normalize_value(None))
+        self.assertIsNone(normalize_value(float('nan')))
+        self.assertIsNone(normalize_value('   '))
+        self.assertIsNone(normalize_value(pd.NaT))
+
+    def test_leading_zeros_are_kept(self):
+        self.assertEqual(normalize_value('00123'), '00123')
+
+    def test_dates_drop_midnight(self):
+        self.assertEqual(normalize_value(pd.Timestamp('2024-01-31')), '2024-01-31')
+
+
+class NormalizedLookupTest(WorkbookTestCase):
+    """Test that dropdown values and lookups use the same normalized keys"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'size': [100, 100.5, None, 200],
+                'grade': [' A ', 'B', 'A', None],
+                'total': [1, 2, 3, 4],
+            })},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['size', 'grade'], 'result_columns': ['total']}}
+        )
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+
+    def test_dropdown_values_are_normalized(self):
+        response = self.client.get(
+            reverse('excel_processor:get_columns'),
+            {'file_id': self.excel_file.id, 'sheet_name': 'Sheet1'}
+        )
+        columns = json.loads(response.content)['columns']
+        self.assertEqual(columns['size'], ['100', '100.5', '200'])
+        self.assertEqual(columns['grade'], ['A', 'B'])
+
+    def test_lookup_matches_float_spelling_of_integer(self):
+        response = self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': {'size': '200.0'}}),
+            content_type='application/json'
+        )
+        self.assertEqual(json.loads(response.content)['results'], {'total': 4.0})
+
+
+class FilterOperatorTest(WorkbookTestCase):
+    """Test IN-list and numeric range filters in fetch_results"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'grade': ['A', 'B', 'C', 'A', 'B'],
+                'quantity': [50, 100, 250, 500, 1000],
+                'total': [1, 2, 3, 4, 5],
+            })},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade', 'quantity'], 'result_columns': ['total']}}
+        )
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+
+    def fetch(self, filters):
+        return self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': filters}),
+            content_type='application/json'
+        )
+
+    def total(self, filters):
+        data = json.loads(self.fetch(filters).content)
+        return data['results']['total'] if data.get('success') else None
+
+    def test_in_list(self):
+        self.assertEqual(self.total({'grade': ['C', 'B']}), 2.0)
+        self.assertEqual(self.total({'grade': {'in': ['C']}}), 3.0)
+
+    def test_range_is_inclusive(self):
+        self.assertEqual(self.total({'quantity': {'min': 100, 'max': 500}}), 2.0)
+        self.assertEqual(self.total({'quantity': {'min': '251'}}), 4.0)
+        self.assertIsNone(self.total({'quantity': {'max': 10}}))
+
+    def test_range_combined_with_in_list(self):
+        self.assertEqual(self.total({'grade': ['A'], 'quantity': {'min': 100}}), 4.0)
+
+    def test_invalid_filters_are_rejected(self):
+        self.assertEqual(self.fetch({'quantity': {'min': 'lots'}}).status_code, 400)
+        self.assertEqual(self.fetch({'quantity': {'min': 5, 'max': 1}}).status_code, 400)
+        self.assertEqual(self.fetch({'grade': {'like': 'A'}}).status_code, 400)
+        self.assertEqual(self.fetch(['A']).status_code, 400)
+
+
+@override_settings(STREAMING_SCAN_ENABLED=False)
+class LoadedFilterOperatorTest(FilterOperatorTest):
+    """Run the filter operator tests against a loaded sheet"""
+
+
+@override_settings(STREAMING_SCAN_ENABLED=False)
+class LoadedNormalizedLookupTest(NormalizedLookupTest):
+    """Run the normalized lookup tests against a loaded sheet"""
+
+
+class AggregateTest(WorkbookTestCase):
+    """Test group-by aggregation over filtered rows"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'category': ['A', 'B', 'A', 'B', None],
+                'quantity': [10, 20, 30, 40, 50],
+                'total': [1.5, 2.0, None, 4.0, 5.0],
+            })},
+            {'Sheet1': {
+                'is_enabled': True,
+                'filter_columns': ['category', 'quantity'],
+                'result_columns': ['total'],
+            }}
+        )
+
+    def aggregate(self, **payload):
+        payload.setdefault('file_id', self.excel_file.id)
+        payload.setdefault('sheet_name', 'Sheet1')
+        return self.client.post(
+            reverse('excel_processor:aggregate_results'),
+            json.dumps(payload),
+            content_type='application/json'
+        )
+
+    def test_group_by_category(self):
+        data = json.loads(self.aggregate(
+            group_by=['category'],
+            aggregates={'total': ['sum', 'count', 'min', 'max', 'mean']}
+        ).content)
+        groups = {group['group']['category']: group for group in data['groups']}
+        self.assertEqual(groups['A']['rows'], 2)
+        self.assertEqual(groups['A']['values']['total'], {'sum': 1.5, 'count': 1, 'min': 1.5, 'max': 1.5, 'mean': 1.5})
+        self.assertEqual(groups['B']['values']['total']['sum'], 6.0)
+        self.assertEqual(groups[None]['values']['total']['sum'], 5.0)
+
+    def test_filters_apply_before_grouping(self):
+        data = json.loads(self.aggregate(filters={'quantity': {'min': 20}}).content)
+        self.assertEqual(len(data['groups']), 1)
+        self.assertEqual(data['groups'][0]['rows'], 4)
+        self.assertEqual(data['groups'][0]['values']['total'], {'sum': 11.0, 'count': 3})
+
+    def test_removed_filter_column_is_ignored_by_warm_sheets(self):
+        data = json.loads(self.aggregate(filters={'category': 'A'}).content)
+        self.assertEqual(data['groups'][0]['rows'], 2)
+
+        # The loaded sheet still has the column's keys
+        self.excel_file.sheet_config['Sheet1']['filter_columns'] = ['quantity']
+        self.excel_file.save()
+        data = json.loads(self.aggregate(filters={'category': 'A'}).content)
+        self.assertEqual(data['applied_filters'], {})
+        self.assertEqual(data['groups'][0]['rows'], 5)
+
+    def test_results_are_memoized(self):
+        self.aggregate(group_by=['category'])
+        with mock.patch('apps.excel_processor.query.aggregate', side_effect=AssertionError('recomputed')):
+            response = self.aggregate(group_by=['category'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_rejects_unconfigured_columns(self):
+        self.assertEqual(self.aggregate(group_by=['missing']).status_code, 400)
+        self.assertEqual(self.aggregate(aggregates={'category': ['sum']}).status_code, 400)
+        self.assertEqual(self.aggregate(aggregates={'total': ['median']}).status_code, 400)
+
+
+class CrossSearchTest(WorkbookTestCase):
+    """Test searching one filter set across every product and sheet"""
+
+    def setUp(self):
+        super().setUp()
+        config = {'is_enabled': True, 'filter_columns': ['sku'], 'result_columns': ['total']}
+        self.first = self.create_excel_file(
+            {
+                'Pipes': pd.DataFrame({'sku': ['P-1', 'P-2'], 'total': [10, 20]}),
+                'Valves': pd.DataFrame({'sku': ['V-1', 'P-2'], 'total': [30, 40]}),
+                'Hidden': pd.DataFrame({'sku': ['P-2'], 'total': [50]}),
+            },
+            {'Pipes': config, 'Valves': config, 'Hidden': dict(config, is_enabled=False)},
+            name='First'
+        )
+        self.second = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'code': ['P-2'], 'total': [60]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['code'], 'result_columns': ['total']}},
+            name='Second'
+        )
+
+    def search(self, payload):
+        return self.client.post(
+            reverse('excel_processor:search_all_sheets'),
+            json.dumps(payload),
+            content_type='application/json'
+        )
+
+    def test_streams_matches_then_summary(self):
+        response = self.search({'filters': {'sku': 'P-2'}})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        summary = lines.pop()
+        self.assertEqual(summary, {'done': True, 'searched': 2, 'matches': 2, 'timed_out': False})
+        self.assertEqual(
+            sorted((line['sheet_name'], line['results']['total']) for line in lines),
+            [('Pipes', 20.0), ('Valves', 40.0)]
+        )
+
+    def test_time_budget_abandons_slow_sheets(self):
+        def slow_search(*args):
+            time.sleep(0.5)
+
+        with mock.patch('apps.excel_processor.cross_search._search_sheet', slow_search):
+            response = self.search({'filters': {'sku': 'P-2'}, 'time_budget': 0.1})
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[-1]['timed_out'], True)
+
+    def test_requires_a_filter(self):
+        self.assertEqual(self.search({'filters': {'sku': ''}}).status_code, 400)
+
+    def test_filters_must_be_configured_on_some_sheet(self):
+        response = self.search({'filters': {'sku': 'P-2', 'colour': 'red'}})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Not a filter column of any sheet: colour')
+        # Columns filterable only on a disabled sheet count as unknown too
+        self.first.sheet_config['Hidden']['filter_columns'] = ['sku', 'total']
+        self.first.save()
+        self.assertEqual(self.search({'filters': {'total': 50}}).status_code, 400)
+
+
+@override_settings(SQLITE_BACKEND_ROW_THRESHOLD=0)
+class SQLiteTypeaheadTest(TypeaheadTest):
+    """Run the typeahead tests against the SQLite backend"""
+
+
+@override_settings(SQLITE_BACKEND_ROW_THRESHOLD=0, STREAMING_SCAN_ENABLED=False)
+class SQLiteNormalizedLookupTest(NormalizedLookupTest):
+    """Run the normalized lookup tests against the SQLite backend"""
+
+
+@override_settings(SQLITE_BACKEND_ROW_THRESHOLD=0, STREAMING_SCAN_ENABLED=False)
+class SQLiteFilterOperatorTest(FilterOperatorTest):
+    """Run the filter operator tests against the SQLite backend"""
+
+    def test_sheet_is_served_from_sqlite(self):
+        from .sqlite_store import SQLiteSheet
+        self.assertIsInstance(sheet_cache.get_sheet(self.excel_file, 'Sheet1'), SQLiteSheet)
+
+
+@override_settings(SQLITE_BACKEND_ROW_THRESHOLD=0)
+class SQLiteAggregateTest(AggregateTest):
+    """Run the aggregation tests against the SQLite backend"""
+
+    def test_results_are_memoized(self):
+        self.aggregate(group_by=['category'])
+        sheet = sheet_cache.get_sheet(self.excel_file, 'Sheet1')
+        with mock.patch.object(type(sheet), 'aggregate', side_effect=AssertionError('recomputed')):
+            response = self.aggregate(group_by=['category'])
+        self.assertEqual(response.status_code, 200)
+
+
+class StreamingScanTest(WorkbookTestCase):
+    """Test lookups that scan the worksheet instead of loading it"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+
+    def fetch(self, excel_file, filters):
+        response = self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': excel_file.id, 'sheet_name': 'Sheet1', 'filters': filters}),
+            content_type='application/json'
+        )
+        return json.loads(response.content)
+
+    def test_unconfigured_sheet_filters_on_any_column(self):
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B', 'B'], 'size': [1, 2, 3], 'total': [10, 20, 30]})},
+            {}
+        )
+        with mock.patch('pandas.read_excel', side_effect=AssertionError('sheet loaded')):
+            data = self.fetch(excel_file, {'grade': 'B', 'size': {'min': 3}})
+        self.assertEqual(data['results'], {'total': 30.0})
+        self.load_in_background.assert_not_called()
+
+    def test_cold_configured_sheet_streams_and_loads_in_background(self):
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        data = self.fetch(excel_file, {'grade': 'B'})
+        self.assertEqual(data['results'], {'total': 20.0})
+        self.load_in_background.assert_called_once()
+
+        # Once loaded, lookups no longer scan the worksheet
+        sheet_cache.get_sheet(excel_file, 'Sheet1')
+        with mock.patch('apps.excel_processor.stream_scan.first_match', side_effect=AssertionError('scanned')):
+            self.assertEqual(self.fetch(excel_file, {'grade': 'A'})['results'], {'total': 10.0})
+
+    def test_no_match(self):
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A'], 'total': [10]})},
+            {}
+        )
+        self.assertFalse(self.fetch(excel_file, {'grade': 'Z'})['success'])
+
+    def test_cold_and_warm_lookups_agree(self):
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'A'], 'size': [1, 2], 'total': [10, 20]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        filters = {'grade': 'A', 'size': 2}
+        cold = self.fetch(excel_file, filters)
+        sheet_cache.get_sheet(excel_file, 'Sheet1')
+        with mock.patch('apps.excel_processor.stream_scan.first_match', side_effect=AssertionError('scanned')):
+            warm = self.fetch(excel_file, filters)
+        self.assertEqual(cold, warm)
+        self.assertEqual(cold['results'], {'total': 10.0})
+
+    def test_blank_rows_count_as_rows(self):
+        from . import sheet_queries, stream_scan
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': [None, 'A'], 'total': [None, 10]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        scanned = stream_scan.first_match(excel_file.file.path, 'Sheet1', {}, ['total'], ['grade', 'total'])
+        sheet_cache.get_sheet(excel_file, 'Sheet1')
+        with mock.patch.object(stream_scan, 'first_match', side_effect=AssertionError('scanned')):
+            loaded = sheet_queries.lookup(excel_file, 'Sheet1', {})
+        self.assertEqual(scanned, loaded)
+        self.assertEqual(scanned, ({}, {'total': None}))
+
+class PrewarmTest(WorkbookTestCase):
+    """Test loading popular sheets ahead of the first request"""
+
+    def setUp(self):
+        super().setUp()
+        config = {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}
+        sheets = {
+            name: pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]})
+            for name in ('Busy', 'Quiet', 'Unused')
+        }
+        self.excel_file = self.create_excel_file(sheets, {name: dict(config) for name in sheets})
+        for sheet_name, count in (('Busy', 3), ('Quiet', 1)):
+            for _ in range(count):
+                QueryLog.objects.create(excel_file=self.excel_file, sheet_name=sheet_name, filters_applied={})
+
+    def cached_sheets(self):
+        return sorted(sheet_name for _, sheet_name in sheet_cache._cache)
+
+    def test_popular_sheets_ranked_by_query_count(self):
+        from .prewarm import popular_sheets
+        self.assertEqual(popular_sheets(days=7, limit=10), [
+            (self.excel_file.id, 'Busy', 3),
+            (self.excel_file.id, 'Quiet', 1),
+        ])
+
+    def test_prewarm_loads_popular_sheets(self):
+        from .prewarm import prewarm
+        report = prewarm(days=7, limit=10, time_budget=60, memory_budget=1024 * 1024)
+        self.assertEqual([status for _, _, status in report], ['loaded', 'loaded'])
+        self.assertEqual(self.cached_sheets(), ['Busy', 'Quiet'])
+
+    def test_prewarm_stops_at_memory_budget(self):
+        from .prewarm import prewarm
+        report = prewarm(days=7, limit=10, time_budget=60, memory_budget=1)
+        self.assertEqual(report[-1][1:], ('Quiet', 'skipped: memory budget reached'))
+        self.assertEqual(self.cached_sheets(), ['Busy'])
+
+    def test_prewarm_skips_disabled_sheets(self):
+        from .prewarm import prewarm
+        self.excel_file.sheet_config['Busy']['is_enabled'] = False
+        self.excel_file.save()
+        prewarm(days=7, limit=10, time_budget=60, memory_budget=1024 * 1024)
+        self.assertEqual(self.cached_sheets(), ['Quiet'])
+
+    def test_management_command(self):
+        from django.core.management import call_command
+        output = io.StringIO()
+        call_command('prewarm_sheets', '--limit', '1', stdout=output)
+        self.assertIn('Busy: loaded', output.getvalue())
+        self.assertEqual(self.cached_sheets(), ['Busy'])
+
+
+class SingleFlightTest(WorkbookTestCase):
+    """Test that concurrent loads of one sheet run once"""
+
+    def run_concurrently(self, function, count=4):
+        import threading
+        results = [None] * count
+
+        def call(position):
+            try:
+                results[position] = function()
+            except Exception as e:
+                results[position] = e
+
+        threads = [threading.Thread(target=call, args=(position,)) for position in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def slow_load(self, calls, result=None, error=None):
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            if error is not None:
+                raise error
+            return result
+        return load
+
+    def test_waiters_share_one_load(self):
+        from .singleflight import do
+        calls = []
+        load = self.slow_load(calls, result='sheet')
+        self.assertEqual(self.run_concurrently(lambda: do('key', load)), ['sheet'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_reach_waiters(self):
+        from .singleflight import do
+        load = self.slow_load([], error=ValueError('bad workbook'))
+        results = self.run_concurrently(lambda: do('key', load))
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_waiters_time_out(self):
+        from .singleflight import LoadTimeout, do
+        load = self.slow_load([], result='sheet')
+        results = self.run_concurrently(lambda: do('key', load, timeout=0.01), count=2)
+        self.assertEqual(sorted(map(type, results), key=str), [LoadTimeout, str])
+
+    def test_concurrent_requests_parse_sheet_once(self):
+        excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        read_excel = pd.read_excel
+        with mock.patch('pandas.read_excel', side_effect=read_excel) as parse:
+            sheets = self.run_concurrently(lambda: sheet_cache.get_sheet(excel_file, 'Sheet1'))
+        self.assertTrue(all(sheet is sheets[0] for sheet in sheets))
+        # One header read, one column read
+        self.assertEqual(parse.call_count, 2)
+
+
+class ColumnCatalogTest(WorkbookTestCase):
+    """Test the column statistics computed at ingest and the indexes they choose"""
+
+    def test_column_stats(self):
+        from .ingest import sheet_catalog
+        catalog = sheet_catalog(pd.DataFrame({
+            'grade': ['A', 'B', 'A', None],
+            'quantity': [5, 1, 5, 9],
+        }))
+        self.assertEqual(catalog['row_count'], 4)
+        grade, quantity = catalog['stats']['grade'], catalog['stats']['quantity']
+        self.assertEqual((grade['dtype'], grade['null_count'], grade['distinct_count']), ('text', 1, 2))
+        self.assertEqual(grade['top_values'][0], ['A', 2])
+        self.assertEqual((quantity['dtype'], quantity['min'], quantity['max']), ('integer', 1, 9))
+
+    @override_settings(BITMAP_INDEX_MAX_DISTINCT=2)
+    def test_index_kind_follows_stats(self):
+        from .ingest import sheet_catalog
+        stats = sheet_catalog(pd.DataFrame({
+            'grade': ['A', 'B', 'A', 'B'],
+            'code': ['w', 'x', 'y', 'z'],
+            'quantity': [1, 2, 3, 4],
+        }))['stats']
+        self.assertEqual(
+            [stats[column]['index'] for column in ('grade', 'code', 'quantity')],
+            ['bitmap', 'hash', 'sorted']
+        )
+
+    def test_index_kinds_find_the_same_rows(self):
+        import numpy as np
+        keys = np.array(['b', 'a', None, 'b', 'c'], dtype=object)
+        for index_class in sheet_cache.KEY_INDEX_KINDS.values():
+            index = index_class(keys)
+            self.assertEqual(index.rows(['b']).tolist(), [0, 3], index_class.kind)
+            self.assertEqual(index.rows(['c', 'a', 'z']).tolist(), [1, 4], index_class.kind)
+            self.assertEqual(index.count(['b', 'z']), 2, index_class.kind)
+
+    def test_upload_stores_catalog(self):
+        admin = User.objects.create_user(username='admin', password='secret', is_staff=True)
+        self.client.force_login(admin)
+        upload = SimpleUploadedFile('Stock.xlsx', make_workbook({
+            'Sheet1': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]})
+        }))
+        self.client.post(reverse('excel_processor:upload_excel'), {'name': 'Stock', 'file': upload})
+        excel_file = ExcelFile.objects.get(name='Stock')
+        self.assertEqual(excel_file.column_info['Sheet1']['stats']['grade']['distinct_count'], 2)
+
+        response = self.client.get(reverse('excel_processor:configure_sheets', args=[excel_file.id]))
+        self.assertContains(response, 'grade (2 distinct)')
+
+
+@override_settings(STREAMING_SCAN_ENABLED=False, SLOW_QUERY_SAMPLE_RATE=0.0)
+class SlowQueryTest(WorkbookTestCase):
+    """Test that slow and sampled requests are recorded with their trace"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B', 'B'], 'total': [10, 20, 30]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+
+    def fetch(self, filters):
+        return self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': filters}),
+            content_type='application/json'
+        )
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+    def test_slow_request_is_recorded_with_trace(self):
+        from .models import SlowQuery
+        self.fetch({'grade': 'B'})
+        self.fetch({'grade': 'B'})
+        cold, warm = SlowQuery.objects.order_by('id')
+        self.assertEqual(cold.view_name, 'excel_processor:fetch_results')
+        self.assertEqual((cold.excel_file_id, cold.sheet_name, cold.filters), (self.excel_file.id, 'Sheet1', {'grade': 'B'}))
+        self.assertFalse(cold.cache_hit)
+        self.assertTrue(warm.cache_hit)
+        self.assertEqual(warm.rows_scanned, 2)
+        self.assertTrue({'load', 'filter', 'results', 'log'} <= set(warm.phases))
+        self.assertFalse(warm.sampled)
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=60000)
+    def test_fast_requests_are_skipped_unless_sampled(self):
+        from .models import SlowQuery
+        self.fetch({'grade': 'B'})
+        self.assertFalse(SlowQuery.objects.exists())
+        with override_settings(SLOW_QUERY_SAMPLE_RATE=1.0):
+            self.fetch({'grade': 'B'})
+        self.assertTrue(SlowQuery.objects.get().sampled)
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+    def test_untraced_views_are_skipped(self):
+        from .models import SlowQuery
+        self.client.get(reverse('excel_processor:get_sheets'), {'file_id': self.excel_file.id})
+        self.assertFalse(SlowQuery.objects.exists())
+
+
+class ProfilingTest(WorkbookTestCase):
+    """Test on-demand request profiling"""
+
+    def setUp(self):
+        super().setUp()
+        self.override = override_settings(PROFILE_DIR=os.path.join(self.media_root, 'profiles'))
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+
+    def test_staff_request_is_profiled(self):
+        from .models import RequestProfile
+        self.client.force_login(User.objects.create_user(username='admin', password='secret', is_staff=True))
+        response = self.client.get(reverse('excel_processor:analytics'), {'_profile': '1'})
+        request_profile = RequestProfile.objects.get()
+        self.assertEqual(response['X-Profile-Id'], str(request_profile.request_id))
+
+        detail = self.client.get(reverse('excel_processor:profile_detail', args=[request_profile.request_id]))
+        self.assertContains(detail, 'analytics')
+        download = self.client.get(reverse('excel_processor:profile_download', args=[request_profile.request_id]))
+        self.assertEqual(download['Content-Disposition'], f'attachment; filename="{request_profile.request_id}.prof"')
+
+    def test_non_staff_requests_are_not_profiled(self):
+        from .models import RequestProfile
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+        response = self.client.get(reverse('excel_processor:analytics'), HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+
+class ContentAddressedStorageTest(WorkbookTestCase):
+    """Test that identical uploads share one stored file and its parsed data"""
+
+    def setUp(self):
+        super().setUp()
+        sheets = {'Sheet1': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]})}
+        config = {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        self.first = self.create_excel_file(sheets, config, name='First')
+        self.second = self.create_excel_file(sheets, config, name='Second')
+
+    def test_identical_uploads_share_file_and_snapshots(self):
+        self.assertEqual(self.first.content_hash, self.second.content_hash)
+        self.assertEqual(self.first.file.name, self.second.file.name)
+        self.assertIn(self.first.content_hash, self.first.file.name)
+
+        sheet = sheet_cache.get_sheet(self.first, 'Sheet1')
+        self.assertIs(sheet_cache.get_sheet(self.second, 'Sheet1'), sheet)
+
+    def test_catalog_is_reused(self):
+        from .ingest import catalog_for
+        self.first.sheet_names, self.first.column_info = catalog_for(self.first)
+        self.first.save()
+        with mock.patch('apps.excel_processor.ingest.workbook_catalog', side_effect=AssertionError('parsed')):
+            sheet_names, column_info = catalog_for(self.second)
+        self.assertEqual((sheet_names, column_info), (self.first.sheet_names, self.first.column_info))
+
+    def test_file_is_deleted_with_last_reference(self):
+        path = self.first.file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            self.first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            ExcelFile.objects.filter(pk=self.second.pk).delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_replacing_file_releases_old_content(self):
+        path = self.first.file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second.delete()
+            self.first.file = SimpleUploadedFile('Other.xlsx', make_workbook({'Sheet1': pd.DataFrame({'x': [1]})}))
+            self.first.save()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(self.first.file.path))
+
+    def test_store_and_release_hold_the_content_lock(self):
+        from contextlib import contextmanager
+        from . import content_store
+        events = []
+
+        @contextmanager
+        def content_lock(storage, digest):
+            events.append(('lock', digest))
+            yield
+            events.append(('unlock', digest))
+
+        digest, storage = self.first.content_hash, self.first.file.storage
+        self.second.delete()
+        with mock.patch.object(content_store, 'content_lock', content_lock), \
+                mock.patch.object(storage, 'delete', side_effect=lambda name: events.append(('delete', name))):
+            self.first.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.first.delete()
+        # The reference check and the delete happen under the lock the store path takes
+        self.assertEqual(events, [
+            ('lock', digest), ('unlock', digest),
+            ('lock', digest), ('delete', self.first.file.name), ('unlock', digest),
+        ])
+
+
+class QueryLogAdminTest(TestCase):
+    """Test the cursor-paged QueryLog changelist"""
+
+    databases = {'default', 'logs'}
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'secret'))
+        excel_file = ExcelFile.objects.create(name="Test File")
+        for position in range(5):
+            QueryLog.objects.create(
+                excel_file=excel_file, sheet_name=f'Sheet{position}', filters_applied={'grade': position}
+            )
+
+    def changelist(self, url=None, **params):
+        from .admin import QueryLogAdmin
+        with mock.patch.object(QueryLogAdmin, 'list_per_page', 2):
+            return self.client.get(url or reverse('admin:excel_processor_querylog_changelist'), params)
+
+    def sheets(self, response):
+        return [log.sheet_name for log in response.context['cl'].result_list]
+
+    def test_cursor_pages_through_logs(self):
+        first = self.changelist()
+        self.assertEqual(self.sheets(first), ['Sheet4', 'Sheet3'])
+        self.assertIsNone(first.context['cl'].newer_url)
+
+        url = reverse('admin:excel_processor_querylog_changelist')
+        second = self.changelist(url + first.context['cl'].older_url)
+        self.assertEqual(self.sheets(second), ['Sheet2', 'Sheet1'])
+        third = self.changelist(url + second.context['cl'].older_url)
+        self.assertEqual(self.sheets(third), ['Sheet0'])
+        self.assertIsNone(third.context['cl'].older_url)
+
+        back = self.changelist(url + third.context['cl'].newer_url)
+        self.assertEqual(self.sheets(back), ['Sheet2', 'Sheet1'])
+
+    @override_settings(QUERYLOG_ADMIN_COUNT_LIMIT=3)
+    def test_count_is_capped(self):
+        response = self.changelist()
+        self.assertTrue(response.context['cl'].count_capped)
+        self.assertContains(response, '3+ Query Logs')
+
+
+class ClientDatasetTest(WorkbookTestCase):
+    """Test the compressed sheet payloads served for filtering in the browser"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'category': ['A', 'B', 'A', None],
+                'grade': [1, 2, 2, 1],
+                'total': [10.5, 20, 30, None],
+                'product_code': ['P1', 'P2', 'P3', 'P4'],
+            })},
+            {'Sheet1': {
+                'is_enabled': True,
+                'filter_columns': ['category', 'grade'],
+                'result_columns': ['product_code', 'total'],
+            }}
+        )
+
+    def dataset_url(self):
+        response = self.client.get(
+            reverse('excel_processor:get_columns'),
+            {'file_id': self.excel_file.id, 'sheet_name': 'Sheet1'}
+        )
+        return json.loads(response.content)['dataset_url']
+
+    def test_payload_is_dictionary_encoded(self):
+        response = self.client.get(self.dataset_url(), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        import gzip
+        payload = json.loads(gzip.decompress(response.content))
+        self.assertEqual(payload['row_count'], 4)
+        category = payload['columns']['category']
+        self.assertEqual(category['values'], ['A', 'B', None])
+        self.assertEqual(category['codes'], [0, 1, 0, 2])
+        self.assertEqual(payload['columns']['grade']['values'], ['1', '2'])
+        self.assertEqual(payload['result_columns'], ['total', 'product_code'])
+        total = payload['results'][0]
+        self.assertEqual([total['values'][code] for code in total['codes']], [10.5, 20.0, 30.0, None])
+
+    def test_uncompressed_without_accept_encoding(self):
+        response = self.client.get(self.dataset_url(), HTTP_ACCEPT_ENCODING='')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content)['row_count'], 4)
+
+    def test_version_follows_sheet_config(self):
+        url = self.dataset_url()
+        self.excel_file.sheet_config['Sheet1']['result_columns'] = ['total']
+        self.excel_file.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertNotEqual(self.dataset_url(), url)
+
+    @override_settings(CLIENT_DATASET_MAX_ROWS=3)
+    def test_large_sheets_use_the_api(self):
+        self.assertIsNone(self.dataset_url())
+
+    @override_settings(CLIENT_DATASET_MAX_BYTES=10)
+    def test_oversized_payloads_use_the_api(self):
+        self.assertIsNone(self.dataset_url())
+
+    def log_query(self, results=None):
+        return self.client.post(
+            reverse('excel_processor:log_query'),
+            json.dumps({
+                'file_id': self.excel_file.id,
+                'sheet_name': 'Sheet1',
+                'filters': {'category': 'B', 'unknown': 'x'},
+                'results': results,
+            }),
+            content_type='application/json'
+        )
+
+    def test_log_query_records_local_lookup(self):
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+        # Posted results are ignored in favour of the server's own lookup
+        response = self.log_query({'total': 99, 'product_code': 'FAKE'})
+        self.assertEqual(response.status_code, 204)
+        log = QueryLog.objects.get()
+        self.assertEqual(log.filters_applied, {'category': 'B'})
+        self.assertEqual(log.result_data, {'total': 20.0, 'product_code': 'P2'})
+        self.assertTrue(log.result_found)
+        self.assertEqual(log.user.username, 'viewer')
+
+    def test_log_query_requires_a_session(self):
+        response = self.log_query({'total': 20.0, 'product_code': 'P2'})
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(QueryLog.objects.exists())
+
+    def test_log_query_enforces_csrf(self):
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+        self.assertEqual(self.log_query().status_code, 403)
+        self.assertFalse(QueryLog.objects.exists())
+
+
+class QueryServerTest(WorkbookTestCase):
+    """Test routing sheet operations to sharded query servers"""
+
+    def setUp(self):
+        super().setUp()
+        from . import query_servers
+        self.query_servers = query_servers
+        query_servers._down.clear()
+        self.addCleanup(query_servers._down.clear)
+        # The test database connection must stay open across handled messages
+        patcher = mock.patch.object(query_servers, 'close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({
+                'category': ['A', 'B'],
+                'total': [10, 20],
+            })},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['category'], 'result_columns': ['total']}}
+        )
+
+    def test_ring_moves_few_keys_when_a_server_is_added(self):
+        keys = [f'{file_id}:Sheet1' for file_id in range(1000)]
+        before = self.query_servers.HashRing(['a', 'b', 'c'])
+        after = self.query_servers.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.owner(key) != after.owner(key)]
+        self.assertTrue(all(after.owner(key) == 'd' for key in moved))
+        self.assertLess(len(moved), 400)
+        self.assertEqual(len(set(before.owner(key) for key in keys)), 3)
+
+    @override_settings(QUERY_SERVERS=['127.0.0.1:7101', '127.0.0.1:7102'])
+    def test_lookup_is_forwarded_to_the_owner(self):
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+        calls = []
+
+        def call(address, message):
+            calls.append(address)
+            return self.query_servers.handle(message)
+
+        with mock.patch.object(self.query_servers, '_call', side_effect=call):
+            response = self.client.post(
+                reverse('excel_processor:fetch_results'),
+                json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': {'category': 'B'}}),
+                content_type='application/json'
+            )
+            bad = self.client.post(
+                reverse('excel_processor:fetch_results'),
+                json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1',
+                            'filters': {'category': {'min': 'x'}}}),
+                content_type='application/json'
+            )
+        self.assertEqual(json.loads(response.content)['results'], {'total': 20.0})
+        self.assertEqual(bad.status_code, 400)
+        owner = self.query_servers.ring(('127.0.0.1:7101', '127.0.0.1:7102')).owner(f'{self.excel_file.id}:Sheet1')
+        self.assertEqual(calls, [owner, owner])
+
+    def test_unreachable_servers_fall_back_to_this_process(self):
+        address = os.path.join(self.media_root, 'missing.sock')
+        with override_settings(QUERY_SERVERS=[address]):
+            results = self.query_servers.run('first_match', self.excel_file, 'Sheet1', filters={'category': 'A'})
+            self.assertTrue(self.query_servers._is_down(address))
+        self.assertEqual(results, {'total': 10.0})
+
+    def test_socket_round_trip(self):
+        import socket
+        import threading
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            address = f'127.0.0.1:{probe.getsockname()[1]}'
+        with mock.patch.object(self.query_servers, 'handle', lambda message: ('ok', message[0], None)):
+            threading.Thread(target=self.query_servers.serve, args=(address,), daemon=True).start()
+            time.sleep(0.2)
+            with override_settings(QUERY_SERVERS=[address]):
+                self.assertEqual(self.query_servers.run('lookup', self.excel_file, 'Sheet1'), 'lookup')
+                self.assertFalse(self.query_servers._is_down(address))
+
+
+class ParallelIngestTest(WorkbookTestCase):
+    """Test cataloging and snapshotting a workbook's sheets in worker processes"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {
+                'North': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]}),
+                'South': pd.DataFrame({'grade': ['C', None], 'total': [1.5, 2]}),
+                'East': pd.DataFrame({'code': [1, 2, 3]}),
+            },
+            {'North': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+
+    @override_settings(INGEST_WORKERS=2)
+    def test_pool_matches_inline_catalog(self):
+        from . import ingest
+        sheet_names, column_info = ingest.catalog_for(self.excel_file)
+        self.assertEqual(sheet_names, ['North', 'South', 'East'])
+        with override_settings(INGEST_WORKERS=1):
+            self.assertEqual(ingest.workbook_catalog(self.excel_file.file.path), (sheet_names, column_info))
+        self.assertEqual(column_info['South']['stats']['grade']['null_count'], 1)
+
+        # The workers' snapshots serve the first lookup without parsing the workbook
+        with mock.patch('pandas.read_excel', side_effect=AssertionError('workbook parsed')):
+            sheet = sheet_cache.get_sheet(self.excel_file, 'North')
+            self.assertEqual(sheet.distinct_values('grade'), ['A', 'B'])
+
+    def test_workers_do_not_fork_the_caller(self):
+        from . import ingest
+        self.assertIn(ingest._pool_context().get_start_method(), ('forkserver', 'spawn'))
+
+    @override_settings(INGEST_WORKERS=1)
+    def test_failed_sheet_is_isolated(self):
+        from . import ingest
+        real_ingest = ingest.ingest_sheet
+
+        def ingest_sheet(path, sheet_name, fingerprint=None):
+            if sheet_name == 'South':
+                raise ValueError('corrupt sheet')
+            return real_ingest(path, sheet_name, fingerprint)
+
+        with mock.patch.object(ingest, 'ingest_sheet', side_effect=ingest_sheet):
+            sheet_names, column_info = ingest.catalog_for(self.excel_file)
+        self.assertEqual(ingest.failed_sheets(column_info), {'South': 'corrupt sheet'})
+        self.assertEqual(column_info['North']['columns'], ['grade', 'total'])
+        self.assertFalse(ingest.is_cataloged(column_info, sheet_names))
+
+
+class ImportBudgetTest(TestCase):
+    """Test that serving lookups does not import pandas or openpyxl"""
+
+    # Seconds for Django setup plus the app's views, URLs and admin. Wall
+    # time depends on the machine, so it is only checked when set
+    IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET') or 0)
+
+    def test_lookup_runtime_imports_stay_lean(self):
+        import subprocess
+        import sys
+        from django.conf import settings
+        script = (
+            'import sys, time\n'
+            'started = time.perf_counter()\n'
+            'import django\n'
+            'django.setup()\n'
+            'from django.contrib import admin\n'
+            'admin.autodiscover()\n'
+            'import apps.excel_processor.urls, apps.excel_processor.query_servers\n'
+            'elapsed = time.perf_counter() - started\n'
+            'print(elapsed, *[name for name in ("pandas", "openpyxl") if name in sys.modules])\n'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=settings.BASE_DIR,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE='excel_analyzer.settings'),
+            capture_output=True, text=True, check=True
+        ).stdout.split()
+        self.assertEqual(output[1:], [])
+        if self.IMPORT_TIME_BUDGET:
+            elapsed = float(output[0])
+            self.assertLess(elapsed, self.IMPORT_TIME_BUDGET, f'Imports took {elapsed:.2f}s')
+
+    def test_snapshot_values_are_plain_python(self):
+        import datetime
+        values = sheet_cache.column_values(pd.Series([pd.Timestamp('2024-01-02 03:04'), pd.NaT, 'A'], dtype=object))
+        self.assertIs(type(values[0]), datetime.datetime)
+        self.assertEqual(values.tolist()[1:], [None, 'A'])
+        self.assertEqual(normalize_value(values[0]), '2024-01-02 03:04:00')
+
+
+class PreflightTest(WorkbookTestCase):
+    """Test the upload checks made from the zip directory before parsing"""
+
+    def workbook(self):
+        return make_workbook({'Sheet1': pd.DataFrame({'grade': ['A', 'B', 'C'], 'total': [1, 2, 3]})})
+
+    def upload(self, content):
+        admin = User.objects.create_user(username='admin', password='secret', is_staff=True)
+        self.client.force_login(admin)
+        upload = SimpleUploadedFile('Stock.xlsx', content)
+        return self.client.post(reverse('excel_processor:upload_excel'), {'name': 'Stock', 'file': upload})
+
+    def test_inspection_reads_dimensions(self):
+        from . import preflight
+        inspection = preflight.inspect(io.BytesIO(self.workbook()))
+        self.assertEqual(inspection.sheets['Sheet1'], {'rows': 4, 'columns': 2, 'cells': 8})
+        self.assertTrue(inspection.parse_inline)
+        self.assertIsNone(preflight.inspect(io.BytesIO(b'not a zip')))
+
+    @override_settings(PREFLIGHT_MAX_COLUMNS=1)
+    def test_declared_size_over_limit_is_rejected(self):
+        from . import preflight
+        with self.assertRaisesMessage(preflight.PreflightError, 'declares 2 columns'):
+            preflight.inspect(io.BytesIO(self.workbook()))
+
+        with mock.patch('apps.excel_processor.ingest.workbook_catalog', side_effect=AssertionError('parsed')):
+            self.upload(self.workbook())
+        self.assertFalse(ExcelFile.objects.exists())
+
+    def test_highly_compressed_part_is_rejected(self):
+        import zipfile
+        from . import preflight
+        buffer = io.BytesIO(self.workbook())
+        with zipfile.ZipFile(buffer, 'a', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('xl/media/padding.bin', b'\0' * (4 * 1024 * 1024))
+        with self.assertRaisesMessage(preflight.PreflightError, 'xl/media/padding.bin'):
+            preflight.inspect(buffer)
+
+    @override_settings(PREFLIGHT_INLINE_MEMORY_BUDGET=0)
+    def test_costly_workbook_is_cataloged_out_of_band(self):
+        from . import ingest
+        with mock.patch.object(ingest, 'catalog_out_of_band') as out_of_band, \
+                mock.patch.object(ingest, 'workbook_catalog', side_effect=AssertionError('parsed inline')):
+            self.upload(self.workbook())
+        excel_file = ExcelFile.objects.get(name='Stock')
+        out_of_band.assert_called_once_with(excel_file)
+        self.assertEqual(excel_file.sheet_names, ['Sheet1'])
+        self.assertEqual(excel_file.column_info, {})
+
+        ingest._catalog_deferred(excel_file.id)
+        excel_file.refresh_from_db()
+        self.assertEqual(excel_file.column_info['Sheet1']['row_count'], 3)
+
+    @override_settings(PREFLIGHT_INLINE_MEMORY_BUDGET=0)
+    def test_failed_deferred_ingest_is_stored_and_retried(self):
+        from . import ingest
+        with mock.patch.object(ingest, 'catalog_out_of_band'):
+            self.upload(self.workbook())
+        excel_file = ExcelFile.objects.get(name='Stock')
+
+        with mock.patch.object(ingest.threading, 'Thread'):
+            ingest.catalog_out_of_band(excel_file)
+        excel_file.refresh_from_db()
+        self.assertTrue(ingest.is_catalog_pending(excel_file.column_info, ['Sheet1']))
+
+        with mock.patch.object(ingest, 'workbook_catalog', side_effect=RuntimeError('pool broke')), \
+                self.assertLogs('apps.excel_processor.ingest', 'ERROR'):
+            ingest._catalog_deferred(excel_file.id)
+        excel_file.refresh_from_db()
+        self.assertEqual(ingest.failed_sheets(excel_file.column_info), {'Sheet1': 'pool broke'})
+        self.assertFalse(ingest.is_catalog_pending(excel_file.column_info, ['Sheet1']))
+
+        # The configure page reports the failure and sends the workbook back out of band
+        with mock.patch.object(ingest, 'catalog_out_of_band') as out_of_band:
+            response = self.client.get(reverse('excel_processor:configure_sheets', args=[excel_file.id]))
+        out_of_band.assert_called_once_with(excel_file)
+        self.assertIn('Could not read sheet Sheet1: pool broke', [str(m) for m in response.context['messages']])
+
+        call_command('catalog_workbooks', stdout=io.StringIO())
+        excel_file.refresh_from_db()
+        self.assertEqual(excel_file.column_info['Sheet1']['row_count'], 3)
+        self.assertEqual(ingest.failed_sheets(excel_file.column_info), {})
+
+
+class HeavyHitterTest(WorkbookTestCase):
+    """Test streaming counts of popular filter combinations"""
+
+    def setUp(self):
+        super().setUp()
+        from . import heavy_hitters
+        self.heavy_hitters = heavy_hitters
+        heavy_hitters._take_pending()  # Counts left by other tests
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B', 'C'], 'total': [10, 20, 30]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        self.client.force_login(User.objects.create_user(username='viewer', password='secret'))
+
+    def fetch(self, grade):
+        return self.client.post(
+            reverse('excel_processor:fetch_results'),
+            json.dumps({'file_id': self.excel_file.id, 'sheet_name': 'Sheet1', 'filters': {'grade': grade}}),
+            content_type='application/json'
+        )
+
+    def test_summary_keeps_frequent_keys_within_capacity(self):
+        # Keys seen more than total / capacity (18) times are always kept
+        summary = self.heavy_hitters.SpaceSaving(capacity=10)
+        for key in ['a'] * 50 + ['b'] * 30 + [f'rare{i}' for i in range(100)]:
+            summary.offer(key)
+        self.assertEqual(len(summary), 10)
+        self.assertEqual(summary.total, 180)
+        counts = {key: (count, error) for key, count, error in summary.top()}
+        for key, true_count in [('a', 50), ('b', 30)]:
+            count, error = counts[key]
+            self.assertTrue(count - error <= true_count <= count, key)
+
+    def test_merged_summaries_match_combined_stream(self):
+        left = self.heavy_hitters.SpaceSaving(capacity=4)
+        right = self.heavy_hitters.SpaceSaving(capacity=4)
+        for key in ['a'] * 20 + ['b'] * 5 + ['c', 'd', 'e']:
+            left.offer(key)
+        for key in ['a'] * 10 + ['f'] * 15:
+            right.offer(key)
+        merged = left.merge(right)
+        self.assertEqual(merged.total, 53)
+        self.assertEqual([key for key, _, _ in merged.top(2)], ['a', 'f'])
+        for key, count, error in merged.top():
+            true_count = {'a': 30, 'b': 5, 'f': 15}.get(key, 1)
+            self.assertTrue(count - error <= true_count <= count, key)
+
+    @override_settings(HEAVY_HITTER_FLUSH_INTERVAL=3600)
+    def test_lookups_are_counted_and_flushed(self):
+        from .models import FilterSummary
+        for grade in ['B', 'B', 'B', 'A', 'Z']:
+            self.fetch(grade)
+        self.assertFalse(FilterSummary.objects.exists())
+
+        self.heavy_hitters.flush()
+        self.fetch('A')
+        combinations, total = self.heavy_hitters.top()
+        self.assertEqual(total, 6)
+        self.assertEqual(
+            [(c['filters'], c['count']) for c in combinations],
+            [({'grade': 'B'}, 3), ({'grade': 'A'}, 2), ({'grade': 'Z'}, 1)]
+        )
+        self.assertEqual(FilterSummary.objects.get().total, 5)
+
+    @override_settings(HEAVY_HITTER_FLUSH_INTERVAL=3600)
+    def test_locked_database_keeps_counts_for_the_next_flush(self):
+        from django.db import OperationalError
+        from .models import FilterSummary
+        self.fetch('B')
+        manager = FilterSummary.objects
+
+        # A lock that clears is retried within the flush
+        locked = mock.Mock(side_effect=[OperationalError('database is locked'), manager.select_for_update()])
+        with mock.patch.object(manager, 'select_for_update', locked), \
+                mock.patch.object(self.heavy_hitters, 'STORE_RETRY_DELAY', 0):
+            self.heavy_hitters.flush()
+        self.assertEqual(FilterSummary.objects.get().total, 1)
+
+        # One that does not leaves the counts pending
+        self.fetch('B')
+        locked.side_effect = OperationalError('database is locked')
+        with mock.patch.object(manager, 'select_for_update', locked), \
+                mock.patch.object(self.heavy_hitters, 'STORE_RETRY_DELAY', 0), \
+                self.assertLogs('apps.excel_processor.heavy_hitters', 'ERROR'):
+            self.heavy_hitters.flush()
+        self.assertEqual(FilterSummary.objects.get().total, 1)
+        self.heavy_hitters.flush()
+        self.assertEqual(FilterSummary.objects.get().total, 2)
+
+    @override_settings(HEAVY_HITTER_FLUSH_INTERVAL=3600)
+    def test_deleted_files_are_dropped(self):
+        other = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A'], 'total': [1]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}},
+            name='Other'
+        )
+        self.fetch('A')
+        self.heavy_hitters.flush()
+        self.fetch('B')
+        self.heavy_hitters.record(other.id, 'Sheet1', {'grade': 'A'})
+
+        self.excel_file.delete()
+        combinations, total = self.heavy_hitters.top()
+        self.assertEqual([c['file_id'] for c in combinations], [other.id])
+        self.assertEqual(total, 3)
+
+    def test_api_and_analytics_list_combinations(self):
+        for grade in ['C', 'C', 'A']:
+            self.fetch(grade)
+        response = self.client.get(reverse('excel_processor:popular_filters'), {'limit': 1})
+        data = response.json()
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['combinations'], [{
+            'file_id': self.excel_file.id, 'file_name': 'Workbook', 'sheet_name': 'Sheet1',
+            'filters': {'grade': 'C'}, 'count': 2, 'error': 0,
+        }])
+        self.assertEqual(self.client.get(reverse('excel_processor:popular_filters'), {'limit': 'x'}).status_code, 400)
+
+        response = self.client.get(reverse('excel_processor:analytics'))
+        self.assertContains(response, 'grade: C')
+
+
+class LoadTestCommandTest(LiveServerTestCase):
+    """Test the load-testing command against a live server"""
+
+    databases = {'default', 'logs'}
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            SHEET_SNAPSHOT_DIR=os.path.join(self.media_root, 'snapshots')
+        )
+        self.settings_override.enable()
+        sheet_cache.clear()
+
+    def tearDown(self):
+        sheet_cache.clear()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_percentiles_and_skew(self):
+        from .management.commands.load_test import percentile, skewed_weights
+        values = list(range(1, 101))
+        self.assertEqual((percentile(values, 0.5), percentile(values, 0.99), percentile(values, 1.0)), (50, 99, 100))
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(skewed_weights(3, 0), [1, 1, 1])
+        self.assertEqual(skewed_weights(3, 1), [1, 1 / 2, 1 / 3])
+
+    def test_sessions_are_replayed_and_reported(self):
+        from django.core.management import call_command
+        output = io.StringIO()
+        # One client: the live server's threads share a single in-memory SQLite
+        # connection, where overlapping transactions fail in ways real ones don't
+        call_command(
+            'load_test', url=self.live_server_url, duration=1.5, interval=1, concurrency=1,
+            users=2, workbooks=1, sheets=1, rows=30, stdout=output
+        )
+        report = output.getvalue()
+        for endpoint in ('get_sheets', 'get_columns', 'fetch_results'):
+            self.assertRegex(report, rf'{endpoint}\s+[1-9]')
+        self.assertIn('0.0% errors, 0 database-lock error(s)', report)
+        # Users, workbooks and their logs are removed afterwards
+        self.assertFalse(QueryLog.objects.exists())
+        self.assertFalse(ExcelFile.objects.exists())
+        self.assertFalse(User.objects.filter(username__startswith='loadtest-').exists())
+
+
+class SheetVersionTest(WorkbookTestCase):
+    """Test version bumps on ExcelFile writes and the version-keyed shared cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.excel_file = self.create_excel_file(
+            {'Sheet1': pd.DataFrame({'grade': ['A', 'B'], 'total': [10, 20]}),
+             'Sheet2': pd.DataFrame({'grade': ['C'], 'total': [30]})},
+            {'Sheet1': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']},
+             'Sheet2': {'is_enabled': True, 'filter_columns': ['grade'], 'result_columns': ['total']}}
+        )
+        self.admin = User.objects.create_user(username='admin', password='secret', is_staff=True)
+        self.client.force_login(self.admin)
+
+    def refreshed(self):
+        return ExcelFile.objects.get(pk=self.excel_file.pk)
+
+    def test_config_changes_bump_only_changed_sheets(self):
+        self.assertEqual((self.excel_file.version, self.excel_file.sheet_version('Sheet1')), (1, 0))
+
+        self.excel_file.description = 'Not cached anywhere'
+        self.excel_file.save()
+        self.assertEqual(self.refreshed().version, 1)
+
+        self.client.post(reverse('excel_processor:configure_sheets', args=[self.excel_file.id]), {
+            'sheet_name': 'Sheet1', 'is_enabled': 'true',
+            'filter_columns[]': ['grade'], 'result_columns[]': ['total', 'grade'],
+        })
+        excel_file = self.refreshed()
+        self.assertEqual(excel_file.version, 2)
+        self.assertEqual((excel_file.sheet_version('Sheet1'), excel_file.sheet_version('Sheet2')), (2, 0))
+
+        self.client.post(reverse('excel_processor:toggle_excel'), {'excel_id': self.excel_file.id})
+        excel_file = self.refreshed()
+        self.assertEqual((excel_file.version, excel_file.sheet_version('Sheet1')), (3, 2))
+
+    def test_replacing_workbook_bumps_every_sheet(self):
+        self.excel_file.file = SimpleUploadedFile('new.xlsx', make_workbook({
+            'Sheet1': pd.DataFrame({'grade': ['A'], 'total': [99]}),
+            'Sheet2': pd.DataFrame({'grade': ['C'], 'total': [30]}),
+        }))
+        self.excel_file.save()
+        self.assertEqual(self.excel_file.version, 2)
+        self.assertEqual(self.excel_file.sheet_versions, {'Sheet1': 2, 'Sheet2': 2})
+
+    def test_stale_copy_cannot_roll_versions_back(self):
+        stale = self.refreshed()
+        self.excel_file.sheet_config = dict(self.excel_file.sheet_config, Sheet2={'is_enabled': False})
+        self.excel_file.save()
+        stale.is_active = False
+        stale.save()
+        excel_file = self.refreshed()
+        self.assertEqual(excel_file.version, 3)
+        self.assertEqual(excel_file.sheet_version('Sheet2'), 3)
+
+    def test_previous_state_is_read_inside_the_transaction(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.excel_file.save()
+        statements = [query['sql'] for query in queries]
+        self.assertTrue(statements[0].startswith('SAVEPOINT'))
+        # The lock-taking write comes before the read
+        self.assertTrue(statements[1].startswith('UPDATE'))
+        self.assertIn('"sheet_config"', statements[2])
+
+    def test_shared_cache_is_invalidated_by_version(self):
+        from . import query_servers, shared_cache
+        cache_dir = os.path.join(self.media_root, 'shared_cache')
+
+        def lookup(excel_file):
+            return query_servers.run('lookup', excel_file, 'Sheet1', filters={'grade': 'B'})
+
+        with override_settings(SHARED_CACHE_DIR=cache_dir, STREAMING_SCAN_ENABLED=False):
+            self.assertEqual(lookup(self.excel_file), ({'grade': 'B'}, {'total': 20.0}))
+            # Another process on the host shares the directory, not the loaded sheet
+            sheet_cache.clear()
+            with mock.patch.object(shared_cache, '_backend', None), \
+                    mock.patch.object(sheet_cache, 'get_sheet', side_effect=AssertionError('not cached')):
+                self.assertEqual(lookup(self.refreshed()), ({'grade': 'B'}, {'total': 20.0}))
+
+            self.excel_file.sheet_config['Sheet1']['result_columns'] = ['total', 'grade']
+            self.excel_file.save()
+            self.assertEqual(lookup(self.refreshed()), ({'grade': 'B'}, {'total': 20.0, 'grade': 'B'}))
+
+        # Without a directory nothing is shared
+        self.assertIsNone(shared_cache.backend())
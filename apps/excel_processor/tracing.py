@@ -0,0 +1,151 @@
+"""Per-request traces, kept as SlowQuery records when a request is slow or sampled
+
+SlowQueryMiddleware starts a trace for every request to a view listed in
+SLOW_QUERY_VIEWS. Code along the way times its phases with `phase` and
+adds details with `annotate`; the trace is saved only when the request
+took longer than SLOW_QUERY_THRESHOLD_MS, or was picked by
+SLOW_QUERY_SAMPLE_RATE. Outside a traced request every call is a no-op.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.fields = {}
+        self.rows_scanned = None
+
+
+def current():
+    """The trace of the request this thread is serving, or None"""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def phase(name):
+    """Time a block of work as one phase of the current request"""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        trace.phases[name] = trace.phases.get(name, 0.0) + elapsed
+
+
+def annotate(**fields):
+    """Record details of the current request: excel_file, sheet_name, filters, cache_hit"""
+    trace = current()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def add_rows_scanned(count):
+    trace = current()
+    if trace is not None:
+        trace.rows_scanned = (trace.rows_scanned or 0) + int(count)
+
+
+@contextmanager
+def collect():
+    """Trace a block of work outside a request (e.g. in a query server), yielding the Trace"""
+    previous = current()
+    _local.trace = trace = Trace()
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def summary(trace):
+    """The parts of a trace that can be sent to another process"""
+    return {
+        'phases': trace.phases,
+        'cache_hit': trace.fields.get('cache_hit'),
+        'rows_scanned': trace.rows_scanned,
+    }
+
+
+def merge(summary):
+    """Add a trace summary from another process to the current trace"""
+    trace = current()
+    if trace is None or not summary:
+        return
+    for name, elapsed in summary['phases'].items():
+        trace.phases[name] = trace.phases.get(name, 0.0) + elapsed
+    if summary['cache_hit'] is not None:
+        trace.fields['cache_hit'] = summary['cache_hit']
+    if summary['rows_scanned'] is not None:
+        add_rows_scanned(summary['rows_scanned'])
+
+
+def _is_traced(resolver_match):
+    if resolver_match is None:
+        return False
+    names = settings.SLOW_QUERY_VIEWS
+    # A bare namespace such as 'admin' traces every view in it
+    return resolver_match.view_name in names or any(
+        namespace in names for namespace in resolver_match.namespaces
+    )
+
+
+class SlowQueryMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.trace = trace = Trace()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.trace = None
+
+        duration = (time.perf_counter() - trace.started) * 1000
+        if not _is_traced(getattr(request, 'resolver_match', None)):
+            return response
+
+        slow = duration >= settings.SLOW_QUERY_THRESHOLD_MS
+        sampled = not slow and random.random() < settings.SLOW_QUERY_SAMPLE_RATE
+        if slow or sampled:
+            self.record(request, response, trace, duration, sampled)
+        return response
+
+    def record(self, request, response, trace, duration, sampled):
+        from .models import SlowQuery
+
+        user = getattr(request, 'user', None)
+        excel_file = trace.fields.get('excel_file')
+        try:
+            SlowQuery.objects.create(
+                view_name=request.resolver_match.view_name,
+                path=request.path[:500],
+                method=request.method,
+                status_code=response.status_code,
+                user_id=user.pk if user is not None and user.is_authenticated else None,
+                excel_file_id=excel_file.pk if excel_file is not None else None,
+                sheet_name=trace.fields.get('sheet_name') or '',
+                filters=trace.fields.get('filters'),
+                rows_scanned=trace.rows_scanned,
+                cache_hit=trace.fields.get('cache_hit'),
+                duration_ms=duration,
+                phases={name: round(elapsed, 3) for name, elapsed in trace.phases.items()},
+                sampled=sampled,
+            )
+        except Exception:
+            # Tracing must never fail the request it describes
+            logger.exception('Could not record slow query')
@@ -18,9 +18,17 @@ urlpatterns = [
     path('toggle-excel/', views.toggle_excel, name='toggle_excel'),
     path('delete-excel/', views.delete_excel, name='delete_excel'),
     path('configure-sheets/<int:excel_id>/', views.configure_sheets, name='configure_sheets'),
+    path('profiles/<uuid:request_id>/', views.profile_detail, name='profile_detail'),
+    path('profiles/<uuid:request_id>/download/', views.profile_download, name='profile_download'),
 
     # AJAX endpoints
     path('api/get-sheets/', views.get_sheets, name='get_sheets'),
     path('api/get-columns/', views.get_columns, name='get_columns'),  
+    path('api/search-values/', views.search_values, name='search_values'),
+    path('api/dataset/<int:file_id>/<str:version>/', views.sheet_dataset, name='sheet_dataset'),
+    path('api/log-query/', views.log_query, name='log_query'),
     path('api/fetch-results/', views.fetch_results, name='fetch_results'),
+    path('api/aggregate/', views.aggregate_results, name='aggregate_results'),
+    path('api/search-all/', views.search_all_sheets, name='search_all_sheets'),
+    path('api/popular-filters/', views.popular_filters, name='popular_filters'),
 ]
@@ -1,19 +1,20 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse, Http404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
 from django.conf import settings
-from django.core.files.storage import default_storage
 from django.views.decorators.http import require_GET, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.core.exceptions import ValidationError
-import pandas as pd
-import openpyxl
+from django.urls import reverse
+from urllib.parse import urlencode
+import gzip
 import json
-import numpy as np
+import os
 
-from .models import ExcelFile, QueryLog, CustomUser
+from .models import ExcelFile, QueryLog, CustomUser, RequestProfile
+from . import client_dataset, cross_search, heavy_hitters, ingest, preflight, profiling, query, query_servers, sheet_cache, tracing
 
 # Test commit
 def is_admin(user):
@@ -51,10 +52,44 @@ def admin_panel(request):
     context = {
         'users': CustomUser.objects.filter(is_staff=False),
         'excel_files': ExcelFile.objects.all(),
-        'search_logs': QueryLog.objects.all().order_by('-query_time')[:100]  # Get last 100 logs
+        # Get last 100 logs; files and users are in another database, so no join
+        'search_logs': QueryLog.objects.select_related('result').prefetch_related('user', 'excel_file').order_by('-query_time')[:100],
+        'profiles': RequestProfile.objects.prefetch_related('user')[:settings.PROFILE_LIST_SIZE],
     }
     return render(request, 'excel_processor/admin_panel.html', context)
 
+@login_required
+@user_passes_test(is_admin)
+def profile_detail(request, request_id):
+    """Top functions of a stored request profile"""
+    request_profile = get_object_or_404(RequestProfile, request_id=request_id)
+    sort = request.GET.get('sort', 'cumulative')
+    if sort not in profiling.PROFILE_SORT_KEYS:
+        sort = 'cumulative'
+    try:
+        functions = profiling.top_functions(profiling.profile_path(request_profile.request_id), sort=sort)
+    except (OSError, EOFError, TypeError) as e:
+        messages.error(request, f'Error reading profile: {str(e)}')
+        return redirect('excel_processor:admin_panel')
+
+    context = {
+        'request_profile': request_profile,
+        'functions': functions,
+        'sort': sort,
+        'sort_keys': list(profiling.PROFILE_SORT_KEYS),
+    }
+    return render(request, 'excel_processor/profile_detail.html', context)
+
+@login_required
+@user_passes_test(is_admin)
+def profile_download(request, request_id):
+    """Download the raw .prof file, for pstats or snakeviz"""
+    request_profile = get_object_or_404(RequestProfile, request_id=request_id)
+    path = profiling.profile_path(request_profile.request_id)
+    if not os.path.exists(path):
+        raise Http404('Profile file is missing')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'{request_profile.request_id}.prof')
+
 @login_required
 @user_passes_test(is_admin)
 def create_user(request):
@@ -91,22 +126,32 @@ def upload_excel(request):
     if ExcelFile.objects.filter(name=name).exists():
         messages.error(request, 'File name already exists')
     else:
+        # Check the zip directory and sheet dimensions before anything parses cells
+        try:
+            inspection = preflight.inspect(file) if file else None
+        except preflight.PreflightError as e:
+            messages.error(request, f'Excel file rejected: {str(e)}')
+            return redirect('excel_processor:admin_panel')
+        deferred = inspection is not None and not inspection.parse_inline
+
         excel_file = ExcelFile.objects.create(
             name=name,
             file=file,
             uploaded_by=request.user
         )
         
-        # Read the Excel file to get sheet names and columns
+        # Catalog its sheets, columns and column statistics, reusing the
+        # catalog of an earlier upload of the same workbook. Costly
+        # workbooks are cataloged out of band once the upload is saved
         try:
-            df = pd.ExcelFile(excel_file.file.path)
-            sheet_names = df.sheet_names
+            if deferred:
+                sheet_names, column_info = inspection.sheet_names, {}
+            else:
+                sheet_names, column_info = ingest.catalog_for(excel_file)
             
             # Initialize sheet configuration
             sheet_config = {}
             for sheet in sheet_names:
-                df_sheet = pd.read_excel(excel_file.file.path, sheet_name=sheet)
-                columns = list(df_sheet.columns)
                 sheet_config[sheet] = {
                     'is_enabled': False,  # Default to disabled
                     'filter_columns': [],  # Default to no filter columns
@@ -115,6 +160,7 @@ def upload_excel(request):
             
             # Update the model with sheet information and initial configuration
             excel_file.sheet_names = sheet_names
+            excel_file.column_info = column_info
             excel_file.sheet_config = sheet_config
             excel_file.enabled_sheets = list(sheet_names)  # Initially enable all sheets
             excel_file.save()
@@ -124,7 +170,13 @@ def upload_excel(request):
             excel_file.delete()
             return redirect('excel_processor:admin_panel')
         
-        messages.success(request, 'File uploaded successfully')
+        if deferred:
+            ingest.catalog_out_of_band(excel_file)
+            messages.success(request, 'File uploaded; its sheets are being processed in the background')
+        else:
+            messages.success(request, 'File uploaded successfully')
+        for sheet, error in ingest.failed_sheets(column_info).items():
+            messages.warning(request, f'Could not read sheet {sheet}: {error}')
     
     return redirect('excel_processor:admin_panel')
 
@@ -157,19 +209,33 @@ def configure_sheets(request, excel_id):
             sheet for sheet, config in sheet_config.items() 
             if config.get('is_enabled', True)
         ]
-        excel_file.save()
+        # Leaves column_info to a background ingest that may be writing it
+        excel_file.save(update_fields=['sheet_config', 'enabled_sheets'])
         
         return JsonResponse({'status': 'success'})
     
-    # Get available columns for each sheet
+    # Get available columns and their distinct counts for each sheet
     sheet_columns = {}
+    sheet_cardinality = {}
     sheet_config = excel_file.sheet_config or {}
     
     try:
-        df = pd.ExcelFile(excel_file.file.path)
+        # Files uploaded before the catalog existed are cataloged once here;
+        # those too costly to parse in a request are left to the background,
+        # and sent there again when an earlier ingest failed or was lost
+        column_info = excel_file.column_info or {}
+        if ingest.is_cataloged(column_info, excel_file.sheet_names) or ingest.can_catalog_inline(excel_file):
+            column_info = ingest.ensure_catalog(excel_file)
+        elif ingest.is_catalog_pending(column_info, excel_file.sheet_names):
+            messages.info(request, 'This workbook is still being processed; columns appear once it is done')
+        else:
+            ingest.catalog_out_of_band(excel_file)
+            messages.info(request, 'This workbook is being processed again in the background; columns appear once it is done')
+        for sheet, error in ingest.failed_sheets(column_info).items():
+            messages.warning(request, f'Could not read sheet {sheet}: {error}')
         for sheet in excel_file.sheet_names:
-            df_sheet = pd.read_excel(excel_file.file.path, sheet_name=sheet)
-            sheet_columns[sheet] = list(df_sheet.columns)
+            sheet_columns[sheet] = column_info.get(sheet, {}).get('columns', [])
+            sheet_cardinality[sheet] = ingest.cardinalities(column_info, sheet)
             
             # Initialize sheet config if it doesn't exist
             if sheet not in sheet_config:
@@ -185,7 +251,7 @@ def configure_sheets(request, excel_id):
             sheet for sheet, config in sheet_config.items() 
             if config.get('is_enabled', True)
         ]
-        excel_file.save()
+        excel_file.save(update_fields=['sheet_config', 'enabled_sheets'])
         
     except Exception as e:
         messages.error(request, f'Error reading Excel file: {str(e)}')
@@ -193,7 +259,9 @@ def configure_sheets(request, excel_id):
     
     context = {
         'excel_file': excel_file,
-        'sheet_columns': sheet_columns
+        'sheet_columns': sheet_columns,
+        'sheet_cardinality': sheet_cardinality,
+        'typeahead_threshold': settings.TYPEAHEAD_CARDINALITY_THRESHOLD,
     }
     return render(request, 'excel_processor/configure_sheets.html', context)
 
@@ -215,14 +283,17 @@ def toggle_excel(request):
 def delete_excel(request):
     excel_id = request.POST.get('excel_id')
     excel = ExcelFile.objects.get(id=excel_id)
-    if excel.file:
-        default_storage.delete(excel.file.name)
+    # The file itself goes with the last row referencing it
     excel.delete()
     return JsonResponse({'status': 'success'})
 
 @login_required
 @user_passes_test(is_admin)
 def configure_columns(request, excel_id):
+    # Imported here: workers serving lookups never load pandas or openpyxl
+    import openpyxl
+    import pandas as pd
+
     excel_file = get_object_or_404(ExcelFile, id=excel_id)
     
     # Ensure sheet names are cached
@@ -312,6 +383,7 @@ def get_sheets(request):
         # If sheet names are not cached, read from file
         if not excel_file.sheet_names:
             try:
+                import openpyxl
                 wb = openpyxl.load_workbook(excel_file.file.path, read_only=True)
                 sheet_names = wb.sheetnames
                 wb.close()
@@ -357,29 +429,27 @@ def get_columns(request):
         if not sheet_config.get('is_enabled', True):  # Default to True if not configured
             return JsonResponse({'error': 'Selected sheet is not enabled'}, status=400)
         
-        # Read the Excel file and get columns
+        # Load the sheet (cached) and get columns
         try:
-            df = pd.read_excel(excel_file.file.path, sheet_name=sheet_name)
-            all_columns = df.columns.tolist()
-
-            # Get configured filter columns
-            filterable_columns = sheet_config.get('filter_columns', [])
+            tracing.annotate(excel_file=excel_file, sheet_name=sheet_name)
 
-            # Get unique values for each filterable column
-            column_data = {}
-            for column in filterable_columns:
-                # Get unique values and convert to string, handling NaN values
-                unique_values = df[column].dropna().astype(str).unique().tolist()
-                # Sort the values
-                unique_values.sort()
-                column_data[column] = unique_values
+            # Sorted unique values per filter column, on whichever process holds the sheet
+            columns = query_servers.run('columns', excel_file, sheet_name)
 
             # Get result columns from sheet config
             result_columns = sheet_config.get('result_columns', ['total'])
 
+            # Small sheets can be downloaded once and filtered in the browser
+            dataset_url = None
+            if columns['dataset_version']:
+                dataset_url = reverse('excel_processor:sheet_dataset', args=[excel_file.id, columns['dataset_version']])
+                dataset_url += '?' + urlencode({'sheet_name': sheet_name})
+
             return JsonResponse({
-                'columns': column_data,
-                'result_columns': result_columns
+                'columns': columns['columns'],
+                'typeahead_columns': columns['typeahead_columns'],
+                'result_columns': result_columns,
+                'dataset_url': dataset_url
             })
 
         except Exception as e:
@@ -389,6 +459,140 @@ def get_columns(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@require_GET
+def sheet_dataset(request, file_id, version):
+    """Serve a sheet's precompressed client-side payload under its immutable, versioned URL"""
+    sheet_name = request.GET.get('sheet_name')
+    if not sheet_name:
+        return JsonResponse({'error': 'Sheet name is required'}, status=400)
+
+    excel_file = get_object_or_404(ExcelFile, id=file_id, is_active=True)
+    sheet_config = excel_file.sheet_config.get(sheet_name, {})
+    if sheet_name not in (excel_file.sheet_names or []) or not sheet_config.get('is_enabled', True):
+        raise Http404('Sheet not found')
+
+    # A URL for an older version must never be answered with newer content
+    if version != client_dataset.version(excel_file, sheet_name):
+        raise Http404('Dataset version is no longer current')
+    if not client_dataset.is_servable(excel_file, sheet_name, version):
+        raise Http404('Dataset is not available for this sheet')
+
+    encoding, path = client_dataset.negotiate(
+        excel_file, sheet_name, version, request.META.get('HTTP_ACCEPT_ENCODING')
+    )
+    with open(path, 'rb') as f:
+        content = f.read()
+    if encoding is None:
+        content = gzip.decompress(content)
+
+    response = HttpResponse(content, content_type='application/json')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['ETag'] = f'"{version}"'
+    response['Cache-Control'] = f'private, max-age={settings.CLIENT_DATASET_MAX_AGE}, immutable'
+    return response
+
+
+@require_POST
+def log_query(request):
+    """Beacon endpoint logging a lookup the browser resolved from a sheet payload
+
+    Only the lookup itself is taken from the request; its results are
+    resolved again on the server, so a client cannot write arbitrary
+    results into the log.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+
+    try:
+        data = json.loads(request.body)
+        file_id = data.get('file_id')
+        sheet_name = data.get('sheet_name')
+        filters = data.get('filters', {})
+
+        if not file_id or not sheet_name:
+            return JsonResponse({'error': 'File ID and sheet name are required'}, status=400)
+
+        excel_file = get_object_or_404(ExcelFile, id=file_id, is_active=True)
+        sheet_config = excel_file.sheet_config.get(sheet_name, {})
+        if not sheet_config.get('is_enabled', True):
+            return JsonResponse({'error': 'Selected sheet is not enabled'}, status=400)
+
+        try:
+            # Cheap: sheets small enough to be filtered in the browser are
+            # snapshotted, and repeated lookups come from the shared cache
+            applied_filters, results = query_servers.run('lookup', excel_file, sheet_name, filters=filters)
+        except query.FilterError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        QueryLog.objects.create(
+            user=request.user,
+            excel_file=excel_file,
+            sheet_name=sheet_name,
+            filters_applied=applied_filters,
+            result_found=results is not None,
+            result_data=results
+        )
+        heavy_hitters.record(excel_file.id, sheet_name, applied_filters)
+        return HttpResponse(status=204)
+
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+
+@require_GET
+def search_values(request):
+    """AJAX endpoint to search the values of a high-cardinality filter column"""
+    try:
+        file_id = request.GET.get('file_id')
+        sheet_name = request.GET.get('sheet_name')
+        column = request.GET.get('column')
+        text = request.GET.get('q', '')
+        mode = request.GET.get('mode', 'prefix')
+
+        if not file_id or not sheet_name or not column:
+            return JsonResponse({'error': 'File ID, sheet name and column are required'}, status=400)
+
+        if mode not in ('prefix', 'contains'):
+            return JsonResponse({'error': 'Mode must be "prefix" or "contains"'}, status=400)
+
+        try:
+            limit = int(request.GET.get('limit', settings.TYPEAHEAD_RESULT_LIMIT))
+        except ValueError:
+            return JsonResponse({'error': 'Limit must be an integer'}, status=400)
+        limit = max(1, min(limit, settings.TYPEAHEAD_RESULT_LIMIT))
+
+        excel_file = get_object_or_404(ExcelFile, id=file_id, is_active=True)
+
+        # Get sheet configuration
+        sheet_config = excel_file.sheet_config.get(sheet_name, {})
+
+        # Check if sheet is enabled in sheet_config
+        if not sheet_config.get('is_enabled', True):  # Default to True if not configured
+            return JsonResponse({'error': 'Selected sheet is not enabled'}, status=400)
+
+        if column not in sheet_config.get('filter_columns', []):
+            return JsonResponse({'error': 'Column is not a filter column'}, status=400)
+
+        try:
+            values = query_servers.run(
+                'search_values', excel_file, sheet_name, column=column, text=text, mode=mode, limit=limit
+            )
+        except Exception as e:
+            return JsonResponse({'error': f'Error reading sheet: {str(e)}'}, status=500)
+
+        return JsonResponse({
+            'column': column,
+            'values': values
+        })
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
 @require_POST
 @csrf_exempt
 def fetch_results(request):
@@ -411,66 +615,29 @@ def fetch_results(request):
         if not sheet_config.get('is_enabled', True):  # Default to True if not configured
             return JsonResponse({'error': 'Selected sheet is not enabled'}, status=400)
 
+        tracing.annotate(excel_file=excel_file, sheet_name=sheet_name, filters=filters)
+
         try:
-            # Read the Excel file
-            df = pd.read_excel(excel_file.file.path, sheet_name=sheet_name)
-
-            # Apply filters
-            filtered_df = df.copy()
-            applied_filters = {}
-
-            for column, value in filters.items():
-                if value and column in df.columns:
-                    # Convert both to string for comparison to handle mixed types
-                    filtered_df = filtered_df[filtered_df[column].astype(str) == str(value)]
-                    applied_filters[column] = value
-
-            if len(filtered_df) > 0:
-                # Get result columns from sheet config
-                sheet_config = excel_file.sheet_config.get(sheet_name, {})
-                result_columns = sheet_config.get('result_columns', ['total'])
-
-                # Convert numpy values to native Python types
-                results = {}
-                
-                # First add 'total' if it's in the result columns
-                if 'total' in result_columns:
-                    total_value = filtered_df['total'].iloc[0]
-                    # Convert to float for consistent decimal handling
-                    if pd.isna(total_value):
-                        total_value = None
-                    else:
-                        # Convert any numeric type to float
-                        try:
-                            total_value = float(total_value)
-                        except:
-                            total_value = None
-                    results['total'] = total_value
-                
-                # Then add all other columns
-                for col in result_columns:
-                    if col.lower() != 'total':  # Skip total as it's already added
-                        value = filtered_df[col].iloc[0]
-                        # Convert numpy types to native Python types
-                        if isinstance(value, (np.int64, np.int32)):
-                            value = int(value)
-                        elif isinstance(value, (np.float64, np.float32)):
-                            value = float(value)
-                        elif pd.isna(value):
-                            value = None
-                        else:
-                            value = str(value)
-                        results[col] = value
+            try:
+                # Scans the worksheet if the sheet is not loaded yet, else
+                # looks up the first matching row; 'total' comes first
+                applied_filters, results = query_servers.run('lookup', excel_file, sheet_name, filters=filters)
+            except query.FilterError as e:
+                return JsonResponse({'error': str(e)}, status=400)
 
+            heavy_hitters.record(excel_file.id, sheet_name, applied_filters)
+
+            if results is not None:
                 # Log the successful search
-                QueryLog.objects.create(
-                    user=request.user,
-                    excel_file=excel_file,
-                    sheet_name=sheet_name,
-                    filters_applied=applied_filters,
-                    result_found=True,
-                    result_data=results
-                )
+                with tracing.phase('log'):
+                    QueryLog.objects.create(
+                        user=request.user,
+                        excel_file=excel_file,
+                        sheet_name=sheet_name,
+                        filters_applied=applied_filters,
+                        result_found=True,
+                        result_data=results
+                    )
                 return JsonResponse({
                     'success': True,
                     'results': results,
@@ -478,14 +645,15 @@ def fetch_results(request):
                 })
 
             # Log unsuccessful search
-            QueryLog.objects.create(
-                user=request.user,
-                excel_file=excel_file,
-                sheet_name=sheet_name,
-                filters_applied=applied_filters,
-                result_found=False,
-                result_data=None
-            )
+            with tracing.phase('log'):
+                QueryLog.objects.create(
+                    user=request.user,
+                    excel_file=excel_file,
+                    sheet_name=sheet_name,
+                    filters_applied=applied_filters,
+                    result_found=False,
+                    result_data=None
+                )
             
             return JsonResponse({
                 'success': False,
@@ -502,17 +670,131 @@ def fetch_results(request):
         return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
 
 
+@require_POST
+@csrf_exempt
+def aggregate_results(request):
+    """AJAX endpoint to group and aggregate the rows matching a filter set"""
+    try:
+        data = json.loads(request.body)
+        file_id = data.get('file_id')
+        sheet_name = data.get('sheet_name')
+        filters = data.get('filters', {})
+        group_by = data.get('group_by', [])
+
+        if not file_id or not sheet_name:
+            return JsonResponse({'error': 'File ID and sheet name are required'}, status=400)
+
+        excel_file = get_object_or_404(ExcelFile, id=file_id, is_active=True)
+
+        # Get sheet configuration
+        sheet_config = excel_file.sheet_config.get(sheet_name, {})
+
+        # Check if sheet is enabled in sheet_config
+        if not sheet_config.get('is_enabled', True):  # Default to True if not configured
+            return JsonResponse({'error': 'Selected sheet is not enabled'}, status=400)
+
+        # Group by filter or result columns; aggregate result columns only
+        result_columns = sheet_config.get('result_columns', ['total'])
+        groupable_columns = sheet_cache.configured_columns(sheet_config)
+        if not isinstance(group_by, list) or any(column not in groupable_columns for column in group_by):
+            return JsonResponse({'error': 'Group by must list configured columns'}, status=400)
+
+        try:
+            aggregates = query.parse_aggregates(
+                data.get('aggregates', {column: ['sum', 'count'] for column in result_columns}),
+                result_columns
+            )
+        except query.QueryError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        try:
+            applied_filters, groups = query_servers.run(
+                'aggregate', excel_file, sheet_name, filters=filters, group_by=group_by, aggregates=aggregates
+            )
+        except query.QueryError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': f'Error reading or processing file: {str(e)}'}, status=500)
+
+        return JsonResponse({
+            'success': True,
+            'group_by': group_by,
+            'applied_filters': applied_filters,
+            'groups': groups
+        })
+
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+
+@require_POST
+@csrf_exempt
+def search_all_sheets(request):
+    """AJAX endpoint streaming matches for one filter set across every product and sheet
+
+    The response is newline-delimited JSON: one line per matching sheet as
+    it is found, then a summary line with "done": true.
+    """
+    try:
+        data = json.loads(request.body)
+        filters = data.get('filters', {})
+        excel_files = list(ExcelFile.objects.filter(is_active=True))
+
+        # Validate the filters once and drop blank ones before fanning out
+        columns = cross_search.filter_columns(excel_files)
+        try:
+            _, applied_filters = query.parse_filters(filters, columns)
+        except query.FilterError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        # No sheet could apply them, so nothing could match
+        unknown = [column for column in filters if column not in columns]
+        if unknown:
+            return JsonResponse({'error': f'Not a filter column of any sheet: {", ".join(unknown)}'}, status=400)
+
+        if not applied_filters:
+            return JsonResponse({'error': 'At least one filter is required'}, status=400)
+
+        try:
+            time_budget = float(data.get('time_budget', settings.CROSS_SEARCH_TIME_BUDGET))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'Time budget must be a number of seconds'}, status=400)
+        time_budget = max(0.0, min(time_budget, settings.CROSS_SEARCH_TIME_BUDGET))
+
+        lines = (
+            json.dumps(line) + '\n'
+            for line in cross_search.search_all(excel_files, applied_filters, time_budget)
+        )
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+
 def analytics(request):
     """Analytics page showing query statistics"""
     total_queries = QueryLog.objects.count()
     successful_queries = QueryLog.objects.filter(result_found=True).count()
-    recent_queries = QueryLog.objects.select_related('excel_file')[:10]
+    recent_queries = QueryLog.objects.prefetch_related('excel_file')[:10]
 
-    # Popular files
+    # Popular files, counted in the log database and looked up in the main one
     from django.db.models import Count
-    popular_files = ExcelFile.objects.annotate(
-        query_count=Count('querylog')
+    file_counts = QueryLog.objects.values('excel_file_id').annotate(
+        query_count=Count('id')
     ).order_by('-query_count')[:5]
+    files = ExcelFile.objects.in_bulk([row['excel_file_id'] for row in file_counts])
+    popular_files = []
+    for row in file_counts:
+        excel_file = files.get(row['excel_file_id'])
+        if excel_file is not None:
+            excel_file.query_count = row['query_count']
+            popular_files.append(excel_file)
+
+    # Hottest filter combinations, from the streaming summary
+    popular_filters, _ = _popular_filters(settings.HEAVY_HITTER_TOP)
 
     context = {
         'total_queries': total_queries,
@@ -520,5 +802,33 @@ def analytics(request):
         'success_rate': (successful_queries / total_queries * 100) if total_queries > 0 else 0,
         'recent_queries': recent_queries,
         'popular_files': popular_files,
+        'popular_filters': popular_filters,
     }
     return render(request, 'excel_processor/analytics.html', context)
+
+
+def _popular_filters(limit):
+    """Top filter combinations with their file names, and the lookups counted"""
+    combinations, total = heavy_hitters.top(limit)
+    names = dict(ExcelFile.objects.filter(
+        id__in=[combination['file_id'] for combination in combinations]
+    ).values_list('id', 'name'))
+    # Other processes may still flush counts for a file deleted since
+    combinations = [combination for combination in combinations if combination['file_id'] in names]
+    for combination in combinations:
+        combination['file_name'] = names[combination['file_id']]
+    return combinations, total
+
+
+@require_GET
+def popular_filters(request):
+    """JSON list of the most frequent filter combinations (approximate counts)"""
+    try:
+        limit = min(int(request.GET.get('limit', settings.HEAVY_HITTER_TOP)), settings.HEAVY_HITTER_CAPACITY)
+    except ValueError:
+        return JsonResponse({'error': 'Limit must be a number'}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'Limit must be positive'}, status=400)
+
+    combinations, total = _popular_filters(limit)
+    return JsonResponse({'success': True, 'total': total, 'combinations': combinations})
@@ -0,0 +1,88 @@
+"""Cheap facts about .xlsx workbooks, read from the zip directory without parsing cells"""
+import posixpath
+import re
+import zipfile
+from xml.etree import ElementTree
+
+
+_MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# The <dimension> record sits near the top of a worksheet part
+_DIMENSION = re.compile(rb'<(?:\w+:)?dimension\s+ref="([A-Z]+)?(\d+)?(?::([A-Z]+)(\d+))?"')
+_DIMENSION_SCAN_BYTES = 64 * 1024
+
+
+def _column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+def sheet_parts(archive):
+    """Return {sheet name: worksheet part path} for an open .xlsx archive"""
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{_PACKAGE_REL_NS}Relationship')}
+
+    parts = {}
+    for sheet in workbook.iter(f'{_MAIN_NS}sheet'):
+        target = targets.get(sheet.get(f'{_REL_NS}id'))
+        if target:
+            if target.startswith('/'):
+                parts[sheet.get('name')] = target.lstrip('/')
+            else:
+                parts[sheet.get('name')] = posixpath.normpath(posixpath.join('xl', target))
+    return parts
+
+
+def read_dimension(archive, part):
+    """Return the declared (rows, columns) of a worksheet part, or None if absent"""
+    with archive.open(part) as f:
+        head = f.read(_DIMENSION_SCAN_BYTES)
+    match = _DIMENSION.search(head)
+    if not match:
+        return None
+
+    start_col, start_row, end_col, end_row = (
+        group.decode('ascii') if group else None for group in match.groups()
+    )
+    if end_row is None:
+        # A single-cell reference such as "A1"
+        end_col, end_row = start_col, start_row
+    if not end_row or not end_col:
+        return None
+    start_row = int(start_row or 1)
+    start_col = _column_number(start_col or 'A')
+    return int(end_row) - start_row + 1, _column_number(end_col) - start_col + 1
+
+
+def sheet_dimensions(path):
+    """Return {sheet name: (rows, columns) or None} for an .xlsx file
+
+    Returns None when the file is not an .xlsx zip (e.g. legacy .xls).
+    """
+    if not zipfile.is_zipfile(path):
+        return None
+    with zipfile.ZipFile(path) as archive:
+        return {
+            name: read_dimension(archive, part) if part in archive.namelist() else None
+            for name, part in sheet_parts(archive).items()
+        }
+
+
+def header_names(row):
+    """Column names as pandas would give them: unnamed and repeated ones renamed"""
+    names = []
+    seen = {}
+    for position, value in enumerate(row):
+        name = f'Unnamed: {position}' if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
@@ -33,11 +33,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.excel_processor.tracing.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apps.excel_processor.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -69,9 +71,21 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # Query logs are written on every lookup, so they get their own file
+    # (WAL, relaxed sync) instead of contending with sessions and auth
+    'logs': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'query_logs.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+        },
+    },
 }
 
+LOG_DATABASE = 'logs'
+DATABASE_ROUTERS = ['apps.excel_processor.routers.LogDatabaseRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -127,5 +141,100 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
 ALLOWED_EXCEL_EXTENSIONS = ['.xlsx', '.xls']
 
+# Upload preflight: limits checked from the .xlsx zip directory and sheet
+# dimension records before any cell is parsed
+PREFLIGHT_MAX_ROWS = 1000000  # Per sheet, as declared
+PREFLIGHT_MAX_COLUMNS = 1000  # Per sheet, as declared
+PREFLIGHT_MAX_CELLS = 50000000  # Estimated, whole workbook
+PREFLIGHT_MAX_UNCOMPRESSED_BYTES = 512 * 1024 * 1024
+PREFLIGHT_MAX_SHARED_STRINGS_BYTES = 128 * 1024 * 1024
+PREFLIGHT_MAX_COMPRESSION_RATIO = 100  # Per part; XML usually compresses 5-20:1
+PREFLIGHT_INLINE_MEMORY_BUDGET = 256 * 1024 * 1024  # Estimated parse memory; larger workbooks ingest out of band
+
 # Hardcoded result columns (these won't appear as filter dropdowns)
 RESULT_COLUMNS = ['total', 'product_code']
+
+# Sheet cache settings
+SHEET_CACHE_MAX_SHEETS = 32  # Loaded sheets kept in memory per process
+SHEET_SNAPSHOT_DIR = BASE_DIR / 'sheet_snapshots'  # Parsed columns, one file per column
+SHEET_RESULT_CACHE_SIZE = 128  # Memoized aggregation results per loaded sheet
+SQLITE_BACKEND_ROW_THRESHOLD = 200000  # Larger sheets are queried from a SQLite store
+STREAMING_SCAN_ENABLED = True  # Scan unloaded sheets row by row instead of loading them
+SHEET_LOAD_TIMEOUT = 120  # Seconds to wait on a concurrent load of the same sheet
+SHEET_LOAD_FILE_LOCK = True  # Also deduplicate loads across worker processes
+BITMAP_INDEX_MAX_DISTINCT = 64  # Filter columns with fewer values get bitmap indexes
+COLUMN_STATS_TOP_VALUES = 5  # Most frequent values kept in the column catalog
+INGEST_WORKERS = min(4, os.cpu_count() or 1)  # Processes parsing a workbook's sheets at upload
+INGEST_PENDING_TIMEOUT = 60 * 60  # Seconds before an unfinished out-of-band ingest is retried
+
+# Filter columns with more distinct values than this are served through
+# the typeahead search endpoint instead of inline dropdown values
+TYPEAHEAD_CARDINALITY_THRESHOLD = 500
+TYPEAHEAD_RESULT_LIMIT = 20
+
+# Client-side datasets: small sheets are served to the browser as one
+# compressed payload and filtered there instead of through the API
+CLIENT_DATASET_ENABLED = True
+CLIENT_DATASET_MAX_ROWS = 20000
+CLIENT_DATASET_MAX_BYTES = 512 * 1024  # Compressed size
+CLIENT_DATASET_MAX_AGE = 365 * 24 * 60 * 60  # Seconds; payload URLs are versioned
+
+# Shared result cache: with a directory set, results of sheet operations
+# are cached on disk for every worker process on the host. Keys carry each
+# sheet's version, so configuration and workbook changes take effect
+# without restarting workers.
+SHARED_CACHE_DIR = None  # e.g. BASE_DIR / 'shared_cache'
+SHARED_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds
+SHARED_CACHE_MAX_ENTRIES = 10000
+
+# Cross-product search settings
+CROSS_SEARCH_MAX_WORKERS = 4  # Sheets searched concurrently per process
+CROSS_SEARCH_TIME_BUDGET = 5.0  # Seconds before remaining sheets are abandoned
+
+# Query servers: with addresses listed ("host:port" or a Unix socket path),
+# sheet lookups are forwarded to the server owning each sheet on a
+# consistent hash ring instead of loading sheets in every web worker.
+# Run them with `manage.py run_query_servers`.
+QUERY_SERVERS = []
+QUERY_SERVER_AUTHKEY = None  # Defaults to SECRET_KEY
+QUERY_SERVER_TIMEOUT = 150  # Seconds; above SHEET_LOAD_TIMEOUT so cold loads can finish
+QUERY_SERVER_RETRY_AFTER = 10  # Seconds an unreachable server is skipped
+QUERY_SERVER_RING_REPLICAS = 64  # Points per server on the hash ring
+
+# Popular filter combinations: each worker counts lookups in a bounded
+# space-saving summary and merges it into the log database periodically
+HEAVY_HITTER_CAPACITY = 500  # Combinations tracked; memory stays bounded by this
+HEAVY_HITTER_FLUSH_INTERVAL = 30  # Seconds between merges into the log database
+HEAVY_HITTER_TOP = 20  # Combinations shown in analytics
+
+# Sheet prewarming, ranked by recent QueryLog volume
+SHEET_PREWARM_ON_STARTUP = False  # Prewarm on a background thread when a worker starts
+SHEET_PREWARM_DELAY = 5  # Seconds to wait after startup before prewarming
+SHEET_PREWARM_DAYS = 7
+SHEET_PREWARM_LIMIT = 10
+SHEET_PREWARM_TIME_BUDGET = 60  # Seconds
+SHEET_PREWARM_MEMORY_BUDGET = 512 * 1024 * 1024  # Bytes
+
+# Slow query log: traced views slower than the threshold are recorded,
+# plus a random sample of the rest
+SLOW_QUERY_THRESHOLD_MS = 500
+SLOW_QUERY_SAMPLE_RATE = 0.0  # e.g. 0.01 to also trace 1% of normal requests
+SLOW_QUERY_VIEWS = [
+    'excel_processor:fetch_results',
+    'excel_processor:get_columns',
+    'excel_processor:admin_panel',
+    'excel_processor:configure_sheets',
+    'excel_processor:configure_columns',
+    'excel_processor:analytics',
+    'admin',  # Every Django admin view
+]
+
+# On-demand request profiling for staff (?_profile=1 or an X-Profile: 1 header)
+PROFILING_ENABLED = True
+PROFILE_DIR = BASE_DIR / 'profiles'
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_LIST_SIZE = 20  # Recent profiles listed in the admin panel
+
+# Query log admin: counts stop at this many rows ("10000+") so the
+# changelist never counts the whole table
+QUERYLOG_ADMIN_COUNT_LIMIT = 10000